@@ -0,0 +1,331 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import synthetic
+
+
+# End-to-end benchmark and regression check for the xdelta backends
+# that patch_core.do_xdelta() can use:
+#
+# - "module": the xdelta3 Python module
+# - "exe": data/xdelta3.exe (through wine, except on Windows)
+# - "pure_py": xdelta3_pure_py
+#
+# These three are timed through do_xdelta() itself, with the backends
+# it would have preferred switched off, so that its overhead (temporary
+# files, copies) is measured too. Two more are run directly, as
+# reference points:
+#
+# - "cli": a native xdelta3 program on the PATH (not used by the wizard)
+# - "pure_py_pipelined": xdelta3_pure_py.apply_vcdiff_pipelined()
+#
+# Every run happens in a fresh subprocess, so that peak RSS and CPU time
+# can be measured separately for each one. Results are compared against
+# a baseline file, and the script fails if any backend got slower than
+# the threshold allows (or produced the wrong output).
+
+
+DEFAULT_BASELINE_FP = Path(__file__).resolve().parent / 'baseline.json'
+
+BACKENDS = ['module', 'exe', 'cli', 'pure_py', 'pure_py_pipelined']
+
+
+def backend_available(backend: str) -> bool:
+    """Check if a backend can run on this machine"""
+    if backend == 'module':
+        import patch_core
+        return patch_core.get_xdelta3_module() is not None
+    elif backend == 'exe':
+        if not (ROOT_DIR / 'data' / 'xdelta3.exe').is_file():
+            return False
+        return sys.platform == 'win32' or shutil.which('wine') is not None
+    elif backend == 'cli':
+        return shutil.which('xdelta3') is not None
+    else:
+        return True
+
+
+def run_do_xdelta(backend: str, src_fp: Path, patch_fp: Path, out_fp: Path) -> None:
+    """
+    Apply a patch with patch_core.do_xdelta(), forcing it to use the
+    given backend ("module", "exe" or "pure_py")
+    """
+    import patch_core
+    import telemetry
+
+    # (do_xdelta() runs xdelta3.exe from the data folder)
+    os.chdir(ROOT_DIR)
+
+    # do_xdelta() tries the module, then xdelta3.exe, then pure Python,
+    # so switch off the ones ahead of the backend being measured
+    if backend != 'module':
+        patch_core.get_xdelta3_module = lambda: None
+    if backend == 'pure_py':
+        def exe_disabled(*args):
+            raise RuntimeError('xdelta3.exe is switched off for this benchmark')
+        patch_core.get_xdelta3_exe_command = exe_disabled
+
+    records = []
+    telemetry.enable(records.append)
+    out_fp.write_bytes(patch_core.do_xdelta(src_fp.read_bytes(), patch_fp.read_bytes()))
+    telemetry.disable()
+
+    # ("pure_py" can also come out as "pure_py_threaded")
+    used = [r['backend'] for r in records if r['phase'] == 'xdelta']
+    if not used or not used[-1].startswith(backend):
+        raise RuntimeError(f'do_xdelta() used {used} instead of {backend}')
+
+
+def run_backend(backend: str, src_fp: Path, patch_fp: Path, out_fp: Path) -> None:
+    """Apply a patch with one backend (in the worker process)"""
+    if backend == 'cli':
+        subprocess.run(['xdelta3', '-d', '-f', '-s', str(src_fp), str(patch_fp), str(out_fp)], check=True)
+
+    elif backend == 'pure_py_pipelined':
+        import xdelta3_pure_py
+        with out_fp.open('wb') as out:
+            xdelta3_pure_py.apply_vcdiff_pipelined(src_fp.read_bytes(), patch_fp.read_bytes(), out)
+
+    else:
+        run_do_xdelta(backend, src_fp, patch_fp, out_fp)
+
+
+def get_peak_rss() -> Optional[int]:
+    """
+    Return the peak RSS of this process or any of its (finished) child
+    processes, in bytes, or None if the OS can't report it
+    """
+    peak = None
+
+    # (VmHWM is used instead of getrusage() where possible, since
+    # ru_maxrss carries over across exec() from the parent process)
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith('VmHWM:'):
+                peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:  # Windows
+        return peak
+
+    def get_maxrss(who: int) -> int:
+        # (ru_maxrss is in KiB, except on macOS, where it's in bytes)
+        maxrss = resource.getrusage(who).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    if peak is None:
+        peak = get_maxrss(resource.RUSAGE_SELF)
+    return max(peak, get_maxrss(resource.RUSAGE_CHILDREN))
+
+
+def worker_main(backend: str, src_fp: Path, patch_fp: Path, out_fp: Path) -> int:
+    start_wall = time.perf_counter()
+    start_times = os.times()
+
+    run_backend(backend, src_fp, patch_fp, out_fp)
+
+    wall_seconds = time.perf_counter() - start_wall
+    end_times = os.times()
+    # (On Windows, the children's CPU times are always 0)
+    cpu_seconds = sum(end_times[:4]) - sum(start_times[:4])
+
+    print(json.dumps({
+        'wallSeconds': wall_seconds,
+        'cpuSeconds': cpu_seconds,
+        'peakRssBytes': get_peak_rss(),
+    }))
+    return 0
+
+
+def measure(backend: str, src_fp: Path, patch_fp: Path, out_fp: Path) -> Optional[dict]:
+    """
+    Run a backend in a fresh subprocess, and return its wall time, CPU
+    time (including any subprocesses of its own) and peak RSS, or None
+    if it failed
+    """
+    proc = subprocess.run(
+        [sys.executable, __file__, '--worker', backend, str(src_fp), str(patch_fp), str(out_fp)],
+        stdout=subprocess.PIPE)
+
+    if proc.returncode != 0:
+        return None
+
+    return json.loads(proc.stdout)
+
+
+def run_benchmarks(sizes: List[int], backends: List[str], seed: int, repeat: int) -> List[dict]:
+    """
+    Run every backend on synthetic patches of every size (in MiB), with
+    and without LZMA secondary compression
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        src_fp = temp_dir / 'source.nds'
+        patch_fp = temp_dir / 'patch.xdelta'
+        out_fp = temp_dir / 'out.nds'
+
+        for size in sizes:
+            for use_lzma in [False, True]:
+                case = f'{size}MiB-{"lzma" if use_lzma else "plain"}'
+                source, patch, target = synthetic.make_pair(size * 0x100000, seed,
+                    use_lzma=use_lzma, edit_mix='rom_like')
+                src_fp.write_bytes(source)
+                patch_fp.write_bytes(patch)
+                expected_md5 = hashlib.md5(target).hexdigest()
+                del source, target
+
+                for backend in backends:
+                    best = None
+                    for _ in range(repeat):
+                        if out_fp.exists():
+                            out_fp.unlink()
+                        result = measure(backend, src_fp, patch_fp, out_fp)
+                        if result is None:
+                            result = {'wallSeconds': None, 'cpuSeconds': None, 'peakRssBytes': None}
+                        result['correct'] = (result['wallSeconds'] is not None and out_fp.is_file()
+                            and hashlib.md5(out_fp.read_bytes()).hexdigest() == expected_md5)
+                        if not result['correct']:
+                            best = result
+                            break
+                        if best is None or result['wallSeconds'] < best['wallSeconds']:
+                            best = result
+
+                    results.append({'backend': backend, 'case': case, 'patchSize': len(patch), **best})
+
+                    if best['correct']:
+                        print(f'{case:14s} {backend:18s} {best["wallSeconds"]:8.3f}s'
+                            f'  cpu {best["cpuSeconds"] or 0:7.3f}s'
+                            f'  rss {(best["peakRssBytes"] or 0) / 0x100000:7.1f} MiB', flush=True)
+                    else:
+                        print(f'{case:14s} {backend:18s} WRONG OUTPUT OR FAILED', flush=True)
+
+    return results
+
+
+def compare_to_baseline(results: List[dict], baseline: List[dict],
+        threshold: float, min_delta: float) -> List[str]:
+    """
+    Return a list of problems: wrong outputs, and backends that are
+    more than `threshold` times (and at least min_delta seconds) slower
+    than in the baseline
+    """
+    problems = []
+    baseline_times = {(r['backend'], r['case']): r['wallSeconds'] for r in baseline if r.get('correct')}
+
+    for r in results:
+        key = (r['backend'], r['case'])
+        if not r['correct']:
+            problems.append(f'{r["backend"]} produced wrong output for {r["case"]}')
+        elif (key in baseline_times
+                and r['wallSeconds'] > baseline_times[key] * threshold
+                and r['wallSeconds'] - baseline_times[key] > min_delta):
+            problems.append(f'{r["backend"]} slowed down on {r["case"]}:'
+                f' {baseline_times[key]:.3f}s -> {r["wallSeconds"]:.3f}s')
+
+    return problems
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark every available xdelta backend, and check for regressions.')
+    parser.add_argument('--sizes', default='8,32',
+        help='comma-separated synthetic ROM sizes, in MiB (default: 8,32)')
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+        help=f'comma-separated backends to try, if available (default: {",".join(BACKENDS)})')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per backend and case; the fastest is kept (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE_FP,
+        help='baseline results to compare against (default: benchmarks/baseline.json)')
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help='fail if anything is this many times slower than the baseline (default: 1.25)')
+    parser.add_argument('--min-delta', type=float, default=0.05,
+        help="ignore slowdowns smaller than this many seconds, which are "
+        "usually just noise (default: 0.05)")
+    parser.add_argument('--update-baseline', action='store_true',
+        help='save the results as the new baseline instead of comparing')
+    parser.add_argument('--json', type=Path,
+        help='also write the results to this file')
+    parser.add_argument('--worker', nargs=4, metavar=('BACKEND', 'SOURCE', 'PATCH', 'OUTPUT'),
+        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker is not None:
+        backend, *fps = args.worker
+        return worker_main(backend, *map(Path, fps))
+
+    backends = [b for b in args.backends.split(',') if backend_available(b)]
+    sizes = [int(s) for s in args.sizes.split(',')]
+    print(f'Backends: {", ".join(backends)}')
+
+    results = run_benchmarks(sizes, backends, args.seed, args.repeat)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'results': results,
+    }
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(report, indent=4) + '\n', encoding='utf-8')
+
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(report, indent=4) + '\n', encoding='utf-8')
+        print(f'Saved the baseline to {args.baseline}')
+        return 0 if all(r['correct'] for r in results) else 1
+
+    baseline = []
+    if args.baseline.is_file():
+        baseline = json.loads(args.baseline.read_text(encoding='utf-8'))['results']
+    else:
+        print(f'No baseline found at {args.baseline}; only checking correctness')
+
+    problems = compare_to_baseline(results, baseline, args.threshold, args.min_delta)
+    for problem in problems:
+        print(f'FAIL: {problem}', file=sys.stderr)
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
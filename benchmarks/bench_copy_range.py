@@ -0,0 +1,159 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import synthetic
+import xdelta3_pure_py
+
+
+# Compares xdelta3_pure_py.apply_vcdiff() against
+# apply_vcdiff_copy_range() (which hands long source COPYs to
+# os.copy_file_range()), file to file, on a synthetic patch whose target
+# is mostly the source unchanged or shifted -- which is what Newer DS's
+# patch mostly does to the NSMB ROM.
+#
+# The page cache is left warm, so this measures CPU and memory-copying
+# costs rather than the disk.
+
+
+def make_mostly_unchanged_windows(source: bytes, seed: int, window_size: int,
+        edit_size: int = 0x1000, edit_interval: int = 0x40000) -> List[List[synthetic.Op]]:
+    """
+    Make per-window edit operations describing a target that's the
+    source with a small edit (new data, and a shift) every edit_interval
+    bytes or so
+    """
+    rng = random.Random(seed)
+    windows = []
+
+    src_pos = 0
+    while src_pos < len(source):
+        ops = []
+        done = 0
+        while done < window_size and src_pos < len(source):
+            size = min(rng.randrange(edit_interval // 2, edit_interval * 3 // 2),
+                window_size - done, len(source) - src_pos)
+            ops.append(('src', src_pos, size))
+            done += size
+            src_pos += size
+
+            edit = min(rng.randrange(1, edit_size), window_size - done)
+            if edit:
+                ops.append(('add', rng.randbytes(edit)))
+                done += edit
+                # Insert or replace
+                if rng.random() < 0.5:
+                    src_pos += edit
+        windows.append(ops)
+
+    return windows
+
+
+def run_normal(src_fp: Path, patch: bytes, out_fp: Path) -> None:
+    with src_fp.open('rb') as src, out_fp.open('wb') as out:
+        xdelta3_pure_py.apply_vcdiff(src, patch, out)
+
+
+def run_copy_range(src_fp: Path, patch: bytes, out_fp: Path) -> int:
+    with src_fp.open('rb') as src, out_fp.open('wb') as out:
+        return xdelta3_pure_py.apply_vcdiff_copy_range(src, patch, out)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the copy_file_range() VCDIFF decoder on a mostly-unchanged target.')
+    parser.add_argument('--size', type=int, default=32,
+        help='size of the synthetic ROM, in MiB (default: 32)')
+    parser.add_argument('--window-size', type=int, default=8192,
+        help='VCDIFF window size, in KiB (default: 8192)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of runs per mode; the best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=Path,
+        help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    if not xdelta3_pure_py.HAVE_COPY_RANGE:
+        print('os.copy_file_range() is not available on this platform', file=sys.stderr)
+        return 1
+
+    source = synthetic.make_source(args.size * 0x100000, args.seed)
+    windows = make_mostly_unchanged_windows(source, args.seed + 1, args.window_size * 0x400)
+    patch, target = synthetic.encode_vcdiff(source, windows)
+    expected_md5 = hashlib.md5(target).hexdigest()
+    target_mib = len(target) / 0x100000
+    del target
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        src_fp = Path(temp_dir) / 'source.bin'
+        out_fp = Path(temp_dir) / 'out.bin'
+        src_fp.write_bytes(source)
+        del source
+
+        for mode, func in [('normal', run_normal), ('copy_range', run_copy_range)]:
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                copied = func(src_fp, patch, out_fp)
+                times.append(time.perf_counter() - start)
+                if hashlib.md5(out_fp.read_bytes()).hexdigest() != expected_md5:
+                    print(f'{mode}: WRONG OUTPUT', file=sys.stderr)
+                    return 1
+
+            result = {
+                'mode': mode,
+                'patchSize': len(patch),
+                'targetSize': round(target_mib * 0x100000),
+                'seconds': min(times),
+                'mibPerSecond': target_mib / min(times),
+            }
+            if copied is not None:
+                result['kernelCopiedBytes'] = copied
+            results.append(result)
+
+            print(f'{mode:10s} {min(times):8.3f}s  ({target_mib / min(times):7.1f} MiB/s)'
+                + (f'  {copied / 0x100000:.1f} MiB copied by the OS' if copied is not None else ''))
+
+    print(f'({os.cpu_count()} CPU(s) available)')
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=4) + '\n', encoding='utf-8')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
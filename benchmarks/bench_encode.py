@@ -0,0 +1,141 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import hashlib
+import io
+import json
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import synthetic
+import xdelta3_pure_py
+
+
+# Compares xdelta3_pure_py.encode_vcdiff() against a native xdelta3
+# program on the PATH (if there is one), on synthetic ROM pairs: encoding
+# throughput and patch size, with and without LZMA secondary
+# compression. Every patch is decoded again with xdelta3_pure_py to make
+# sure it's correct.
+
+
+def encode_pure_py(src_fp: Path, target_fp: Path, patch_fp: Path, use_lzma: bool) -> None:
+    with src_fp.open('rb') as src, target_fp.open('rb') as target, patch_fp.open('wb') as out:
+        xdelta3_pure_py.encode_vcdiff(src, target, out,
+            secondary=xdelta3_pure_py.VCD_COMPRESSION_LZMA if use_lzma else None)
+
+
+def encode_cli(src_fp: Path, target_fp: Path, patch_fp: Path, use_lzma: bool) -> None:
+    subprocess.run(['xdelta3', '-e', '-f', '-S', 'lzma' if use_lzma else 'none',
+        '-s', str(src_fp), str(target_fp), str(patch_fp)], check=True)
+
+
+ENCODERS = {
+    'pure_py': encode_pure_py,
+    'cli': encode_cli,
+}
+
+
+def check_patch(source: bytes, patch_fp: Path, expected_md5: str) -> bool:
+    out = io.BytesIO()
+    try:
+        xdelta3_pure_py.apply_vcdiff(source, patch_fp.read_bytes(), out)
+    except Exception:
+        return False
+    return hashlib.md5(out.getbuffer()).hexdigest() == expected_md5
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pure-Python VCDIFF encoder against native xdelta3.')
+    parser.add_argument('--sizes', default='8',
+        help='comma-separated synthetic ROM sizes, in MiB (default: 8)')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='number of runs per encoder; the best is reported (default: 1)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=Path,
+        help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    encoders = ['pure_py']
+    if shutil.which('xdelta3') is not None:
+        encoders.append('cli')
+    else:
+        print('(xdelta3 not found on the PATH; only benchmarking the pure-Python encoder)')
+
+    results = []
+    failed = False
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        src_fp = temp_dir / 'source.nds'
+        target_fp = temp_dir / 'target.nds'
+        patch_fp = temp_dir / 'patch.xdelta'
+
+        for size in [int(s) for s in args.sizes.split(',')]:
+            source, _, target = synthetic.make_pair(size * 0x100000, args.seed, edit_mix='rom_like')
+            src_fp.write_bytes(source)
+            target_fp.write_bytes(target)
+            expected_md5 = hashlib.md5(target).hexdigest()
+            del target
+
+            for use_lzma in [False, True]:
+                case = f'{size}MiB-{"lzma" if use_lzma else "plain"}'
+
+                for encoder in encoders:
+                    seconds = None
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        ENCODERS[encoder](src_fp, target_fp, patch_fp, use_lzma)
+                        elapsed = time.perf_counter() - start
+                        if seconds is None or elapsed < seconds:
+                            seconds = elapsed
+
+                    correct = check_patch(source, patch_fp, expected_md5)
+                    failed |= not correct
+                    patch_size = patch_fp.stat().st_size
+
+                    results.append({
+                        'encoder': encoder,
+                        'case': case,
+                        'seconds': seconds,
+                        'patchSize': patch_size,
+                        'correct': correct,
+                    })
+                    print(f'{case:14s} {encoder:8s} {seconds:8.3f}s'
+                        f'  ({size / seconds:6.2f} MiB/s)  {patch_size:10d} bytes'
+                        f'{"" if correct else "  WRONG OUTPUT"}', flush=True)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=4) + '\n', encoding='utf-8')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,116 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import synthetic
+import xdelta3_pure_py
+
+
+# Compares xdelta3_pure_py.apply_vcdiff() (sequential) against
+# apply_vcdiff_pipelined(), on synthetic patches with and without LZMA
+# secondary compression. Both modes write to a real file and compute the
+# MD5 of the output, since that's what the wizard does with them.
+
+
+def run_sequential(source: bytes, patch: bytes, out_fp: Path) -> str:
+    with out_fp.open('w+b') as out:
+        xdelta3_pure_py.apply_vcdiff(source, patch, out)
+        out.seek(0)
+        return hashlib.md5(out.read()).hexdigest()
+
+
+def run_pipelined(source: bytes, patch: bytes, out_fp: Path) -> str:
+    output_hash = hashlib.md5()
+    with out_fp.open('wb') as out:
+        xdelta3_pure_py.apply_vcdiff_pipelined(source, patch, out, output_hash=output_hash)
+    return output_hash.hexdigest()
+
+
+MODES = {
+    'sequential': run_sequential,
+    'pipelined': run_pipelined,
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sequential and pipelined pure-Python VCDIFF decoders.')
+    parser.add_argument('--size', type=int, default=16,
+        help='size of the synthetic ROMs, in MiB (default: 16)')
+    parser.add_argument('--window-size', type=int, default=512,
+        help='VCDIFF window size, in KiB (default: 512)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of runs per mode; the best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=Path,
+        help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        out_fp = Path(temp_dir) / 'out.bin'
+
+        for use_lzma in [False, True]:
+            source, patch, target = synthetic.make_pair(
+                args.size * 0x100000, args.seed, args.window_size * 0x400, use_lzma)
+            expected_md5 = hashlib.md5(target).hexdigest()
+            label = 'lzma' if use_lzma else 'plain'
+
+            for mode, func in MODES.items():
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    md5 = func(source, patch, out_fp)
+                    times.append(time.perf_counter() - start)
+                    if md5 != expected_md5:
+                        print(f'{label}/{mode}: WRONG OUTPUT', file=sys.stderr)
+                        return 1
+
+                results.append({
+                    'patch': label,
+                    'mode': mode,
+                    'patchSize': len(patch),
+                    'seconds': min(times),
+                })
+                print(f'{label:6s} {mode:11s} {min(times):8.3f}s'
+                    f'  ({args.size / min(times):.1f} MiB/s)')
+
+    print(f'({os.cpu_count()} CPU(s) available)')
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=4) + '\n', encoding='utf-8')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
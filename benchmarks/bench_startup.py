@@ -0,0 +1,159 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+from typing import Optional
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+# Startup-time benchmark, with a budget:
+#
+# - Import time of patch_core (which the patch service and command-line
+#   tools use) and patch_wizard (which also loads Qt), according to
+#   "python -X importtime"
+# - Time from launching the wizard's process to its window having been
+#   shown and the first event loop iteration having run
+#
+# Each is measured in fresh processes, and the best of several runs is
+# reported.
+
+
+# Runs in the child process. The data files are checked first, since
+# create_wizard() would otherwise show a (blocking) error message box.
+FIRST_WINDOW_SCRIPT = """
+import sys
+from pathlib import Path
+import patch_core
+patch_core.load_data(Path('data'))
+if not patch_core.have_required_files():
+    sys.exit('The data folder is incomplete')
+import patch_wizard
+from PyQt5 import QtCore
+app = patch_wizard.create_application()
+wizard = patch_wizard.create_wizard(Path('data'))
+wizard.show()
+QtCore.QTimer.singleShot(0, app.quit)
+app.exec_()
+print('shown', flush=True)
+"""
+
+
+def measure_import_time(module: str) -> Optional[float]:
+    """
+    Return the cumulative import time of a module in a fresh
+    interpreter, in milliseconds, or None if it couldn't be imported
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        return None
+
+    # Lines look like "import time:  self [us] | cumulative | name"
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].rstrip() == f' {module}':
+            return int(parts[1]) / 1000
+
+    return None
+
+
+def measure_first_window(env: dict) -> Optional[float]:
+    """
+    Return the time from launching the wizard to its window being shown,
+    in milliseconds, or None if it failed
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', FIRST_WINDOW_SCRIPT],
+        cwd=ROOT_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    end = time.perf_counter()
+
+    if proc.returncode != 0 or 'shown' not in proc.stdout:
+        print(proc.stderr.strip(), file=sys.stderr)
+        return None
+
+    return (end - start) * 1000
+
+
+def best_of(func, repeat: int, *args) -> Optional[float]:
+    results = [func(*args) for _ in range(repeat)]
+    if None in results:
+        return None
+    return min(results)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Measure how long the patch wizard takes to start up.')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of runs per measurement; the best is reported (default: 5)')
+    parser.add_argument('--core-budget', type=float, default=100,
+        help='import time budget for patch_core, in ms (default: 100)')
+    parser.add_argument('--wizard-budget', type=float, default=400,
+        help='import time budget for patch_wizard, in ms (default: 400)')
+    parser.add_argument('--window-budget', type=float, default=1500,
+        help='time-to-first-window budget, in ms (default: 1500)')
+    parser.add_argument('--offscreen', action='store_true',
+        help="use Qt's offscreen platform plugin (for machines without a display)")
+    parser.add_argument('--json', type=Path,
+        help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    if args.offscreen:
+        env['QT_QPA_PLATFORM'] = 'offscreen'
+
+    results = {
+        'patchCoreImportMs': best_of(measure_import_time, args.repeat, 'patch_core'),
+        'patchWizardImportMs': best_of(measure_import_time, args.repeat, 'patch_wizard'),
+        'firstWindowMs': best_of(measure_first_window, args.repeat, env),
+    }
+    budgets = {
+        'patchCoreImportMs': args.core_budget,
+        'patchWizardImportMs': args.wizard_budget,
+        'firstWindowMs': args.window_budget,
+    }
+
+    failed = False
+    for key, value in results.items():
+        if value is None:
+            print(f'{key:22s}   (failed)')
+            failed = True
+        else:
+            over = value > budgets[key]
+            failed |= over
+            print(f'{key:22s} {value:8.1f}  (budget {budgets[key]:.0f}){"  OVER BUDGET" if over else ""}')
+
+    if args.json is not None:
+        args.json.write_text(json.dumps({'results': results, 'budgets': budgets}, indent=4) + '\n',
+            encoding='utf-8')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
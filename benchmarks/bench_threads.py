@@ -0,0 +1,137 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import synthetic
+import xdelta3_pure_py
+
+
+# Measures how xdelta3_pure_py.apply_vcdiff_threaded() scales with the
+# number of threads, compared to plain apply_vcdiff(), on a synthetic
+# patch with many windows.
+#
+# Threads only help on a free-threaded ("no-GIL") Python build, so run
+# this with e.g. python3.13t to see any scaling. On a normal build, it
+# shows the overhead of the threaded mode instead.
+
+
+def run_normal(source: bytes, patch: bytes, threads: int) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.apply_vcdiff(source, patch, out)
+    return out.getvalue()
+
+
+def run_threaded(source: bytes, patch: bytes, threads: int) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.apply_vcdiff_threaded(source, patch, out, max_workers=threads)
+    return out.getvalue()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark how threaded VCDIFF decoding scales with the number of threads.')
+    parser.add_argument('--size', type=int, default=32,
+        help='size of the synthetic ROM, in MiB (default: 32)')
+    parser.add_argument('--window-size', type=int, default=512,
+        help='VCDIFF window size, in KiB (default: 512)')
+    parser.add_argument('--threads', default=None,
+        help='comma-separated thread counts to try (default: powers of 2, up to the CPU count)')
+    parser.add_argument('--lzma', action='store_true',
+        help='use LZMA secondary compression in the patch')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of runs per thread count; the best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=Path,
+        help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    cpu_count = os.cpu_count() or 1
+    if args.threads is None:
+        thread_counts = [1]
+        while thread_counts[-1] * 2 <= cpu_count:
+            thread_counts.append(thread_counts[-1] * 2)
+    else:
+        thread_counts = [int(t) for t in args.threads.split(',')]
+
+    free_threaded = xdelta3_pure_py.is_free_threaded()
+    print(f'Python {platform.python_version()}, {cpu_count} CPU(s),'
+        f' {"free-threaded (GIL disabled)" if free_threaded else "GIL enabled"}')
+
+    source, patch, target = synthetic.make_pair(args.size * 0x100000, args.seed,
+        args.window_size * 0x400, args.lzma, 'rom_like')
+    expected_md5 = hashlib.md5(target).hexdigest()
+    target_mib = len(target) / 0x100000
+    del target
+
+    runs = [('normal', run_normal, 1)] + [('threaded', run_threaded, t) for t in thread_counts]
+    results = []
+    baseline = None
+
+    for mode, func, threads in runs:
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            output = func(source, patch, threads)
+            times.append(time.perf_counter() - start)
+            if hashlib.md5(output).hexdigest() != expected_md5:
+                print(f'{mode} ({threads} threads): WRONG OUTPUT', file=sys.stderr)
+                return 1
+            del output
+
+        seconds = min(times)
+        if baseline is None:
+            baseline = seconds
+        results.append({
+            'mode': mode,
+            'threads': threads,
+            'seconds': seconds,
+            'mibPerSecond': target_mib / seconds,
+            'speedup': baseline / seconds,
+        })
+        print(f'{mode:8s} {threads:3d} thread(s) {seconds:8.3f}s  ({target_mib / seconds:7.1f} MiB/s,'
+            f' x{baseline / seconds:.2f})')
+
+    if args.json is not None:
+        report = {
+            'python': platform.python_version(),
+            'freeThreaded': free_threaded,
+            'cpuCount': cpu_count,
+            'patchSize': len(patch),
+            'results': results,
+        }
+        args.json.write_text(json.dumps(report, indent=4) + '\n', encoding='utf-8')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,172 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+from pathlib import Path
+import random
+import sys
+from typing import List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import xdelta3_pure_py
+
+
+# Reproducible synthetic (source, target, patch) triples for the
+# benchmarks, so that they don't depend on having a real NSMB ROM and
+# the real Newer DS patches around.
+#
+# The source looks vaguely like a ROM (incompressible regions, repetitive
+# "code", and padding), and the target is built from it by a list of
+# edit operations per window, which are then encoded with
+# xdelta3_pure_py.VCDIFFWriter (with xdelta3's Adler-32 extension, and
+# optionally LZMA secondary compression). Decoding the patch must give
+# back exactly the target.
+
+
+# Edit operations:
+# ('src', addr, size): copy from the source
+# ('tgt', addr, size): copy from earlier in the same target window
+#     (addr is relative to the start of the window)
+# ('add', data)
+# ('run', byte, size)
+Op = tuple
+
+# Size ranges (for random.randrange()) of the 'src' copies and 'add's in
+# each edit mix. "default" is what the benchmarks were first written
+# against, so it's kept as is to keep their inputs the same; "rom_like"
+# has shorter copies and longer adds, which gives patches closer in size
+# to the real ones.
+EDIT_MIXES = {
+    'default': {'src': (0x20, 0x2000), 'add': (1, 0x200)},
+    'rom_like': {'src': (0x8, 0x800), 'add': (1, 0x800)},
+}
+
+
+def build_window_target(source: bytes, ops: List[Op]) -> bytes:
+    """Return the data a window's edit operations produce"""
+    target = bytearray()
+    for op in ops:
+        if op[0] == 'add':
+            target += op[1]
+        elif op[0] == 'run':
+            target += bytes([op[1]]) * op[2]
+        elif op[0] == 'src':
+            target += source[op[1] : op[1] + op[2]]
+        else:  # 'tgt'
+            _, addr, size = op
+            for i in range(size):  # (may overlap)
+                target.append(target[addr + i])
+    return bytes(target)
+
+
+def encode_vcdiff(source: bytes, windows: List[List[Op]], use_lzma: bool = False) -> Tuple[bytes, bytes]:
+    """
+    Encode a VCDIFF patch with one window per op list. Returns (patch,
+    target).
+    """
+    patch = io.BytesIO()
+    writer = xdelta3_pure_py.VCDIFFWriter(patch,
+        secondary=xdelta3_pure_py.VCD_COMPRESSION_LZMA if use_lzma else None)
+
+    target = bytearray()
+    for ops in windows:
+        window_start = len(target)
+        window_target = build_window_target(source, ops)
+        # (The writer wants absolute target addresses)
+        ops = [('tgt', window_start + op[1], op[2]) if op[0] == 'tgt' else op for op in ops]
+        writer.write_window(ops, window_start, window_target)
+        target += window_target
+
+    return patch.getvalue(), bytes(target)
+
+
+def make_source(size: int, seed: int) -> bytes:
+    """
+    Make a ROM-like source file: a mix of random data, repetitive
+    "code", and 0x00/0xFF padding
+    """
+    rng = random.Random(seed)
+    out = bytearray()
+
+    while len(out) < size:
+        kind = rng.random()
+        length = rng.randrange(0x400, 0x10000)
+        if kind < 0.4:
+            out += rng.randbytes(length)
+        elif kind < 0.85:
+            words = [rng.randbytes(4) for _ in range(16)]
+            out += b''.join(rng.choice(words) for _ in range(length // 4))
+        else:
+            out += bytes([rng.choice([0, 0xFF])]) * length
+
+    return bytes(out[:size])
+
+
+def make_windows(source: bytes, target_size: int, seed: int,
+        window_size: int = 0x80000, edit_mix: str = 'default') -> List[List[Op]]:
+    """
+    Make per-window edit operations describing a target that's mostly
+    the source (shifted around a bit), with some new data mixed in
+    (see EDIT_MIXES)
+    """
+    src_sizes, add_sizes = EDIT_MIXES[edit_mix]['src'], EDIT_MIXES[edit_mix]['add']
+    rng = random.Random(seed)
+    windows = []
+
+    pos = 0
+    while pos < target_size:
+        this_window_size = min(window_size, target_size - pos)
+        ops = []
+        done = 0
+        while done < this_window_size:
+            remaining = this_window_size - done
+            kind = rng.random()
+            if kind < 0.6:
+                size = min(rng.randrange(*src_sizes), remaining)
+                # Roughly where this part of the target "came from"
+                center = min(max(pos + done + rng.randrange(-0x1000, 0x1000), 0), len(source) - size)
+                ops.append(('src', center, size))
+            elif kind < 0.8 or done == 0:
+                size = min(rng.randrange(*add_sizes), remaining)
+                ops.append(('add', rng.randbytes(size)))
+            elif kind < 0.9:
+                size = min(rng.randrange(4, 0x400), remaining)
+                ops.append(('run', rng.choice([0, 0xFF, rng.randrange(256)]), size))
+            else:
+                size = min(rng.randrange(4, 0x200), remaining)
+                ops.append(('tgt', rng.randrange(done), size))
+            done += size
+        windows.append(ops)
+        pos += this_window_size
+
+    return windows
+
+
+def make_pair(size: int = 0x800000, seed: int = 0, window_size: int = 0x80000,
+        use_lzma: bool = False, edit_mix: str = 'default') -> Tuple[bytes, bytes, bytes]:
+    """
+    Make a reproducible (source, patch, target) triple
+    """
+    source = make_source(size, seed)
+    windows = make_windows(source, size, seed + 1, window_size, edit_mix)
+    patch, target = encode_vcdiff(source, windows, use_lzma)
+    return source, patch, target
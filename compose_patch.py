@@ -0,0 +1,290 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import bisect
+import io
+from pathlib import Path
+import sys
+from typing import Iterator, List, Optional, Tuple
+import zlib
+
+import optimize_patch
+import xdelta3_pure_py
+from xdelta3_pure_py import BytesLike, EditOp
+
+
+# Offline tool that composes a chain of xdelta3 patches (A -> B, B -> C,
+# ...) into one equivalent patch (A -> C), working on their decoded
+# instruction streams. The intermediate files aren't needed for that.
+#
+# Every intermediate file is described by a PieceMap instead: which
+# parts of it are copies of A, and which are literal data (from ADDs and
+# RUNs). Its patch's target copies are resolved through the map as it's
+# built. The next patch's source copies can then be mapped through it to
+# pieces of A or literal data, and so on. The last patch's target copies
+# are kept as they are, since they refer to the final output.
+#
+# The composed instructions are checked against the last patch's Adler-32
+# checksums, which only needs A, and then re-encoded the same way
+# optimize_patch.py does it. Finally, the new patch is checked against
+# applying the chain one patch at a time, the ordinary way (which does
+# build the intermediate files, in memory).
+
+
+class PieceMap:
+    """
+    Describes a file that's never materialized, as consecutive pieces:
+    ('src', position in A), ('add', data, offset into data) or
+    ('run', byte)
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.pieces = []
+
+    @property
+    def size(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    def append(self, size: int, piece: tuple) -> None:
+        """Append a piece, merging it into the previous one if possible"""
+        if not size:
+            return
+        if self.pieces:
+            prev = self.pieces[-1]
+            prev_size = self.ends[-1] - self.starts[-1]
+            if prev[0] == piece[0] and (
+                    (piece[0] == 'src' and prev[1] + prev_size == piece[1])
+                    or (piece[0] == 'add' and prev[1] is piece[1] and prev[2] + prev_size == piece[2])
+                    or (piece[0] == 'run' and prev[1] == piece[1])):
+                self.ends[-1] += size
+                return
+        self.starts.append(self.size)
+        self.ends.append(self.size + size)
+        self.pieces.append(piece)
+
+    def iter_pieces(self, pos: int, size: int) -> Iterator[Tuple[int, tuple]]:
+        """Yield (size, piece) for consecutive pieces of a range"""
+        if pos + size > self.size:
+            raise ValueError('Patch reads past the end of its source')
+        i = bisect.bisect_right(self.starts, pos) - 1
+        while size:
+            n = min(size, self.ends[i] - pos)
+            piece = self.pieces[i]
+            offset = pos - self.starts[i]
+            if piece[0] == 'src':
+                piece = ('src', piece[1] + offset)
+            elif piece[0] == 'add':
+                piece = ('add', piece[1], piece[2] + offset)
+            yield n, piece
+            pos += n
+            size -= n
+            i += 1
+
+    def append_op(self, op: EditOp, source: Optional['PieceMap']) -> None:
+        """
+        Append the data an edit operation produces. Source copies are
+        mapped through source (the map of the patch's own source file),
+        or taken to be copies of A if that's None.
+        """
+        if op[0] == 'add':
+            self.append(len(op[1]), ('add', op[1], 0))
+        elif op[0] == 'run':
+            self.append(op[2], ('run', op[1]))
+        elif op[0] == 'src':
+            if source is None:
+                self.append(op[2], ('src', op[1]))
+            else:
+                for n, piece in source.iter_pieces(op[1], op[2]):
+                    self.append(n, piece)
+        else:
+            _, pos, size = op
+            # (This may overlap the data being produced, in which case
+            # it repeats with a period of (current size - pos). Copying
+            # from the start of the period each time lets each chunk be
+            # twice as long as the last.)
+            period = self.size - pos
+            if period <= 0:
+                raise ValueError('Target copy reads from after its own position')
+            done = 0
+            while done < size:
+                chunk_pos = pos + done % period
+                n = min(size - done, self.size - chunk_pos)
+                for m, piece in list(self.iter_pieces(chunk_pos, n)):
+                    self.append(m, piece)
+                done += n
+
+
+def piece_to_op(size: int, piece: tuple) -> EditOp:
+    if piece[0] == 'src':
+        return ('src', piece[1], size)
+    elif piece[0] == 'add':
+        return ('add', piece[1][piece[2] : piece[2] + size])
+    return ('run', piece[1], size)
+
+
+def read_patch_ops(patch: BytesLike) -> Tuple[List[EditOp], List[Tuple[int, int, Optional[int]]], Optional[bytes], bool]:
+    """
+    Decode a patch's instructions (without applying it) into a flat list
+    of edit operations with absolute positions. Also returns (start,
+    length, expected Adler-32 or None) for each window, the appheader,
+    and whether the patch used LZMA secondary compression.
+    """
+    diff = xdelta3_pure_py.as_binary_io(patch)
+    code_table, decompressors, appheader = xdelta3_pure_py.read_vcdiff_header(diff)
+    uses_lzma = isinstance(decompressors.adds_runs, xdelta3_pure_py.XdeltaLZMADecompressor)
+
+    ops = []
+    windows = []
+    target_pos = 0
+    while diff.tell() < len(patch):
+        window = xdelta3_pure_py.read_vcdiff_window(diff)
+        window.decompress(decompressors)
+        ops.extend(optimize_patch.iter_window_ops(window, code_table, target_pos))
+        windows.append((target_pos, window.target_window_len, window.expected_adler))
+        target_pos += window.target_window_len
+
+    return ops, windows, appheader, uses_lzma
+
+
+def build_target(source: BytesLike, ops: List[EditOp]) -> bytearray:
+    """Return the data a list of edit operations produces"""
+    target = bytearray()
+    for op in ops:
+        if op[0] == 'add':
+            target += op[1]
+        elif op[0] == 'run':
+            target += bytes([op[1]]) * op[2]
+        elif op[0] == 'src':
+            if op[1] + op[2] > len(source):
+                raise ValueError('Patch reads past the end of its source')
+            target += source[op[1] : op[1] + op[2]]
+        else:
+            _, pos, size = op
+            while size:  # (may overlap; see PieceMap.append_op())
+                n = min(size, len(target) - pos)
+                target += target[pos : pos + n]
+                pos += n
+                size -= n
+    return target
+
+
+def compose_patches(source: bytes, patches: List[BytesLike],
+        window_size: int = optimize_patch.DEFAULT_WINDOW_SIZE,
+        use_lzma: Optional[bool] = None) -> Tuple[bytes, bytes, dict]:
+    """
+    Compose a chain of patches (the first one applies to source) into a
+    single one. use_lzma=None keeps the last patch's setting. Returns
+    (new patch, target, instruction counts). Raises ValueError if the
+    result doesn't match the last patch's checksums, or
+    optimize_patch.PatchMismatch if it doesn't give the same output as
+    applying the patches one at a time.
+    """
+    pieces = None
+    for patch in patches[:-1]:
+        ops, _, _, _ = read_patch_ops(patch)
+        new_pieces = PieceMap()
+        for op in ops:
+            new_pieces.append_op(op, pieces)
+        pieces = new_pieces
+
+    ops, windows, appheader, last_lzma = read_patch_ops(patches[-1])
+    if use_lzma is None:
+        use_lzma = last_lzma
+
+    composed = []
+    for op in ops:
+        if op[0] == 'src' and pieces is not None:
+            composed.extend(piece_to_op(n, piece) for n, piece in pieces.iter_pieces(op[1], op[2]))
+        else:
+            composed.append(op)
+
+    target = build_target(source, composed)
+    for start, length, expected_adler in windows:
+        if expected_adler is not None and zlib.adler32(memoryview(target)[start : start + length]) != expected_adler:
+            raise ValueError('The composed patch has the wrong checksum -- is this the right source file,'
+                ' and are the patches in the right order?')
+
+    new_patch, counts = optimize_patch.encode_ops(composed, target, window_size, use_lzma, appheader)
+
+    expected = apply_chain(source, patches)
+    if target != expected:
+        raise optimize_patch.PatchMismatch('The composed patch gives different output')
+    optimize_patch.verify_patch(source, new_patch, expected)
+
+    return new_patch, bytes(target), counts
+
+
+def apply_chain(source: bytes, patches: List[BytesLike]) -> bytes:
+    """Apply a chain of patches one at a time, and return the output"""
+    data = source
+    for patch in patches:
+        out = io.BytesIO()
+        xdelta3_pure_py.apply_vcdiff(data, patch, out)
+        data = out.getvalue()
+    return data
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Compose a chain of xdelta3 patches (A -> B, B -> C, ...) into a single '
+        'equivalent patch (A -> C), without building the intermediate files.')
+    parser.add_argument('source', type=Path,
+        help='the file the first patch applies to')
+    parser.add_argument('patches', type=Path, nargs='+',
+        help='the patches, in the order they would be applied')
+    parser.add_argument('-o', '--output', type=Path, required=True,
+        help='where to save the composed patch')
+    parser.add_argument('--window-size', type=int, default=optimize_patch.DEFAULT_WINDOW_SIZE // 0x400,
+        help=f'target window size, in KiB (default: {optimize_patch.DEFAULT_WINDOW_SIZE // 0x400};'
+        f' max: {optimize_patch.MAX_WINDOW_SIZE // 0x400})')
+    parser.add_argument('--lzma', dest='lzma', action='store_const', const=True,
+        help='use LZMA secondary compression (default: same as the last patch)')
+    parser.add_argument('--no-lzma', dest='lzma', action='store_const', const=False,
+        help="don't use LZMA secondary compression")
+    args = parser.parse_args(argv)
+
+    if len(args.patches) < 2:
+        parser.error('at least two patches are needed')
+    window_size = args.window_size * 0x400
+    if not 0 < window_size <= optimize_patch.MAX_WINDOW_SIZE:
+        parser.error(f'the window size must be between 1 and {optimize_patch.MAX_WINDOW_SIZE // 0x400} KiB')
+
+    source = args.source.read_bytes()
+    patches = [fp.read_bytes() for fp in args.patches]
+
+    try:
+        new_patch, target, counts = compose_patches(source, patches, window_size, args.lzma)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    print(f'{len(patches)} patches ({sum(map(len, patches))} bytes) -> {len(new_patch)} bytes,'
+        f' {counts["windows"]} windows, {counts["add"]} ADDs, {counts["run"]} RUNs, {counts["copy"]} COPYs')
+
+    args.output.write_bytes(new_patch)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,320 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import multi_hash
+import patch_core
+import telemetry
+
+
+# Applies several patches (a release patch, betas, region variants...)
+# to the same ROM, loading and hashing the ROM only once. Mainly for QA,
+# where calling patch_core.patch_rom() once per patch would re-read,
+# re-hash and re-copy the ROM every time.
+#
+# The normalized ROM (see patch_core.NormalizedRom) is read into an
+# anonymous memory map, and hashed while it's being read. Every patch
+# then reads from that same map without copying it, and streams its
+# output to its own file.
+#
+# Patches run concurrently in a thread pool if the backend can actually
+# make use of that -- the xdelta3 module, or xdelta3.exe (which runs as
+# separate processes). The pure-Python backend holds the GIL, so it only
+# gets one thread, unless this is a free-threaded Python build.
+#
+# Each patch gets a result dict, with:
+#
+# - "name": the job's name (by default, the output filename)
+# - "output": the output filepath
+# - "backend": the backend that applied the patch
+# - "failedBackends": [backend, error] for each backend that failed
+#   before it (like patch_core.do_xdelta(), a failed backend falls back
+#   to the pure-Python one)
+# - "seconds": how long the patch took, including writing and hashing
+#   its output
+# - "outputBytes", "md5": the output's size and MD5
+# - "ok": False if it failed (then "error" says why)
+
+
+class Job:
+    """
+    One patch to apply, and where to save its output. If expected_md5 is
+    given, the output is checked against it.
+    """
+    patch: patch_core.BytesLike
+    out_filepath: Path
+    expected_md5: Optional[str]
+    name: str
+
+    def __init__(self, patch: patch_core.BytesLike, out_filepath: Path,
+            expected_md5: Optional[str] = None, name: Optional[str] = None):
+        self.patch = patch
+        self.out_filepath = out_filepath
+        self.expected_md5 = expected_md5
+        self.name = out_filepath.name if name is None else name
+
+
+def get_backend() -> str:
+    """
+    Choose the backend, in the same order of preference as
+    patch_core.do_xdelta(): "module", "exe" or "pure_py"
+    """
+    if patch_core.get_xdelta3_module() is not None:
+        return 'module'
+    if (patch_core.DataDir / 'xdelta3.exe').is_file() and (
+            sys.platform == 'win32' or shutil.which('wine') is not None):
+        return 'exe'
+    return 'pure_py'
+
+
+def get_default_max_workers(backend: str, num_jobs: int) -> int:
+    """Return how many patches it's worth running at once"""
+    import xdelta3_pure_py
+    if backend == 'pure_py' and not xdelta3_pure_py.is_free_threaded():
+        return 1
+    return max(1, min(num_jobs, os.cpu_count() or 1))
+
+
+def load_source(fn: Path, names: Iterable[str] = ('md5',)) -> Tuple[mmap.mmap, Dict[str, 'hashlib._Hash']]:
+    """
+    Read a ROM, normalized, into an anonymous memory map, computing any
+    set of digests (see multi_hash) of it at the same time. Returns the
+    map and a dict of hash objects by name.
+    """
+    with patch_core.NormalizedRom(fn) as rom:
+        used_size, size = rom.used_size, rom.size
+
+    source = mmap.mmap(-1, size)
+
+    def iter_loaded_blocks() -> Iterator[memoryview]:
+        with memoryview(source) as view, fn.open('rb', buffering=0) as f:
+            pos = 0
+            while pos < used_size:
+                block = view[pos : min(pos + multi_hash.DEFAULT_BLOCK_SIZE, used_size)]
+                n = f.readinto(block)
+                if not n:
+                    raise ValueError('ROM file is truncated')
+                yield block[:n]
+                pos += n
+
+            padding = patch_core.NormalizedRom.PADDING_BLOCK
+            while pos < size:
+                n = min(len(padding), size - pos)
+                view[pos : pos + n] = padding[:n]
+                yield view[pos : pos + n]
+                pos += n
+
+    return source, multi_hash.hash_blocks(iter_loaded_blocks(), names)
+
+
+def write_base_file(source: patch_core.BytesLike) -> Path:
+    """
+    Save the source to a temporary file for xdelta3.exe, which all of the
+    patches can share
+    """
+    base_fp = patch_core.get_temp_filepaths()[0]
+    base_fp.write_bytes(source)
+    return base_fp
+
+
+def run_exe(base_fp: Path, patch: patch_core.BytesLike, out_filepath: Path) -> None:
+    """
+    Apply a patch with xdelta3.exe, given the (already saved) base file,
+    and move its output to out_filepath
+    """
+    _, temp_patch_fp, temp_out_fp = patch_core.get_temp_filepaths()
+    temp_patch_fp.write_bytes(patch)
+    try:
+        command = patch_core.get_xdelta3_exe_command(base_fp, temp_patch_fp, temp_out_fp)
+        if sys.platform == 'win32':
+            subprocess.run(command, shell=True, cwd=patch_core.DataDir, check=True)
+        else:
+            # gulp
+            subprocess.run(['wine', *command], cwd=patch_core.DataDir, check=True)
+        shutil.move(temp_out_fp, out_filepath)
+    finally:
+        temp_patch_fp.unlink()
+        try:
+            temp_out_fp.unlink()
+        except Exception:
+            pass
+
+
+def run_backend(job: Job, source: patch_core.BytesLike, backend: str, base_fp: Optional[Path],
+        result: dict) -> None:
+    """
+    Apply one patch with the given backend, and fill in the
+    "outputBytes" and "md5" of its result dict
+    """
+    if backend == 'module':
+        data = patch_core.get_xdelta3_module().decode(source, bytes(job.patch))
+        job.out_filepath.write_bytes(data)
+        result['outputBytes'] = len(data)
+        result['md5'] = hashlib.md5(data).hexdigest()
+        del data
+        return
+
+    if backend == 'exe':
+        run_exe(base_fp, job.patch, job.out_filepath)
+    else:
+        import xdelta3_pure_py
+        with job.out_filepath.open('wb') as out:
+            xdelta3_pure_py.apply_vcdiff(source, job.patch, out)
+    result['outputBytes'] = job.out_filepath.stat().st_size
+    result['md5'] = patch_core.file_md5(job.out_filepath).hexdigest()
+
+
+def run_job(job: Job, source: patch_core.BytesLike, backend: str, base_fp: Optional[Path]) -> dict:
+    """
+    Apply one patch, and return its result dict. For the xdelta3 module,
+    source must be a bytes object; for xdelta3.exe, base_fp must be the
+    file from write_base_file(). If the backend fails, the pure-Python
+    one is tried instead.
+    """
+    result = {'name': job.name, 'output': str(job.out_filepath), 'backend': backend,
+        'failedBackends': []}
+    start = time.perf_counter()
+
+    with telemetry.phase('fan_out_patch', job=job.name, patchBytes=len(job.patch)) as record:
+        try:
+            try:
+                run_backend(job, source, backend, base_fp, result)
+            except Exception as e:
+                if backend == 'pure_py':
+                    raise
+                result['failedBackends'].append([backend, repr(e)])
+                result['backend'] = 'pure_py'
+                run_backend(job, source, 'pure_py', base_fp, result)
+
+            if job.expected_md5 is not None and result['md5'] != job.expected_md5:
+                raise RuntimeError('Patched output file is incorrect')
+            result['ok'] = True
+
+        except Exception as e:
+            result['ok'] = False
+            result['error'] = f'{type(e).__name__}: {e}'
+
+        result['seconds'] = time.perf_counter() - start
+        record.update(result)
+
+    return result
+
+
+def apply_patches(in_filepath: Path, jobs: List[Job],
+        max_workers: Optional[int] = None) -> dict:
+    """
+    Apply every job's patch to the same ROM, which is loaded and hashed
+    only once. A failed patch doesn't stop the others.
+
+    Returns a dict with "sourceMd5", "backend", "workers",
+    "loadSeconds", "totalSeconds", and "results" (a result dict per job,
+    in the same order).
+    """
+    start = time.perf_counter()
+    backend = get_backend()
+    if max_workers is None:
+        max_workers = get_default_max_workers(backend, len(jobs))
+
+    with telemetry.phase('fan_out_load') as record:
+        source, hashes = load_source(in_filepath)
+        record['bytes'] = len(source)
+    source_md5 = hashes['md5'].hexdigest()
+    load_seconds = time.perf_counter() - start
+
+    base_fp = None
+    try:
+        # (The xdelta3 module only accepts bytes, so that gets one copy
+        # of the source, which all of the patches share)
+        job_source = bytes(source) if backend == 'module' else source
+        if backend == 'exe':
+            base_fp = write_base_file(source)
+
+        if max_workers == 1:
+            results = [run_job(job, job_source, backend, base_fp) for job in jobs]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='fan-out') as executor:
+                results = list(executor.map(lambda job: run_job(job, job_source, backend, base_fp), jobs))
+
+    finally:
+        if base_fp is not None:
+            base_fp.unlink()
+        source.close()
+
+    return {
+        'sourceMd5': source_md5,
+        'backend': backend,
+        'workers': max_workers,
+        'loadSeconds': load_seconds,
+        'totalSeconds': time.perf_counter() - start,
+        'results': results,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Apply several xdelta3 patches to the same ROM, loading and hashing it only once.')
+    parser.add_argument('rom', type=Path,
+        help='the ROM to patch')
+    parser.add_argument('patches', type=Path, nargs='+',
+        help='the patches to apply; each output is named after its patch')
+    parser.add_argument('-o', '--output-dir', type=Path, default=Path('.'),
+        help='where to save the outputs (default: the current folder)')
+    parser.add_argument('--workers', type=int,
+        help='how many patches to run at once (default: depends on the backend)')
+    parser.add_argument('--json', type=Path,
+        help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [Job(fp.read_bytes(), args.output_dir / (fp.stem + args.rom.suffix)) for fp in args.patches]
+
+    report = apply_patches(args.rom, jobs, args.workers)
+
+    print(f'Source {report["sourceMd5"]} loaded in {report["loadSeconds"]:.3f}s;'
+        f' backend {report["backend"]}, {report["workers"]} worker(s)')
+    for result in report['results']:
+        if result['ok']:
+            print(f'{result["name"]:30s} {result["seconds"]:8.3f}s  {result["md5"]}')
+        else:
+            print(f'{result["name"]:30s} {result["seconds"]:8.3f}s  FAILED: {result["error"]}')
+    print(f'Total: {report["totalSeconds"]:.3f}s')
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(report, indent=4) + '\n', encoding='utf-8')
+
+    return 0 if all(result['ok'] for result in report['results']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,407 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import bisect
+import hashlib
+import json
+import os
+from pathlib import Path
+import struct
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
+import zlib
+
+
+# In-place patching: overwriting a ROM file with its patched version
+# directly, instead of building the whole output in memory and then
+# writing it to a second file.
+#
+# The output is written one VCDIFF window at a time, over the same
+# offsets in the file. A window's source COPYs can then only go wrong if
+# they read something an *earlier* window has already overwritten, so
+# the patch is analyzed first to find those source ranges, and only
+# they are saved before anything is written. (ROM patches mostly copy
+# from around the same offset, so that's usually a small fraction of
+# the ROM.)
+#
+# Crash safety comes from two files next to the ROM:
+#
+# - The journal ("<rom>.journal"): the saved source ranges, plus what's
+#   needed to carry on (the source ROM's hash and sizes, and the patch's
+#   hash). It's written before the ROM is touched, and deleted once
+#   patching is complete.
+# - The window record ("<rom>.journal-window"): before each window is
+#   written to the ROM, its output is saved here first. After a crash,
+#   the window in this record may be half-written to the ROM, but every
+#   window before it is complete -- so it's written again, and patching
+#   continues with the next one.
+#
+# Both are replaced atomically (written to a temporary file, fsynced and
+# renamed), so they're always either the old version or the new one.
+#
+# Both files share a layout: a magic, a u32 length of a JSON header, the
+# JSON header, binary data, and an MD5 of everything before it.
+
+
+JOURNAL_SUFFIX = '.journal'
+WINDOW_RECORD_SUFFIX = '.journal-window'
+
+JOURNAL_MAGIC = b'NDSIPJNL'
+WINDOW_RECORD_MAGIC = b'NDSIPWIN'
+JOURNAL_VERSION = 1
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class Journal:
+    """
+    The contents of an in-place patching journal
+    """
+    source_md5: str
+    patch_md5: str
+    used_size: int
+    size: int
+    # (start, data) pairs, sorted and non-overlapping
+    regions: List[Tuple[int, bytes]]
+
+    def __init__(self, source_md5: str, patch_md5: str, used_size: int, size: int,
+            regions: List[Tuple[int, bytes]]):
+        self.source_md5 = source_md5
+        self.patch_md5 = patch_md5
+        self.used_size = used_size
+        self.size = size
+        self.regions = regions
+
+    @property
+    def saved_bytes(self) -> int:
+        return sum(len(data) for _, data in self.regions)
+
+
+def get_journal_filepaths(rom_fp: Path) -> (Path, Path):
+    """Return the paths of the journal and the window record for a ROM"""
+    return (rom_fp.with_name(rom_fp.name + JOURNAL_SUFFIX),
+        rom_fp.with_name(rom_fp.name + WINDOW_RECORD_SUFFIX))
+
+
+def journal_exists(rom_fp: Path) -> bool:
+    """
+    Check if in-place patching of a ROM was started but not finished
+    (meaning the file is neither the original ROM nor the patched one)
+    """
+    return get_journal_filepaths(rom_fp)[0].is_file()
+
+
+def _write_record_file(fp: Path, magic: bytes, header: dict, chunks: List[BytesLike]) -> None:
+    """Atomically write a journal or window record file"""
+    header_data = json.dumps(header).encode('utf-8')
+    md5 = hashlib.md5()
+
+    temp_fp = fp.with_name(fp.name + '.tmp')
+    with temp_fp.open('wb') as f:
+        for chunk in [magic, struct.pack('<I', len(header_data)), header_data, *chunks]:
+            f.write(chunk)
+            md5.update(chunk)
+        f.write(md5.digest())
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_fp, fp)
+    _fsync_dir(fp.parent)
+
+
+def _read_record_file(fp: Path, magic: bytes) -> Optional[Tuple[dict, bytes]]:
+    """
+    Read a journal or window record file, and return (header, data), or
+    None if it doesn't exist. Raises ValueError if it's damaged (which
+    can't happen by crashing, since it's replaced atomically).
+    """
+    try:
+        contents = fp.read_bytes()
+    except FileNotFoundError:
+        return None
+
+    if (len(contents) < len(magic) + 4 + 16
+            or not contents.startswith(magic)
+            or hashlib.md5(contents[:-16]).digest() != contents[-16:]):
+        raise ValueError(f'{fp} is damaged')
+
+    header_len, = struct.unpack_from('<I', contents, len(magic))
+    header_start = len(magic) + 4
+    header = json.loads(contents[header_start : header_start + header_len])
+    return header, contents[header_start + header_len : -16]
+
+
+def _fsync_dir(dir_fp: Path) -> None:
+    """fsync a directory, so that a rename in it is durable (POSIX only)"""
+    if os.name != 'posix':
+        return
+    fd = os.open(dir_fp, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_journal(rom_fp: Path) -> Optional[Journal]:
+    """
+    Load the journal for a ROM, or return None if there isn't one
+    """
+    record = _read_record_file(get_journal_filepaths(rom_fp)[0], JOURNAL_MAGIC)
+    if record is None:
+        return None
+    header, data = record
+
+    if header['version'] != JOURNAL_VERSION:
+        raise ValueError('Unsupported in-place patching journal version')
+
+    regions = []
+    pos = 0
+    for start, length in header['regions']:
+        regions.append((start, data[pos : pos + length]))
+        pos += length
+
+    return Journal(header['sourceMd5'], header['patchMd5'], header['usedSize'], header['size'], regions)
+
+
+def save_journal(rom_fp: Path, journal: Journal) -> None:
+    header = {
+        'version': JOURNAL_VERSION,
+        'sourceMd5': journal.source_md5,
+        'patchMd5': journal.patch_md5,
+        'usedSize': journal.used_size,
+        'size': journal.size,
+        'regions': [[start, len(data)] for start, data in journal.regions],
+    }
+    _write_record_file(get_journal_filepaths(rom_fp)[0], JOURNAL_MAGIC, header,
+        [data for _, data in journal.regions])
+
+
+def merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge overlapping and adjacent (start, end) ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def find_conflicting_ranges(patch: BytesLike, used_size: int) -> List[Tuple[int, int]]:
+    """
+    Return the (start, end) ranges of the source that windows of the
+    patch read after an earlier window has overwritten them, if the
+    output is written over the source one window at a time. Only the
+    source's first used_size bytes are considered, since everything
+    after that is padding that isn't read from the file anyway.
+    """
+    import xdelta3_pure_py
+
+    diff = xdelta3_pure_py.as_binary_io(patch)
+    code_table, decompressors, _ = xdelta3_pure_py.read_vcdiff_header(diff)
+
+    ranges = []
+    window_start = 0
+    while diff.tell() < len(patch):
+        window = xdelta3_pure_py.read_vcdiff_window(diff)
+        window.decompress(decompressors)
+
+        limit = min(window_start, used_size)
+        if limit > window.src_seg_pos:
+            for type, size, addr in window.iter_instructions(code_table):
+                if type == xdelta3_pure_py.INST_TYPE_COPY and addr < window.src_seg_len:
+                    start = window.src_seg_pos + addr
+                    end = min(start + size, limit)
+                    if start < end:
+                        ranges.append((start, end))
+
+        window_start += window.target_window_len
+
+    return merge_ranges(ranges)
+
+
+class InPlaceSource:
+    """
+    Read-only file-like view of the original (normalized) source ROM,
+    while it's being overwritten: saved regions come from the journal,
+    everything else in the used area from the file, and the rest is
+    0xFF padding.
+    """
+    def __init__(self, f: BinaryIO, journal: Journal):
+        self._file = f
+        self._journal = journal
+        self._starts = [start for start, _ in journal.regions]
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        journal = self._journal
+        end = journal.size if size is None or size < 0 else min(self._pos + size, journal.size)
+        pos = self._pos
+        out = bytearray()
+
+        while pos < end:
+            i = bisect.bisect_right(self._starts, pos) - 1
+            if i >= 0 and pos < self._starts[i] + len(journal.regions[i][1]):
+                start, data = journal.regions[i]
+                piece = data[pos - start : end - start]
+            elif pos < journal.used_size:
+                next_start = self._starts[i + 1] if i + 1 < len(self._starts) else end
+                self._file.seek(pos)
+                piece = self._file.read(min(end, next_start, journal.used_size) - pos)
+                if not piece:
+                    raise EOFError('ROM file is truncated')
+            else:
+                piece = b'\xFF' * (end - pos)
+            out += piece
+            pos += len(piece)
+
+        self._pos = max(self._pos, end)
+        return bytes(out)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = self._journal.size + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def start_journal(rom_fp: Path, patch: BytesLike, source_md5: str,
+        used_size: int, size: int) -> Journal:
+    """
+    Find the source ranges that need to be saved, and save them to a new
+    journal. Nothing in the ROM is changed yet.
+    """
+    ranges = find_conflicting_ranges(patch, used_size)
+
+    regions = []
+    with rom_fp.open('rb') as f:
+        for start, end in ranges:
+            f.seek(start)
+            regions.append((start, f.read(end - start)))
+
+    journal = Journal(source_md5, hashlib.md5(patch).hexdigest(), used_size, size, regions)
+    save_journal(rom_fp, journal)
+    return journal
+
+
+class _HashingWriter:
+    """Write-only file-like object that just hashes what's written to it"""
+    def __init__(self):
+        self.hash = hashlib.md5()
+
+    def write(self, data: BytesLike) -> int:
+        self.hash.update(data)
+        return len(data)
+
+
+def get_output_md5(source: Union[BinaryIO, BytesLike], patch: BytesLike) -> str:
+    """
+    Decode the patch without writing the output anywhere, and return the
+    output's MD5. Used to check the output before the ROM is touched.
+    """
+    import xdelta3_pure_py
+    writer = _HashingWriter()
+    xdelta3_pure_py.apply_vcdiff(source, patch, writer)
+    return writer.hash.hexdigest()
+
+
+def patch_in_place(rom_fp: Path, patch: BytesLike, journal: Journal,
+        progress: Optional[Callable[[int, int], None]] = None) -> None:
+    """
+    Apply the patch over the ROM file, using (and finally deleting) a
+    journal from start_journal() or load_journal(). If there's a window
+    record from an interrupted run, this continues after it.
+
+    The caller should make sure the output will be correct (see
+    get_output_md5()) before starting the journal: once the ROM starts
+    being overwritten, the only way to get back a usable file is to
+    finish patching it.
+    """
+    import xdelta3_pure_py
+
+    if hashlib.md5(patch).hexdigest() != journal.patch_md5:
+        raise ValueError("The journal doesn't belong to this patch")
+
+    journal_fp, window_record_fp = get_journal_filepaths(rom_fp)
+
+    # Windows before this one are already in the ROM
+    first_window = 0
+
+    with rom_fp.open('r+b') as f:
+        record = _read_record_file(window_record_fp, WINDOW_RECORD_MAGIC)
+        if record is not None:
+            # Finish writing the window that was being written last time
+            header, data = record
+            f.seek(header['targetOffset'])
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            first_window = header['windowIndex'] + 1
+
+        source = InPlaceSource(f, journal)
+        diff = xdelta3_pure_py.as_binary_io(patch)
+        code_table, decompressors, _ = xdelta3_pure_py.read_vcdiff_header(diff)
+
+        window_index = target_offset = 0
+        while diff.tell() < len(patch):
+            window = xdelta3_pure_py.read_vcdiff_window(diff)
+            # (Skipped windows still have to be decompressed, to keep the
+            # decompressors in sync)
+            window.decompress(decompressors)
+
+            if window_index >= first_window:
+                target_window = window.execute(source, code_table)
+                if (window.expected_adler is not None
+                        and zlib.adler32(target_window) != window.expected_adler):
+                    raise RuntimeError('Patched output is incorrect (window checksum mismatch)')
+
+                _write_record_file(window_record_fp, WINDOW_RECORD_MAGIC,
+                    {'windowIndex': window_index, 'targetOffset': target_offset}, [target_window])
+
+                f.seek(target_offset)
+                f.write(target_window)
+                f.flush()
+                os.fsync(f.fileno())
+
+                if progress is not None:
+                    progress(diff.tell(), len(patch))
+
+            window_index += 1
+            target_offset += window.target_window_len
+
+        f.truncate(target_offset)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Done: the window record has to go first, since the journal is what
+    # marks patching as unfinished
+    try:
+        window_record_fp.unlink()
+    except FileNotFoundError:
+        pass
+    journal_fp.unlink()
+    _fsync_dir(rom_fp.parent)
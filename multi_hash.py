@@ -0,0 +1,150 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import hashlib
+from pathlib import Path
+import queue
+import threading
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Union
+import zlib
+
+
+# Computes any set of digests of a file in a single pass over it.
+#
+# The file is read into two alternating buffers by a read-ahead thread,
+# while the calling thread hashes the other one, so I/O and hashing
+# overlap: hashlib and zlib release the GIL for large updates, and so
+# does reading.
+#
+# Digest names are anything hashlib.new() accepts ("md5", "sha1",
+# "sha256", "blake2b", ...), plus "crc32", which is computed with
+# zlib.crc32() behind a hashlib-like interface.
+
+
+DEFAULT_BLOCK_SIZE = 0x100000
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class CRC32:
+    """
+    hashlib-like wrapper around zlib.crc32()
+    """
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self, data: BytesLike = b''):
+        self._value = zlib.crc32(data)
+
+    def update(self, data: BytesLike) -> None:
+        self._value = zlib.crc32(data, self._value)
+
+    def digest(self) -> bytes:
+        return self._value.to_bytes(4, 'big')
+
+    def hexdigest(self) -> str:
+        return f'{self._value:08x}'
+
+    def copy(self) -> 'CRC32':
+        other = CRC32()
+        other._value = self._value
+        return other
+
+
+def new_hash(name: str) -> 'hashlib._Hash':
+    """Create a hash object by name (see above)"""
+    if name == 'crc32':
+        return CRC32()
+    return hashlib.new(name)
+
+
+def iter_blocks(f: BinaryIO, block_size: int = DEFAULT_BLOCK_SIZE,
+        limit: Optional[int] = None) -> Iterator[memoryview]:
+    """
+    Read a file (from its current position) with a double-buffered
+    read-ahead thread, yielding a memoryview of each block. Each view is
+    only valid until the next one is requested. If limit is given, at
+    most that many bytes are read.
+    """
+    free_buffers = queue.Queue()
+    filled_buffers = queue.Queue()
+    for _ in range(2):
+        free_buffers.put(bytearray(block_size))
+
+    def read_ahead() -> None:
+        remaining = limit
+        try:
+            while True:
+                buffer = free_buffers.get()
+                if buffer is None:  # (stopped early)
+                    return
+                if remaining is None:
+                    length = f.readinto(buffer)
+                else:
+                    with memoryview(buffer)[:min(remaining, block_size)] as view:
+                        length = f.readinto(view)
+                    remaining -= length
+                filled_buffers.put((buffer, length))
+                if not length:
+                    return
+        except BaseException as e:
+            filled_buffers.put((e, 0))
+
+    thread = threading.Thread(target=read_ahead, name='hash-read-ahead', daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            buffer, length = filled_buffers.get()
+            if isinstance(buffer, BaseException):
+                raise buffer
+            if not length:
+                return
+            with memoryview(buffer)[:length] as view:
+                yield view
+            free_buffers.put(buffer)
+    finally:
+        free_buffers.put(None)
+        thread.join()
+
+
+def hash_blocks(blocks: Iterable[BytesLike], names: Iterable[str]) -> Dict[str, 'hashlib._Hash']:
+    """
+    Compute the given digests of a sequence of blocks, and return a
+    dict of hash objects by name
+    """
+    hashes = {name: new_hash(name) for name in names}
+    updates = [h.update for h in hashes.values()]
+    for block in blocks:
+        for update in updates:
+            update(block)
+    return hashes
+
+
+def hash_file(fn: Path, names: Iterable[str] = ('md5',), block_size: int = DEFAULT_BLOCK_SIZE,
+        limit: Optional[int] = None) -> Dict[str, 'hashlib._Hash']:
+    """
+    Compute the given digests of a file (or of its first limit bytes)
+    in one read of it, and return a dict of hash objects by name
+    """
+    with fn.open('rb', buffering=0) as f:
+        return hash_blocks(iter_blocks(f, block_size, limit), names)
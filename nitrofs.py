@@ -0,0 +1,249 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+from pathlib import Path
+import sys
+from typing import Dict, List, Optional, Tuple, Union
+
+
+# Per-region digests of the patched ROM, so that when it doesn't match
+# info.json's "outputHash", we can find out *which* parts are wrong (and
+# fix just those) instead of starting over.
+#
+# The regions come from the NDS header and the NitroFS filesystem it
+# points to:
+#
+# - "header": the header area (normally 0x4000 bytes)
+# - "arm9", "arm7": the main ARM9 and ARM7 binaries
+# - "fnt", "fat": the filename and file allocation tables
+# - "arm9_overlay_table", "arm7_overlay_table"
+# - "banner": the icon/title banner
+# - "overlay9/<id>", "overlay7/<id>": overlays, by overlay ID
+# - "data/<path>": every other NitroFS file, by its path in the FNT
+#
+# info.json's "regionDigests" lists them as [name, start, size, md5]
+# arrays, sorted by start offset. Running this module as a script on the
+# correct patched ROM generates that list.
+
+
+# Regions are hashed in batches of about this many bytes, so that
+# thousands of tiny files don't become thousands of thread pool tasks
+VERIFY_BATCH_SIZE = 0x100000
+
+# Sizes of the known banner versions
+BANNER_SIZES = {0x0001: 0x840, 0x0002: 0x940, 0x0003: 0xA40, 0x0103: 0x23C0}
+
+
+BytesLike = Union[bytes, bytearray, memoryview]
+Region = Tuple[str, int, int]
+
+
+def _u16(data: BytesLike, offset: int) -> int:
+    return int.from_bytes(data[offset : offset + 2], 'little')
+
+
+def _u32(data: BytesLike, offset: int) -> int:
+    return int.from_bytes(data[offset : offset + 4], 'little')
+
+
+def read_file_names(fnt: BytesLike) -> Dict[int, str]:
+    """
+    Parse a NitroFS filename table, and return a dict of file IDs to
+    paths
+    """
+    names = {}
+    visited = set()
+    dir_stack = [(0xF000, '')]
+
+    while dir_stack:
+        dir_id, path = dir_stack.pop()
+        if dir_id in visited:
+            raise ValueError('Filename table has a directory loop')
+        visited.add(dir_id)
+
+        entry = (dir_id & 0xFFF) * 8
+        if entry + 8 > len(fnt):
+            raise ValueError('Filename table is truncated')
+        pos = _u32(fnt, entry)
+        file_id = _u16(fnt, entry + 4)
+
+        while True:
+            if pos >= len(fnt):
+                raise ValueError('Filename table is truncated')
+            length = fnt[pos]
+            pos += 1
+            if length == 0:
+                break
+
+            name = bytes(fnt[pos : pos + (length & 0x7F)]).decode('latin-1')
+            pos += length & 0x7F
+
+            if length & 0x80:
+                dir_stack.append((_u16(fnt, pos), f'{path}{name}/'))
+                pos += 2
+            else:
+                names[file_id] = path + name
+                file_id += 1
+
+    return names
+
+
+def get_regions(rom: BytesLike) -> List[Region]:
+    """
+    Return (name, start, size) for every region of a ROM (see above),
+    sorted by start offset. Raises ValueError if the ROM's header or
+    filesystem is invalid.
+    """
+    if len(rom) < 0x200:
+        raise ValueError('File is too small to be a ROM')
+
+    regions = [('header', 0, _u32(rom, 0x84) or 0x4000)]
+
+    def add_region(name: str, start: int, size: int) -> None:
+        if start and size:
+            regions.append((name, start, size))
+
+    add_region('arm9', _u32(rom, 0x20), _u32(rom, 0x2C))
+    add_region('arm7', _u32(rom, 0x30), _u32(rom, 0x3C))
+
+    fnt_start, fnt_size = _u32(rom, 0x40), _u32(rom, 0x44)
+    fat_start, fat_size = _u32(rom, 0x48), _u32(rom, 0x4C)
+    add_region('fnt', fnt_start, fnt_size)
+    add_region('fat', fat_start, fat_size)
+
+    # Overlays are NitroFS files too, but they're named by the overlay
+    # tables instead of the FNT
+    file_names = {}
+    for cpu, table_offset in [('9', 0x50), ('7', 0x58)]:
+        table_start, table_size = _u32(rom, table_offset), _u32(rom, table_offset + 4)
+        add_region(f'arm{cpu}_overlay_table', table_start, table_size)
+        for entry in range(table_start, table_start + table_size - 31, 32):
+            file_names[_u32(rom, entry + 0x18)] = f'overlay{cpu}/{_u32(rom, entry)}'
+
+    banner_start = _u32(rom, 0x68)
+    if banner_start:
+        add_region('banner', banner_start, BANNER_SIZES.get(_u16(rom, banner_start), 0x840))
+
+    if fnt_size:
+        for file_id, path in read_file_names(rom[fnt_start : fnt_start + fnt_size]).items():
+            file_names.setdefault(file_id, f'data/{path}')
+
+    for file_id in range(fat_size // 8):
+        start = _u32(rom, fat_start + file_id * 8)
+        end = _u32(rom, fat_start + file_id * 8 + 4)
+        if end < start:
+            raise ValueError(f'File {file_id} has an invalid FAT entry')
+        add_region(file_names.get(file_id, f'file/{file_id}'), start, end - start)
+
+    for name, start, size in regions:
+        if start + size > len(rom):
+            raise ValueError(f'{name} extends past the end of the ROM')
+
+    regions.sort(key=lambda region: region[1])
+    return regions
+
+
+def compute_region_digests(rom: BytesLike) -> List[list]:
+    """
+    Return the "regionDigests" list for a (correct) patched ROM
+    """
+    view = memoryview(rom)
+    try:
+        return [[name, start, size, hashlib.md5(view[start : start + size]).hexdigest()]
+            for name, start, size in get_regions(rom)]
+    finally:
+        view.release()
+
+
+def find_mismatched_regions(rom: BytesLike, digests: List[list],
+        max_workers: Optional[int] = None) -> List[Region]:
+    """
+    Check a patched ROM against its "regionDigests" list, and return
+    (name, start, size) for every region that doesn't match, sorted by
+    start offset.
+
+    The regions are hashed in parallel (hashlib releases the GIL), by
+    up to max_workers threads (default: one per CPU).
+    """
+    # Group the regions into batches of roughly equal size
+    batches = [[]]
+    batch_size = 0
+    for digest in digests:
+        if batch_size >= VERIFY_BATCH_SIZE:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append(digest)
+        batch_size += digest[2]
+
+    view = memoryview(rom)
+
+    def check_batch(batch: List[list]) -> List[Region]:
+        bad = []
+        for name, start, size, md5 in batch:
+            if (start + size > len(view)
+                    or hashlib.md5(view[start : start + size]).hexdigest() != md5):
+                bad.append((name, start, size))
+        return bad
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers or os.cpu_count() or 1) as executor:
+            results = list(executor.map(check_batch, batches))
+    finally:
+        view.release()
+
+    return sorted((region for bad in results for region in bad), key=lambda region: region[1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Generate the per-region digests of the patched ROM in info.json.')
+    parser.add_argument('rom', type=Path,
+        help='the (correct) patched ROM')
+    parser.add_argument('--info', type=Path, default=Path('data') / 'info.json',
+        help='the info.json file to update (default: data/info.json)')
+    args = parser.parse_args(argv)
+
+    rom = args.rom.read_bytes()
+    info = json.loads(args.info.read_text(encoding='utf-8'))
+
+    if hashlib.md5(rom).hexdigest() != info.get('outputHash'):
+        print(f"{args.rom} doesn't match the outputHash in {args.info}", file=sys.stderr)
+        return 1
+
+    try:
+        info['regionDigests'] = compute_region_digests(rom)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    args.info.write_text(json.dumps(info, indent=4) + '\n', encoding='utf-8')
+    print(f'Saved {len(info["regionDigests"])} region digests to {args.info}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
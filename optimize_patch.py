@@ -0,0 +1,409 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import bisect
+import io
+from pathlib import Path
+import sys
+import time
+from typing import Iterator, List, Optional, Tuple
+import zlib
+
+import xdelta3_pure_py
+from xdelta3_pure_py import BytesLike, EditOp, INST_TYPE_ADD, INST_TYPE_RUN
+
+
+# Offline tool that re-encodes an existing xdelta3 patch into an
+# equivalent one that xdelta3_pure_py can apply faster. The pure-Python
+# decoder pays a roughly fixed cost per instruction, so this mostly
+# tries to produce fewer, larger instructions:
+#
+# - Target copies are traced back to the source data they came from
+#   (through any number of earlier copies), and turned into source
+#   copies where that gives a reasonably large one
+# - Overlapping target copies with a period of 1 become RUNs, and so do
+#   long repeated bytes inside ADDs
+# - Adjacent ADDs, adjacent RUNs of the same byte, and copies of
+#   contiguous data are merged
+# - Tiny copies become ADDs
+# - The output is re-windowed with large windows (fewer per-window
+#   overheads; 8 MiB by default, which is also xdelta3's default
+#   maximum)
+#
+# LZMA secondary compression can be dropped or applied (by default, it's
+# kept if the input patch used it). Either way, it's only used for data
+# streams it shrinks noticeably: LZMA-decompressing data that barely
+# compresses (like the ADD data of most patches) can easily take longer
+# than everything else put together.
+#
+# optimize_patch() always decodes the new patch again, and checks that
+# it gives exactly the same output as the original one.
+
+
+# Copies smaller than this become ADDs (the default code table can't
+# embed copy sizes below 4 anyway)
+MIN_COPY_SIZE = 4
+
+# Target copies are only split up into source copies if every resulting
+# piece is at least this large
+MIN_RESOLVED_COPY_SIZE = 16
+
+# Data streams are only LZMA-compressed if that makes them at least this
+# much smaller
+LZMA_MIN_SAVINGS = 0.125
+
+DEFAULT_WINDOW_SIZE = 0x800000
+MAX_WINDOW_SIZE = xdelta3_pure_py.MAX_TARGET_WINDOW_LEN
+
+class PatchMismatch(ValueError):
+    """
+    Raised when a re-encoded patch doesn't give the same output as the
+    patch(es) it was made from
+    """
+
+
+def op_size(op: EditOp) -> int:
+    if op[0] == 'add':
+        return len(op[1])
+    return op[2]
+
+
+def split_op(op: EditOp, n: int) -> Tuple[EditOp, EditOp]:
+    """Split an edit operation into its first n bytes and the rest"""
+    if op[0] == 'add':
+        return ('add', op[1][:n]), ('add', op[1][n:])
+    kind, arg, size = op
+    if kind == 'run':
+        return (kind, arg, n), (kind, arg, size - n)
+    return (kind, arg, n), (kind, arg + n, size - n)
+
+
+class OriginMap:
+    """
+    Keeps track of where each part of the target came from: a source
+    position, or None for data that didn't come from the source
+    """
+    def __init__(self):
+        self.starts = []
+        self.entries = []
+
+    def append(self, start: int, end: int, src_pos: Optional[int]) -> None:
+        self.starts.append(start)
+        self.entries.append((end, src_pos))
+
+    def iter_pieces(self, pos: int, size: int):
+        """
+        Yield (size, src_pos or None) for consecutive pieces of a target
+        range
+        """
+        i = bisect.bisect_right(self.starts, pos) - 1
+        while size:
+            start = self.starts[i]
+            end, src_pos = self.entries[i]
+            n = min(size, end - pos)
+            yield n, (None if src_pos is None else src_pos + pos - start)
+            pos += n
+            size -= n
+            i += 1
+
+
+def iter_window_ops(window: xdelta3_pure_py.VCDIFFWindow, code_table: xdelta3_pure_py.VCDIFFCodeTable,
+        window_start: int) -> Iterator[EditOp]:
+    """
+    Yield a (decompressed) window's instructions as edit operations with
+    absolute positions. window_start is the window's target position.
+    """
+    for type, size, arg in window.iter_instructions(code_table):
+        if type == INST_TYPE_ADD:
+            yield ('add', arg)
+        elif type == INST_TYPE_RUN:
+            yield ('run', arg, size)
+        elif arg < window.src_seg_len:
+            yield ('src', window.src_seg_pos + arg, size)
+        else:
+            yield ('tgt', window_start + arg - window.src_seg_len, size)
+
+
+def read_patch(source: bytes, patch: bytes) -> Tuple[List[EditOp], bytearray, Optional[bytes], bool, dict]:
+    """
+    Decode a patch into a flat list of edit operations (with absolute
+    positions) and the target data. Also returns the appheader, whether
+    the patch used LZMA secondary compression, and instruction counts.
+    """
+    src = io.BytesIO(source)
+    diff = io.BytesIO(patch)
+    code_table, decompressors, appheader = xdelta3_pure_py.read_vcdiff_header(diff)
+    uses_lzma = isinstance(decompressors.adds_runs, xdelta3_pure_py.XdeltaLZMADecompressor)
+
+    ops = []
+    target = bytearray()
+    counts = {'windows': 0, 'add': 0, 'run': 0, 'copy': 0}
+
+    while diff.tell() < len(patch):
+        window = xdelta3_pure_py.read_vcdiff_window(diff)
+        window.decompress(decompressors)
+        counts['windows'] += 1
+
+        for op in iter_window_ops(window, code_table, len(target)):
+            ops.append(op)
+            counts['copy' if op[0] in ('src', 'tgt') else op[0]] += 1
+
+        target_window = window.execute(src, code_table)
+        if window.expected_adler is not None and zlib.adler32(target_window) != window.expected_adler:
+            raise ValueError('The patch output has the wrong checksum -- is this the right source file?')
+        target += target_window
+
+    return ops, target, appheader, uses_lzma, counts
+
+
+def resolve_target_copies(ops: List[EditOp], target: BytesLike) -> List[EditOp]:
+    """
+    Replace target copies with source copies and RUNs where possible
+    """
+    origins = OriginMap()
+    result = []
+    out_pos = 0
+
+    for op in ops:
+        size = op_size(op)
+
+        if op[0] == 'tgt':
+            pos = op[1]
+            if pos + size > out_pos:
+                # Overlapping copy
+                if out_pos - pos == 1:
+                    op = ('run', target[pos], size)
+                new_ops = [op]
+            else:
+                pieces = list(origins.iter_pieces(pos, size))
+                if all(src_pos is not None and n >= MIN_RESOLVED_COPY_SIZE for n, src_pos in pieces):
+                    new_ops = [('src', src_pos, n) for n, src_pos in pieces]
+                else:
+                    new_ops = [op]
+        else:
+            new_ops = [op]
+
+        for new_op in new_ops:
+            n = op_size(new_op)
+            origins.append(out_pos, out_pos + n, new_op[1] if new_op[0] == 'src' else None)
+            result.append(new_op)
+            out_pos += n
+
+    return result
+
+
+def append_merged(ops: List[EditOp], op: EditOp) -> None:
+    """Append an edit operation, merging it into the previous one if possible"""
+    if ops:
+        prev = ops[-1]
+        if prev[0] == op[0]:
+            if op[0] == 'add':
+                if not isinstance(prev[1], bytearray):
+                    prev = ops[-1] = ('add', bytearray(prev[1]))
+                prev[1].extend(op[1])
+                return
+            elif op[0] == 'run':
+                if prev[1] == op[1]:
+                    ops[-1] = ('run', op[1], prev[2] + op[2])
+                    return
+            elif prev[1] + prev[2] == op[1]:
+                ops[-1] = (op[0], prev[1], prev[2] + op[2])
+                return
+    ops.append(op)
+
+
+def normalize_ops(ops: List[EditOp], target: BytesLike, out_pos: int) -> List[EditOp]:
+    """
+    Turn tiny copies into ADDs, split long repeated bytes out of ADDs,
+    and merge adjacent operations. out_pos is the target position of
+    the first operation.
+    """
+    result = []
+
+    for op in ops:
+        size = op_size(op)
+        if op[0] in ('src', 'tgt') and size < MIN_COPY_SIZE:
+            op = ('add', target[out_pos : out_pos + size])
+
+        if op[0] == 'add':
+            for piece in xdelta3_pure_py.split_runs(op[1]):
+                append_merged(result, piece)
+        else:
+            append_merged(result, op)
+
+        out_pos += size
+
+    return result
+
+
+def split_into_windows(ops: List[EditOp], target: BytesLike,
+        window_size: int) -> List[Tuple[int, List[EditOp]]]:
+    """
+    Split the edit operations into windows of (at most) window_size
+    bytes of target data. Target copies that reach back past the start
+    of their window are turned into ADDs.
+    """
+    windows = []
+    window_start = 0
+    window_ops = []
+    out_pos = 0
+
+    def finish_window():
+        nonlocal window_ops, window_start
+        windows.append((window_start, normalize_ops(window_ops, target, window_start)))
+        window_ops = []
+        window_start = out_pos
+
+    for op in ops:
+        while op_size(op):
+            n = min(op_size(op), window_start + window_size - out_pos)
+            piece, op = split_op(op, n)
+
+            if piece[0] == 'tgt' and piece[1] < window_start:
+                # The part that reads from before the window is already
+                # known, so just add it
+                k = min(n, window_start - piece[1])
+                window_ops.append(('add', target[out_pos : out_pos + k]))
+                if k < n:
+                    window_ops.append(('tgt', piece[1] + k, n - k))
+            else:
+                window_ops.append(piece)
+
+            out_pos += n
+            if out_pos == window_start + window_size:
+                finish_window()
+
+    if window_ops:
+        finish_window()
+
+    return windows
+
+
+def optimize_patch(source: bytes, patch: bytes, window_size: int = DEFAULT_WINDOW_SIZE,
+        use_lzma: Optional[bool] = None) -> Tuple[bytes, bytes, dict]:
+    """
+    Re-encode a patch for faster decoding. use_lzma=None keeps the
+    input patch's setting. Returns (new patch, target, stats).
+
+    The new patch is decoded and checked against the original output,
+    raising PatchMismatch if it's any different. (stats has how long
+    that took, as "decodeSeconds".)
+    """
+    ops, target, appheader, input_lzma, counts_before = read_patch(source, patch)
+    if use_lzma is None:
+        use_lzma = input_lzma
+
+    new_patch, counts_after = encode_ops(ops, target, window_size, use_lzma, appheader)
+    decode_seconds = verify_patch(source, new_patch, target)
+
+    return new_patch, bytes(target), {'before': counts_before, 'after': counts_after,
+        'decodeSeconds': decode_seconds}
+
+
+def encode_ops(ops: List[EditOp], target: BytesLike, window_size: int = DEFAULT_WINDOW_SIZE,
+        use_lzma: bool = False, appheader: Optional[bytes] = None) -> Tuple[bytes, dict]:
+    """
+    Optimize a flat list of edit operations (with absolute positions)
+    that produce the target, and encode them as a new patch. Returns
+    (patch, instruction counts).
+    """
+    ops = resolve_target_copies(ops, target)
+    ops = normalize_ops(ops, target, 0)
+    windows = split_into_windows(ops, target, window_size)
+
+    out = io.BytesIO()
+    writer = xdelta3_pure_py.VCDIFFWriter(out,
+        secondary=xdelta3_pure_py.VCD_COMPRESSION_LZMA if use_lzma else None,
+        appheader=appheader, secondary_min_savings=LZMA_MIN_SAVINGS)
+
+    counts = {'windows': len(windows), 'add': 0, 'run': 0, 'copy': 0}
+    for i, (window_start, window_ops) in enumerate(windows):
+        window_end = windows[i + 1][0] if i + 1 < len(windows) else len(target)
+        writer.write_window(window_ops, window_start, memoryview(target)[window_start : window_end])
+        for op in window_ops:
+            counts['copy' if op[0] in ('src', 'tgt') else op[0]] += 1
+
+    return out.getvalue(), counts
+
+
+def verify_patch(source: bytes, patch: bytes, target: BytesLike) -> float:
+    """
+    Decode a patch and check that it gives exactly the target, raising
+    PatchMismatch if not. Returns how long decoding took.
+    """
+    out = io.BytesIO()
+    start = time.perf_counter()
+    xdelta3_pure_py.apply_vcdiff(source, patch, out)
+    seconds = time.perf_counter() - start
+    if out.getbuffer() != memoryview(target):
+        raise PatchMismatch('The re-encoded patch gives different output')
+    return seconds
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Re-encode an xdelta3 patch so that the pure-Python '
+        'backend can apply it faster. The output is equivalent to the input.')
+    parser.add_argument('source', type=Path,
+        help='the file the patch applies to')
+    parser.add_argument('patch', type=Path,
+        help='the patch to optimize')
+    parser.add_argument('output', type=Path,
+        help='where to save the optimized patch')
+    parser.add_argument('--window-size', type=int, default=DEFAULT_WINDOW_SIZE // 0x400,
+        help=f'target window size, in KiB (default: {DEFAULT_WINDOW_SIZE // 0x400};'
+        f' max: {MAX_WINDOW_SIZE // 0x400})')
+    parser.add_argument('--lzma', dest='lzma', action='store_const', const=True,
+        help='use LZMA secondary compression (default: same as the input)')
+    parser.add_argument('--no-lzma', dest='lzma', action='store_const', const=False,
+        help="don't use LZMA secondary compression")
+    args = parser.parse_args(argv)
+
+    window_size = args.window_size * 0x400
+    if not 0 < window_size <= MAX_WINDOW_SIZE:
+        parser.error(f'the window size must be between 1 and {MAX_WINDOW_SIZE // 0x400} KiB')
+
+    source = args.source.read_bytes()
+    patch = args.patch.read_bytes()
+
+    try:
+        new_patch, target, stats = optimize_patch(source, patch, window_size, args.lzma)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    for label in ['before', 'after']:
+        counts = stats[label]
+        size = len(patch) if label == 'before' else len(new_patch)
+        print(f'{label:7s} {size:10d} bytes, {counts["windows"]} windows,'
+            f' {counts["add"]} ADDs, {counts["run"]} RUNs, {counts["copy"]} COPYs')
+
+    old_seconds = verify_patch(source, patch, target)
+    print(f'Decoding time: {old_seconds:.3f}s -> {stats["decodeSeconds"]:.3f}s')
+
+    args.output.write_bytes(new_patch)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
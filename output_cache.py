@@ -0,0 +1,257 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import errno
+import os
+from pathlib import Path
+import shutil
+import sys
+import threading
+from typing import Dict, Optional, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# A patched ROM is completely determined by the source ROM and the
+# patch(es) applied to it, so verified outputs can be cached under a
+# (source hash, patch hash) key and handed out again later without
+# decoding anything.
+
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+CACHE_FILE_SUFFIX = '.nds'
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class CacheStats:
+    """
+    Counters describing how an OutputCache has been used
+    """
+    hits: int
+    misses: int
+    stores: int
+    evictions: int
+    bytes_served: int
+    # How cache hits were materialized: 'reflink', 'copy_file_range',
+    # 'hardlink' or 'copy'
+    methods: Dict[str, int]
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self.methods = collections.Counter()
+
+    def as_dict(self) -> dict:
+        """Return the stats as a JSON-compatible dict"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'bytesServed': self.bytes_served,
+            'methods': dict(self.methods),
+        }
+
+
+def clone_file(src_fp: Path, dst_fp: Path, allow_hardlink: bool = False) -> str:
+    """
+    Make dst_fp a copy of src_fp, as cheaply as the OS and filesystem
+    allow. Returns the name of the method that worked.
+
+    Hardlinks are only used if allow_hardlink is True, since anything
+    that later modifies dst_fp in place would then modify src_fp, too.
+
+    The copy is made in a temporary file that then replaces dst_fp, so
+    that if dst_fp already exists -- even as a hardlink to src_fp, from
+    an earlier clone -- it's never written to (which would truncate
+    src_fp along with it).
+    """
+    temp_fp = dst_fp.with_name(f'{dst_fp.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        method = _clone_to_new_file(src_fp, temp_fp, allow_hardlink)
+        os.replace(temp_fp, dst_fp)
+    except BaseException:
+        try:
+            temp_fp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    return method
+
+
+def _clone_to_new_file(src_fp: Path, dst_fp: Path, allow_hardlink: bool) -> str:
+    # (clone_file(), for a dst_fp that doesn't exist yet)
+    if fcntl is not None and sys.platform.startswith('linux'):
+        with src_fp.open('rb') as src, dst_fp.open('wb') as dst:
+            # Reflink (btrfs, XFS, ...): shares the data blocks until
+            # either file is modified
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+
+            # copy_file_range: the kernel does the copy, without the
+            # data passing through userspace (and NFS/CIFS can even do
+            # it server-side)
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    remaining = os.fstat(src.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                    if remaining == 0:
+                        return 'copy_file_range'
+                except OSError as e:
+                    if e.errno not in {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}:
+                        raise
+
+    if allow_hardlink:
+        try:
+            if dst_fp.exists():
+                dst_fp.unlink()
+            os.link(src_fp, dst_fp)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    shutil.copyfile(src_fp, dst_fp)
+    return 'copy'
+
+
+class OutputCache:
+    """
+    A content-addressed cache directory of verified output ROMs, keyed
+    by (source hash, patch hash). Once the total size of the cache goes
+    over max_size bytes, the least recently used entries are evicted.
+
+    Safe to share between threads.
+    """
+    directory: Path
+    max_size: int
+    allow_hardlink: bool
+    stats: CacheStats
+
+    def __init__(self, directory: Path, max_size: int, allow_hardlink: bool = False):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.allow_hardlink = allow_hardlink
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(source_md5: str, patch_md5: str) -> str:
+        """
+        Build a cache key from the (hex) hashes of the source ROM and
+        the patch
+        """
+        return f'{source_md5}-{patch_md5}'
+
+    def _path_for(self, key: str) -> Path:
+        return self.directory / (key + CACHE_FILE_SUFFIX)
+
+    def __contains__(self, key: str) -> bool:
+        return self._path_for(key).is_file()
+
+    def get(self, key: str, out_fp: Path) -> bool:
+        """
+        If the cache has an entry for the key, write it to out_fp and
+        return True. Otherwise, return False.
+        """
+        cached_fp = self._path_for(key)
+
+        try:
+            # Bump the entry to most-recently-used
+            os.utime(cached_fp)
+            method = clone_file(cached_fp, out_fp, self.allow_hardlink)
+        except FileNotFoundError:
+            # (including the entry being evicted by another thread just
+            # now)
+            with self._lock:
+                self.stats.misses += 1
+            return False
+
+        with self._lock:
+            self.stats.hits += 1
+            self.stats.bytes_served += cached_fp.stat().st_size
+            self.stats.methods[method] += 1
+
+        return True
+
+    def put(self, key: str, data: BytesLike) -> None:
+        """
+        Store a (verified!) output ROM in the cache
+        """
+        cached_fp = self._path_for(key)
+
+        # Write to a temporary file first, so that other threads and
+        # processes never see a partially-written entry
+        temp_fp = cached_fp.with_name(f'{cached_fp.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        temp_fp.write_bytes(data)
+        os.replace(temp_fp, cached_fp)
+
+        with self._lock:
+            self.stats.stores += 1
+
+        self.evict()
+
+    def evict(self, max_size: Optional[int] = None) -> None:
+        """
+        Delete least-recently-used entries until the cache is no bigger
+        than max_size bytes (default: self.max_size)
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        with self._lock:
+            entries = []
+            for fp in self.directory.glob('*' + CACHE_FILE_SUFFIX):
+                try:
+                    st = fp.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fp))
+
+            total_size = sum(size for _, size, _ in entries)
+
+            for _, size, fp in sorted(entries):
+                if total_size <= max_size:
+                    break
+                try:
+                    fp.unlink()
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                self.stats.evictions += 1
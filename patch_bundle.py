@@ -0,0 +1,212 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import collections
+import hashlib
+import mmap
+from pathlib import Path
+import re
+import struct
+import sys
+from typing import Dict, Iterator, Union
+
+
+# All of the .xdelta patches are shipped as a single "bundle" file, so
+# that finding a patch is a dictionary lookup instead of a directory
+# scan plus a file open, and reading one is a slice of a memory map.
+#
+# File layout (all integers little-endian):
+#
+# - Header (32 bytes):
+#   - 0x00: magic (b'NDSPBNDL')
+#   - 0x08: format version (u32, currently 1)
+#   - 0x0C: number of entries (u32)
+#   - 0x10: offset of the entry table (u64)
+#   - 0x18: reserved, zero (8 bytes)
+# - Entry table (48 bytes per entry):
+#   - 0x00: MD5 of the ROM the patch applies to (16 bytes)
+#   - 0x10: MD5 of the patch data itself (16 bytes)
+#   - 0x20: offset of the patch data (u64)
+#   - 0x28: length of the patch data (u64)
+# - Patch data, each entry aligned to 16 bytes
+
+
+BUNDLE_MAGIC = b'NDSPBNDL'
+BUNDLE_VERSION = 1
+
+HEADER_STRUCT = struct.Struct('<8sIIQ8x')
+ENTRY_STRUCT = struct.Struct('<16s16sQQ')
+
+DATA_ALIGNMENT = 16
+
+MD5_RE = re.compile('[0-9a-f]{32}')
+
+
+BundleEntry = collections.namedtuple('BundleEntry', 'patch_md5 offset length')
+# patch_md5: str (hex)
+# offset: int
+# length: int
+
+
+class PatchBundle:
+    """
+    A read-only, memory-mapped patch bundle file. Patches are looked up
+    by the (hex) MD5 hash of the ROM they apply to.
+    """
+    entries: Dict[str, BundleEntry]
+
+    def __init__(self, fn: Path):
+        with Path(fn).open('rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        if len(self._mmap) < HEADER_STRUCT.size:
+            raise ValueError('Patch bundle is truncated')
+
+        magic, version, count, table_offset = HEADER_STRUCT.unpack_from(self._mmap, 0)
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f'Wrong patch bundle magic ({magic.hex()})')
+        if version != BUNDLE_VERSION:
+            raise ValueError(f'Unsupported patch bundle version ({version})')
+        if table_offset + count * ENTRY_STRUCT.size > len(self._mmap):
+            raise ValueError('Patch bundle entry table is truncated')
+
+        self.entries = {}
+        for i in range(count):
+            source_md5, patch_md5, offset, length = ENTRY_STRUCT.unpack_from(
+                self._mmap, table_offset + i * ENTRY_STRUCT.size)
+            if offset + length > len(self._mmap):
+                raise ValueError(f'Patch bundle entry {source_md5.hex()} is truncated')
+            self.entries[source_md5.hex()] = BundleEntry(patch_md5.hex(), offset, length)
+
+    def __contains__(self, source_md5: str) -> bool:
+        return source_md5 in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    def get(self, source_md5: str) -> memoryview:
+        """
+        Return the patch for the ROM with the given MD5 hash, as a
+        zero-copy view into the bundle. Raises KeyError if there isn't
+        one.
+        """
+        entry = self.entries[source_md5]
+        return self._view[entry.offset : entry.offset + entry.length]
+
+    def patch_md5(self, source_md5: str) -> str:
+        """
+        Return the MD5 hash of the patch for the ROM with the given MD5
+        hash, without reading the patch itself
+        """
+        return self.entries[source_md5].patch_md5
+
+    def verify(self) -> bool:
+        """
+        Check every patch against the content hash stored for it
+        """
+        for source_md5, entry in self.entries.items():
+            if hashlib.md5(self.get(source_md5)).hexdigest() != entry.patch_md5:
+                return False
+        return True
+
+
+def build_bundle(patches: Dict[str, Union[bytes, memoryview]], out_fn: Path) -> None:
+    """
+    Write a patch bundle containing the given patches, which are keyed
+    by the (hex) MD5 hash of the ROM they apply to.
+    """
+    for source_md5 in patches:
+        if not MD5_RE.fullmatch(source_md5):
+            raise ValueError(f'Patch key {source_md5!r} is not a hex MD5 hash')
+
+    table = []
+    data = bytearray()
+    data_start = HEADER_STRUCT.size
+
+    for source_md5, patch in sorted(patches.items()):
+        data += b'\0' * (-(data_start + len(data)) % DATA_ALIGNMENT)
+        table.append(ENTRY_STRUCT.pack(
+            bytes.fromhex(source_md5),
+            hashlib.md5(patch).digest(),
+            data_start + len(data),
+            len(patch)))
+        data += patch
+
+    table_offset = data_start + len(data)
+
+    with Path(out_fn).open('wb') as f:
+        f.write(HEADER_STRUCT.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(table), table_offset))
+        f.write(data)
+        f.write(b''.join(table))
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Build, list or extract Newer DS patch bundles.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('build', help='build a bundle from a folder of [md5].xdelta files')
+    p.add_argument('patches_dir', type=Path)
+    p.add_argument('bundle', type=Path)
+
+    p = subparsers.add_parser('list', help='list the patches in a bundle')
+    p.add_argument('bundle', type=Path)
+
+    p = subparsers.add_parser('extract', help='extract a bundle to a folder of [md5].xdelta files')
+    p.add_argument('bundle', type=Path)
+    p.add_argument('patches_dir', type=Path)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        patches = {}
+        bad_names = []
+        for fp in sorted(args.patches_dir.glob('*.xdelta')):
+            if MD5_RE.fullmatch(fp.stem.lower()):
+                patches[fp.stem.lower()] = fp.read_bytes()
+            else:
+                bad_names.append(fp.name)
+        if bad_names:
+            parser.error('patch filenames must be the hex MD5 of the ROM they apply to: '
+                + ', '.join(bad_names))
+        build_bundle(patches, args.bundle)
+        print(f'Bundled {len(patches)} patches into {args.bundle}')
+
+    elif args.command == 'list':
+        bundle = PatchBundle(args.bundle)
+        for source_md5, entry in bundle.entries.items():
+            print(f'{source_md5}  {entry.patch_md5}  {entry.length:>10}')
+
+    elif args.command == 'extract':
+        bundle = PatchBundle(args.bundle)
+        args.patches_dir.mkdir(parents=True, exist_ok=True)
+        for source_md5 in bundle:
+            (args.patches_dir / (source_md5 + '.xdelta')).write_bytes(bundle.get(source_md5))
+        print(f'Extracted {len(bundle)} patches to {args.patches_dir}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,122 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import socket
+import sys
+import tempfile
+from typing import Callable, Optional
+
+
+# Client for the patch service (patch_service.py). This deliberately
+# only uses the standard library, so that it starts up instantly.
+#
+# The service listens on a Unix domain socket. Each connection carries
+# one request, as a single line of JSON, and gets back a stream of
+# JSON-line events:
+#
+#   -> {"command": "patch", "input": "/abs/in.nds", "output": "/abs/out.nds"}
+#   <- {"event": "queued"}
+#   <- {"event": "started"}
+#   <- {"event": "progress", "done": 1234, "total": 5678}  (zero or more)
+#   <- {"event": "finished", "seconds": 1.5}
+#      or {"event": "failed", "error": "..."}
+#
+#   -> {"command": "stats"}
+#   <- {"event": "stats", "jobsFinished": ..., "jobsFailed": ..., ...}
+#
+# To run several jobs at once, open several connections.
+
+
+DEFAULT_SOCKET_PATH = Path(tempfile.gettempdir()) / 'newer-ds-patch-service.sock'
+
+FINAL_EVENTS = {'finished', 'failed', 'stats'}
+
+
+def request(socket_path: Path, message: dict,
+        on_event: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Send a request to the service, and return the final event.
+    Intermediate events are passed to on_event, if provided.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        with sock.makefile('rb') as f:
+            for line in f:
+                event = json.loads(line)
+                if event['event'] in FINAL_EVENTS:
+                    return event
+                if on_event is not None:
+                    on_event(event)
+
+    raise ConnectionError('The patch service closed the connection unexpectedly')
+
+
+def submit(socket_path: Path, in_fp: Path, out_fp: Path,
+        on_event: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Ask the service to patch a ROM, and return the final event
+    """
+    return request(socket_path,
+        {'command': 'patch', 'input': str(in_fp.resolve()), 'output': str(out_fp.resolve())},
+        on_event)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Client for the local Newer DS patching service.')
+    parser.add_argument('--socket', type=Path, default=DEFAULT_SOCKET_PATH,
+        help=f'socket path (default: {DEFAULT_SOCKET_PATH})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('patch', help='patch a ROM')
+    p.add_argument('input', type=Path)
+    p.add_argument('output', type=Path)
+
+    subparsers.add_parser('stats', help='show statistics about the service')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'patch':
+        def on_event(event: dict) -> None:
+            if event['event'] == 'progress':
+                print(f'\r{100 * event["done"] // max(event["total"], 1):3d}%', end='', flush=True)
+
+        result = submit(args.socket, args.input, args.output, on_event)
+        print('\r', end='')
+        if result['event'] == 'finished':
+            print(f'Done in {result["seconds"]:.2f}s')
+            return 0
+        else:
+            print(f'Failed: {result["error"]}', file=sys.stderr)
+            return 1
+
+    elif args.command == 'stats':
+        print(json.dumps(request(args.socket, {'command': 'stats'}), indent=4))
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,1258 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import enum
+import functools
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import os
+from pathlib import Path
+import subprocess
+import sys
+import threading
+import types
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+import patch_bundle
+import telemetry
+
+
+# The patch wizard's ROM identification and patching logic, without any
+# GUI. patch_wizard.py wraps this in a Qt wizard; patch_service.py and
+# the benchmarks use it directly, so they don't have to load Qt.
+#
+# To keep startup fast, the xdelta backends (the xdelta3 module, and
+# xdelta3_pure_py), asyncio, and the modules that only some features
+# use (inplace_patch, multi_hash, output_cache, nitrofs, tree_hash) are
+# only imported once they're needed.
+
+
+PATCH_BUNDLE_FILENAME = 'patches.bundle'
+
+# Set by load_data()
+Info = None
+Patches = None
+
+# Where xdelta3.exe is, and is run from (with its temporary files).
+# Relative to the working directory, which the wizard expects to be the
+# program folder; anything that can't assume that (like the patch
+# service) sets this to an absolute path instead.
+DataDir = Path('data')
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+_xdelta3_module = None
+_xdelta3_module_imported = False
+
+def get_xdelta3_module() -> Optional[types.ModuleType]:
+    """
+    Return the xdelta3 module, or None if it isn't installed (or is
+    broken). It's imported the first time this is called.
+    """
+    global _xdelta3_module, _xdelta3_module_imported
+    if not _xdelta3_module_imported:
+        try:
+            import xdelta3
+            _xdelta3_module = xdelta3
+        except Exception:
+            pass
+        _xdelta3_module_imported = True
+    return _xdelta3_module
+
+
+class RomFileStatus(enum.Enum):
+    """
+    The return type of classify_file(). Represents all possible scenarios
+    for a given rom filename.
+    """
+    EMPTY            = 0  # Filename is empty or all whitespace
+    NOT_FULL_PATH    = 1  # Filename is not complete (no slashes)
+    NONEXISTENT      = 2  # No such file exists
+    NOT_A_ROM        = 3  # File exists, but doesn't look like a DS rom
+    UNIDENTIFIED_ROM = 4  # File is a DS rom, but not NSMB
+    UNSUPPORTED_ROM  = 5  # File is a NSMB rom, but not one we can patch
+    VALID_ROM        = 6  # File is a patchable NSMB rom
+    UPGRADABLE_ROM   = 7  # File is an older Newer DS rom we can upgrade
+    INTERRUPTED_ROM  = 8  # File is a rom whose in-place patching was interrupted
+
+
+
+
+def file_md5(fn: Path) -> 'hashlib._Hash':
+    """
+    Calculate the MD5 hash of the file with the given filename, using a
+    method that is efficient even for large files.
+    Return the hashlib hash object.
+    """
+    import multi_hash
+    return multi_hash.hash_file(fn)['md5']
+
+
+
+def get_rom_sizes(header: bytes) -> (int, int):
+    """
+    Given a DS ROM header, return the size of the used area of the ROM
+    and the size of an untrimmed dump (i.e. the chip capacity).
+    """
+    used_size = int.from_bytes(header[0x80:0x84], 'little')
+    capacity = 0x20000 << min(header[0x14], 15)
+    return used_size, capacity
+
+
+class NormalizedRom:
+    """
+    A read-only, file-like view of a ROM file, normalized to look like
+    an untrimmed dump: the used area of the ROM (according to the
+    header), followed by 0xFF padding up to the chip capacity. If the
+    file is trimmed, or only has 0xFF padding after the used area,
+    trimmed and untrimmed dumps of the same ROM look identical.
+
+    If anything else comes after the used area (a Download Play
+    signature, or 0x00 padding, say), the file is used as-is instead,
+    so that it still hashes the same as the raw file, which its patch
+    is keyed by.
+
+    The file is memory-mapped, so this doesn't copy anything until it's
+    read from.
+    """
+    PADDING_BLOCK = b'\xFF' * 0x10000
+
+    def __init__(self, fn: Path):
+        self.filepath = fn
+        with fn.open('rb') as f:
+            header = f.read(0x200)
+            if len(header) < 0x200:
+                raise ValueError('File is too small to be a ROM')
+
+            self.used_size, self.size = get_rom_sizes(header)
+            if self.used_size > self.size:
+                raise ValueError('ROM header has an invalid used-ROM size')
+            if self.used_size > os.fstat(f.fileno()).st_size:
+                raise ValueError('ROM file is truncated')
+
+            file_size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if not self._is_padding(self.used_size, file_size):
+            self.used_size = self.size = file_size
+
+        self._pos = 0
+
+    def _is_padding(self, start: int, end: int) -> bool:
+        """Check if a range of the file is all 0xFF"""
+        block = self.PADDING_BLOCK
+        for pos in range(start, end, len(block)):
+            n = min(len(block), end - pos)
+            if self._mmap[pos : pos + n] != block[:n]:
+                return False
+        return True
+
+    def __enter__(self) -> 'NormalizedRom':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __bytes__(self) -> bytes:
+        return self._mmap[:self.used_size] + b'\xFF' * (self.size - self.used_size)
+
+    def read(self, size: int = -1) -> bytes:
+        start = self._pos
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(start + size, self.size)
+        if end <= start:
+            return b''
+        self._pos = end
+
+        if end <= self.used_size:
+            return self._mmap[start:end]
+
+        data = self._mmap[start:self.used_size] if start < self.used_size else b''
+        return data + b'\xFF' * (end - max(start, self.used_size))
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = self.size + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def hashes(self, names: Iterable[str] = ('md5',)) -> Dict[str, 'hashlib._Hash']:
+        """
+        Calculate any set of digests (see multi_hash) of the normalized
+        ROM in one pass, and return a dict of hash objects by name. Only
+        the used area is actually read from the file.
+        """
+        import multi_hash
+        hashes = multi_hash.hash_file(self.filepath, names, limit=self.used_size)
+
+        padding_len = self.size - self.used_size
+        while padding_len > 0:
+            for h in hashes.values():
+                h.update(self.PADDING_BLOCK[:padding_len])
+            padding_len -= len(self.PADDING_BLOCK)
+
+        return hashes
+
+    def md5(self) -> 'hashlib._Hash':
+        """
+        Calculate the MD5 hash of the normalized ROM
+        """
+        return self.hashes()['md5']
+
+    def buffer(self) -> memoryview:
+        """
+        Return the normalized ROM as a memoryview: of the memory map, if
+        the file is already exactly that (apart from anything after the
+        end), or of a copy otherwise. Release it before closing the ROM.
+        """
+        if len(self._mmap) >= self.size:
+            with memoryview(self._mmap) as view:
+                return view[:self.size]
+        return memoryview(bytes(self))
+
+
+
+def identify_by_manifest(rom: NormalizedRom) -> Optional[str]:
+    """
+    Identify a ROM by its tree-hash root (see tree_hash), which is
+    calculated on every core at once, using info.json's
+    "sourceManifests". Return the MD5 that the matching manifest is
+    listed under, or None if none of them match (or there aren't any).
+    """
+    manifests = Info.get('sourceManifests')
+    if not manifests:
+        return None
+
+    import tree_hash
+
+    # Root -> MD5, for each leaf size in use (normally just one)
+    candidates = {}
+    for md5, manifest in manifests.items():
+        if manifest.get('algorithm') == tree_hash.ALGORITHM and manifest.get('size') == len(rom):
+            candidates.setdefault(manifest['leafSize'], {})[manifest['root']] = md5
+
+    with rom.buffer() as data:
+        for leaf_size, roots in candidates.items():
+            md5 = roots.get(tree_hash.compute_manifest(data, leaf_size)['root'])
+            if md5 is not None:
+                return md5
+
+    return None
+
+
+def classify_file(fn: str) -> RomFileStatus:
+    """
+    Given a file path (string -- could be arbitrarily invalid as a file
+    path), return a RomFileStatus representing whether or not it points
+    to a patchable rom file.
+
+    This function should run very quickly even for very large files.
+    """
+    if not fn.strip():
+        return RomFileStatus.EMPTY
+
+    try:
+        fn = Path(fn)
+    except Exception:
+        return RomFileStatus.NONEXISTENT
+
+    if not fn.is_absolute():
+        return RomFileStatus.NOT_FULL_PATH
+
+    if not fn.is_file():
+        return RomFileStatus.NONEXISTENT
+
+    # (Checked before anything else, since the file itself is half
+    # patched and wouldn't be recognized)
+    import inplace_patch
+    if inplace_patch.journal_exists(fn):
+        return RomFileStatus.INTERRUPTED_ROM
+
+    with telemetry.phase('classify.read_header'), fn.open('rb') as f:
+        first_200 = f.read(0x200)
+
+    if len(first_200) < 0x200:
+        # Unless it's "The Smallest NDS File"...
+        return RomFileStatus.NOT_A_ROM
+
+    # Padding area -- empty in all games I checked
+    if any(first_200[0x15:0x1C]):
+        return RomFileStatus.NOT_A_ROM
+
+    # Check the Nintendo logo
+    if (hashlib.sha256(first_200[0xC0:0x15D]).hexdigest() !=
+            'a07b35ac13a40de9682fc24b4ded05b717da632fb621253e38cafec5471a1cce'):
+        return RomFileStatus.NOT_A_ROM
+
+    # Check for the NSMB rom name and game code (excluding region).
+    # Older Newer DS roms don't have those, so they're recognized by
+    # their header fingerprints instead, and only hashed (to make sure)
+    # if the fingerprint is one of theirs.
+    is_nsmb = first_200[:15] == b'NEW MARIO\0\0\0A2D'
+    if not is_nsmb:
+        fingerprint_md5 = Info.get('fingerprints', {}).get(rom_fingerprint(first_200))
+        if fingerprint_md5 is None or get_upgrade_version(fingerprint_md5) is None:
+            return RomFileStatus.UNIDENTIFIED_ROM
+
+    # If we made it this far, it's probably a NSMB rom.
+    # Hash the used area of the ROM (padded back out to full size, so
+    # that trimmed dumps hash the same as untrimmed ones -- see
+    # NormalizedRom) and check if it's one we have xdeltas for.
+    try:
+        with telemetry.phase('classify.hash') as record, NormalizedRom(fn) as rom:
+            record['bytes'] = len(rom)
+            md5 = identify_by_manifest(rom)
+            if md5 is not None:
+                record['method'] = 'tree_hash'
+            else:
+                md5 = rom.md5().hexdigest()
+    except ValueError:
+        return RomFileStatus.UNSUPPORTED_ROM if is_nsmb else RomFileStatus.UNIDENTIFIED_ROM
+
+    if not is_nsmb:
+        if get_upgrade_version(md5) is not None and have_patch_chain(md5):
+            return RomFileStatus.UPGRADABLE_ROM
+        return RomFileStatus.UNIDENTIFIED_ROM
+
+    if have_patch_chain(md5):
+        return RomFileStatus.VALID_ROM
+    else:
+        return RomFileStatus.UNSUPPORTED_ROM
+
+
+def get_upgrade_version(md5: str) -> Optional[str]:
+    """
+    If the ROM with the given MD5 is an older version of Newer DS that
+    can be upgraded, return its version number. Otherwise, return None.
+
+    info.json's "upgradeFrom" maps the MD5s of older Newer DS ROMs
+    (normalized, like any other input ROM) to their version numbers. The
+    upgrade patches themselves are in the patch bundle, keyed by those
+    same MD5s -- so they're just one more kind of patch chain, and can be
+    chained through intermediate versions with "patchChains", too.
+
+    Their header fingerprints (see rom_fingerprint()) also have to be in
+    "fingerprints", or classify_file() won't even hash them.
+    """
+    return Info.get('upgradeFrom', {}).get(md5)
+
+
+def rom_fingerprint(header: bytes) -> str:
+    """
+    Return a cheap fingerprint of a ROM, computed from its header alone.
+    The header includes the ROM's sizes and CRCs of its secure area and
+    logo, so different dumps of the game practically never share one --
+    but a corrupted dump can, so a fingerprint is only ever used to
+    guess which patch chain to start on (see predict_rom_md5()).
+    """
+    return hashlib.md5(header[:0x200]).hexdigest()
+
+
+def predict_rom_md5(fn: Path) -> Optional[str]:
+    """
+    Guess the (normalized) MD5 of a ROM from its fingerprint, using
+    info.json's "fingerprints" map (fingerprint -> MD5). Returns None if
+    the fingerprint isn't listed, or there's no patch chain for the
+    predicted ROM.
+    """
+    fingerprints = Info.get('fingerprints')
+    if not fingerprints:
+        return None
+
+    with fn.open('rb') as f:
+        header = f.read(0x200)
+
+    md5 = fingerprints.get(rom_fingerprint(header))
+    if md5 is None or not have_patch_chain(md5):
+        return None
+    return md5
+
+
+def get_patch_chain(md5: str) -> List[str]:
+    """
+    Return the list of patches (as patch bundle keys, i.e. the MD5 of
+    the ROM each one applies to) that turn the ROM with the given MD5
+    into Newer DS, in order.
+
+    Most ROMs have a single patch straight to Newer DS. info.json can
+    instead list a chain for a ROM -- typically a small patch that
+    normalizes that particular dump to a canonical base ROM, followed by
+    one large patch shared by every dump.
+    """
+    return Info.get('patchChains', {}).get(md5, [md5])
+
+
+def have_patch_chain(md5: str) -> bool:
+    """
+    Check if every patch needed for the ROM with the given MD5 is in the
+    patch bundle
+    """
+    return all(key in Patches for key in get_patch_chain(md5))
+
+
+def get_patch_chain_md5(chain: List[str]) -> str:
+    """
+    Return a hash identifying the contents of all of the patches in a
+    patch chain
+    """
+    if len(chain) == 1:
+        return Patches.patch_md5(chain[0])
+
+    return hashlib.md5(''.join(Patches.patch_md5(key) for key in chain).encode('ascii')).hexdigest()
+
+
+_temp_file_counter = itertools.count()
+
+def get_temp_filepaths() -> (Path, Path, Path):
+    """
+    Return paths for the temporary base, patch and output files used to
+    run xdelta3.exe. They're unique per call, since the patch service
+    can be running several patches at once.
+    """
+    prefix = f'temp-{os.getpid()}-{next(_temp_file_counter)}-'
+    return tuple(DataDir / f'{prefix}{i}.bin' for i in (1, 2, 3))
+
+
+def get_xdelta3_exe_command(base_fp: Path, patch_fp: Path, out_fp: Path) -> List[str]:
+    """
+    Return the command line for running xdelta3.exe (from the data
+    folder) on the given files
+    """
+    return ['xdelta3.exe', '-d', '-s', base_fp.name, patch_fp.name, out_fp.name]
+
+
+def do_xdelta(base: Union[BytesLike, NormalizedRom], patch: BytesLike,
+        progress: Optional[Callable[[int, int], None]] = None) -> bytes:
+    """
+    Perform an xdelta patch using the best available technique.
+    The patch can be any bytes-like object, such as a memoryview
+    returned by PatchBundle.get(). The base can also be a NormalizedRom,
+    which the pure-Python backend reads from directly.
+
+    If provided, progress is called as progress(done, total) (measured
+    in bytes of the patch) as patching proceeds. Only the pure-Python
+    backend can report progress partway through.
+    """
+    with telemetry.phase('xdelta', bytes=len(patch)) as record:
+        return _do_xdelta(base, patch, progress, record)
+
+
+def _do_xdelta(base: Union[BytesLike, NormalizedRom], patch: BytesLike,
+        progress: Optional[Callable[[int, int], None]], record: dict) -> bytes:
+    # (record is the telemetry record for the phase, which gets the
+    # backend that worked, and any that failed before it)
+    record['failedBackends'] = []
+
+    # If the xdelta3 module is installed, use that
+    xdelta3 = get_xdelta3_module()
+    if xdelta3 is not None:
+        try:
+            record['backend'] = 'module'
+            return xdelta3.decode(bytes(base), patch)
+        except Exception as e:
+            record['failedBackends'].append(['module', repr(e)])
+
+    # Otherwise, try to run the xdelta3.exe program instead
+    record['backend'] = 'exe'
+    temp_base_fp, temp_patch_fp, temp_out_fp = get_temp_filepaths()
+    temp_base_fp.write_bytes(bytes(base))
+    temp_patch_fp.write_bytes(patch)
+
+    try:
+        command = get_xdelta3_exe_command(temp_base_fp, temp_patch_fp, temp_out_fp)
+        if sys.platform == 'win32':
+            subprocess.call(command, shell=True, cwd=DataDir)
+        else:
+            # gulp
+            command.insert(0, 'wine')
+            subprocess.call(command, cwd=DataDir)
+
+        return temp_out_fp.read_bytes()
+
+    except Exception as e:
+        record['failedBackends'].append(['exe', repr(e)])
+
+    finally:
+        temp_base_fp.unlink()
+        temp_patch_fp.unlink()
+        try:
+            temp_out_fp.unlink()
+        except Exception:
+            pass
+
+    # If that still didn't work, use the bundled pure-Python VCDIFF
+    # implementation as a last resort
+    import xdelta3_pure_py
+    out_file_obj = io.BytesIO()
+    if xdelta3_pure_py.is_free_threaded():
+        # (Without the GIL, the windows can run in parallel)
+        record['backend'] = 'pure_py_threaded'
+        xdelta3_pure_py.apply_vcdiff_threaded(base, patch, out_file_obj, progress=progress)
+    else:
+        record['backend'] = 'pure_py'
+        xdelta3_pure_py.apply_vcdiff(base, patch, out_file_obj, progress=progress)
+    out_file_obj.seek(0)
+    return out_file_obj.read()
+
+
+
+def do_xdelta_resumable(base: Union[BytesLike, NormalizedRom], patch: BytesLike,
+        partial_fp: Path, source_md5: str,
+        progress: Optional[Callable[[int, int], None]] = None) -> bytes:
+    """
+    Perform an xdelta patch with the pure-Python backend, writing the
+    output to partial_fp and checkpointing as it goes, so that calling
+    this again after an interruption (even in another process) picks up
+    where it left off. The partial file is deleted afterwards.
+    """
+    import xdelta3_pure_py
+    with telemetry.phase('xdelta', bytes=len(patch), backend='pure_py_resumable'):
+        xdelta3_pure_py.apply_vcdiff_resumable(base, patch, partial_fp,
+            progress=progress, source_id=source_md5)
+        data = partial_fp.read_bytes()
+        partial_fp.unlink()
+        return data
+
+
+def have_native_backend() -> bool:
+    """
+    Check if do_xdelta() has a native backend to use instead of the
+    pure-Python one: the xdelta3 module, or xdelta3.exe (run directly on
+    Windows, or through wine elsewhere)
+    """
+    if get_xdelta3_module() is not None:
+        return True
+    if not (DataDir / 'xdelta3.exe').is_file():
+        return False
+    if sys.platform == 'win32':
+        return True
+    import shutil
+    return shutil.which('wine') is not None
+
+
+def can_xdelta_to_file() -> bool:
+    """
+    Check if do_xdelta_to_file() is worth using: the OS has to support
+    copy_file_range(), and do_xdelta() has to be going to end up with
+    the pure-Python backend anyway
+    """
+    return hasattr(os, 'copy_file_range') and not have_native_backend()
+
+
+def do_xdelta_to_file(base: NormalizedRom, patch: BytesLike, out_filepath: Path,
+        progress: Optional[Callable[[int, int], None]] = None) -> None:
+    """
+    Apply a patch with the pure-Python backend, straight into a new
+    output file. Long unchanged stretches of the ROM are copied by the
+    OS (see xdelta3_pure_py.apply_vcdiff_copy_range()), but only from the
+    used area of the file -- after that, the ROM is normalized padding,
+    which may not be what the file actually contains.
+
+    Since that skips the windows' Adler-32 checks, the output has to be
+    checked afterwards (see check_output_file()).
+    """
+    import xdelta3_pure_py
+    with telemetry.phase('xdelta', bytes=len(patch), backend='pure_py_copy_range') as record, \
+            base.filepath.open('rb') as raw, out_filepath.open('wb') as out:
+        record['kernelCopiedBytes'] = xdelta3_pure_py.apply_vcdiff_copy_range(base, patch, out,
+            progress, src_fd=raw.fileno(), src_limit=base.used_size)
+
+
+def check_output_file(out_filepath: Path) -> None:
+    """
+    Like check_output(), but for a patched ROM that's already been saved
+    """
+    with out_filepath.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        check_output(data)
+
+
+def do_xdelta_chain(base: Union[BytesLike, NormalizedRom], chain: List[str],
+        progress: Optional[Callable[[int, int], None]] = None,
+        partial_fp: Optional[Path] = None) -> bytes:
+    """
+    Apply a chain of patches from the patch bundle (see
+    get_patch_chain()), one after another. Intermediate ROMs are kept in
+    memory and fed straight into the next patch, rather than saved as
+    output files. (The xdelta3.exe backend still writes each step's
+    input and output to temporary files in the data folder.)
+
+    progress is as for do_xdelta(), but measured across the whole chain.
+
+    If partial_fp is provided, the last (and normally largest) patch is
+    applied with do_xdelta_resumable() instead of do_xdelta().
+    """
+    patches = [Patches.get(key) for key in chain]
+    total = sum(len(patch) for patch in patches)
+    done = 0
+
+    for i, (key, patch) in enumerate(zip(chain, patches)):
+        if i > 0:
+            with telemetry.phase('hash_intermediate', bytes=len(base), step=i):
+                if hashlib.md5(base).hexdigest() != key:
+                    raise RuntimeError(f'Intermediate ROM (step {i}) is incorrect')
+
+        if progress is None:
+            step_progress = None
+        else:
+            step_progress = lambda d, t, done=done: progress(done + d, total)
+
+        if partial_fp is not None and i == len(chain) - 1:
+            base = do_xdelta_resumable(base, patch, partial_fp, key, step_progress)
+        else:
+            base = do_xdelta(base, patch, step_progress)
+
+        done += len(patch)
+        if progress is not None:
+            progress(done, total)
+
+    return base
+
+
+class DeltaWriter:
+    """
+    Writable file-like object that updates an existing file to new
+    contents, comparing them block by block and only rewriting the
+    blocks that differ. The file is truncated (or extended) to the new
+    length when this is closed.
+
+    This turns re-patching over an existing, mostly correct output ROM
+    into a read plus a few small writes. (Anything that writes its
+    output sequentially, like xdelta3_pure_py.apply_vcdiff(), can write
+    to this directly.)
+
+    Rewritten blocks are read back right away, raising RuntimeError if
+    they didn't save, so the file never needs to be re-read afterwards.
+    If the file doesn't exist yet, it's created; if it's hardlinked (by
+    an OutputCache, say), the link is broken first, since rewriting it
+    in place would change the other links, too.
+    """
+    BLOCK_SIZE = 0x10000
+
+    bytes_rewritten: int
+
+    def __init__(self, fn: Path):
+        if fn.is_file() and fn.stat().st_nlink > 1:
+            fn.unlink()
+        self._file = fn.open('r+b' if fn.is_file() else 'w+b')
+        self._pos = 0
+        self.bytes_rewritten = 0
+
+    def __enter__(self) -> 'DeltaWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, data: BytesLike) -> int:
+        view = memoryview(data).cast('B')
+        try:
+            for start in range(0, len(view), self.BLOCK_SIZE):
+                block = view[start : start + self.BLOCK_SIZE]
+                self._file.seek(self._pos)
+                if self._file.read(len(block)) != block:
+                    self._file.seek(self._pos)
+                    self._file.write(block)
+                    self._file.seek(self._pos)
+                    if self._file.read(len(block)) != block:
+                        raise RuntimeError(f'Unable to save to {self._file.name}')
+                    self.bytes_rewritten += len(block)
+                self._pos += len(block)
+        finally:
+            view.release()
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        try:
+            self._file.truncate(self._pos)
+            if os.fstat(self._file.fileno()).st_size != self._pos:
+                raise RuntimeError(f'Unable to save to {self._file.name}')
+        finally:
+            self._file.close()
+
+
+class OutputIncorrect(RuntimeError):
+    """
+    Raised when a patched ROM doesn't match info.json's "outputHash"
+    """
+
+
+def repair_output(newer_ds: bytes, in_filepath: Path, chain: List[str]) -> Optional[bytes]:
+    """
+    Try to fix an incorrect patched ROM by finding the regions of it
+    that are wrong (using info.json's "regionDigests"; see nitrofs.py),
+    and re-decoding just the patch windows that cover them with the
+    pure-Python backend.
+
+    Return the repaired ROM (which still needs to be checked as usual),
+    or None if it can't be repaired this way: if there are no region
+    digests, if they all match (so the problem is somewhere else), or if
+    the patch chain has more than one step (since the intermediate ROMs
+    are gone by now).
+    """
+    digests = Info.get('regionDigests')
+    if not digests or len(chain) != 1:
+        return None
+
+    import nitrofs
+    with telemetry.phase('verify_regions', regions=len(digests)) as record:
+        bad_regions = nitrofs.find_mismatched_regions(newer_ds, digests)
+        record['badRegions'] = [name for name, _, _ in bad_regions]
+    if not bad_regions:
+        return None
+
+    import xdelta3_pure_py
+    with telemetry.phase('repair_output') as record, NormalizedRom(in_filepath) as original_rom:
+        windows = xdelta3_pure_py.decode_vcdiff_windows(original_rom, Patches.get(chain[0]),
+            [(start, start + size) for _, start, size in bad_regions])
+        record['windows'] = len(windows)
+        record['bytes'] = sum(len(data) for _, data in windows)
+
+    repaired = bytearray(newer_ds)
+    for offset, data in windows:
+        if offset + len(data) > len(repaired):
+            # (The output is the wrong length, which this can't fix)
+            return None
+        repaired[offset : offset + len(data)] = data
+
+    return bytes(repaired)
+
+
+def check_output(newer_ds: BytesLike) -> None:
+    """
+    Check that a patched ROM is correct, raising OutputIncorrect if not
+    """
+    # Check that the patch was applied properly. If info.json has a
+    # tree-hash manifest for the output, that's checked instead of the
+    # MD5, since it can use every core (and tells us where it's wrong).
+    with telemetry.phase('hash_output', bytes=len(newer_ds)) as record:
+        manifest = Info.get('outputManifest')
+        if manifest:
+            import tree_hash
+            record['method'] = 'tree_hash'
+            bad_offset = tree_hash.find_first_mismatch(newer_ds, manifest)
+            if bad_offset is not None:
+                record['badOffset'] = bad_offset
+                raise OutputIncorrect(f'Patched output file is incorrect (from 0x{bad_offset:X})')
+        elif hashlib.md5(newer_ds).hexdigest() != Info['outputHash']:
+            raise OutputIncorrect('Patched output file is incorrect')
+
+
+def check_and_save_output(newer_ds: bytes, out_filepath: Path) -> None:
+    """
+    Check that a patched ROM is correct (raising OutputIncorrect if
+    not), and save it to the output filepath. If the output file already
+    exists (from patching before, say), only the parts of it that differ
+    are rewritten.
+    """
+    check_output(newer_ds)
+
+    # (DeltaWriter reads back everything it writes, so this also checks
+    # that the thing actually saved correctly)
+    with telemetry.phase('write_output', bytes=len(newer_ds)) as record:
+        with DeltaWriter(out_filepath) as writer:
+            writer.write(newer_ds)
+        record['rewrittenBytes'] = writer.bytes_rewritten
+
+
+class SpeculationFailed(Exception):
+    """
+    Raised to abort speculative patching once the input ROM's hash turns
+    out not to be the predicted one
+    """
+
+
+def patch_rom_speculatively(in_filepath: Path, predicted_md5: str,
+        progress: Optional[Callable[[int, int], None]] = None) -> (str, Optional[bytes]):
+    """
+    Start applying the patch chain for the predicted MD5 right away,
+    while the input ROM's actual MD5 is calculated on another thread
+    (hashlib releases the GIL, so the two really do overlap).
+
+    Return (actual MD5, patched ROM), or (actual MD5, None) if the
+    prediction was wrong -- in which case the output has been discarded.
+    The patched ROM still needs to be checked as usual.
+
+    Patching is stopped early on a wrong prediction through the progress
+    callback, which only the pure-Python backend calls partway through.
+    The native backends can't be stopped, so a wrong prediction would
+    cost a whole wasted patch -- which is why patch_rom_single() only
+    speculates when there isn't a native backend (see
+    have_native_backend()).
+    """
+    result = {}
+
+    def hash_input():
+        try:
+            with telemetry.phase('hash_input', speculative=True) as record, \
+                    NormalizedRom(in_filepath) as original_rom:
+                record['bytes'] = len(original_rom)
+                result['md5'] = original_rom.md5().hexdigest()
+        except Exception as e:
+            result['error'] = e
+
+    hash_thread = threading.Thread(target=hash_input, name='hash-input')
+    hash_thread.start()
+
+    def check_progress(done: int, total: int) -> None:
+        if result.get('md5', predicted_md5) != predicted_md5:
+            raise SpeculationFailed
+        if progress is not None:
+            progress(done, total)
+
+    newer_ds = decode_error = None
+    try:
+        with NormalizedRom(in_filepath) as original_rom:
+            newer_ds = do_xdelta_chain(original_rom, get_patch_chain(predicted_md5), check_progress)
+    except Exception as e:
+        decode_error = e
+    finally:
+        hash_thread.join()
+
+    if 'error' in result:
+        raise result['error']
+    if result['md5'] != predicted_md5:
+        return result['md5'], None
+    if decode_error is not None:
+        raise decode_error
+    return result['md5'], newer_ds
+
+
+def get_partial_output_filepath(out_filepath: Path) -> Path:
+    """
+    Return the path of the partial output file used for resumable
+    patching
+    """
+    return out_filepath.with_name(out_filepath.name + '.partial')
+
+
+class InPlacePatchingFailed(RuntimeError):
+    """
+    Raised if in-place patching would give (or gave) the wrong output.
+    Retrying can't help, so patch_rom() doesn't.
+    """
+
+
+def patch_rom_in_place(rom_filepath: Path,
+        progress: Optional[Callable[[int, int], None]] = None) -> bool:
+    """
+    Patch a ROM by overwriting it, using inplace_patch. If in-place
+    patching of it was interrupted before, this finishes it instead.
+
+    Only single-patch chains are supported; for anything else, this
+    returns False without changing anything (and the caller should patch
+    it the normal way). Otherwise, it returns True.
+    """
+    import inplace_patch
+    journal = inplace_patch.load_journal(rom_filepath)
+    if journal is not None:
+        telemetry.event('in_place_resume', source=journal.source_md5)
+        md5 = journal.source_md5
+    else:
+        with telemetry.phase('hash_input') as record, NormalizedRom(rom_filepath) as original_rom:
+            record['bytes'] = len(original_rom)
+            md5 = original_rom.md5().hexdigest()
+            used_size, size = original_rom.used_size, original_rom.size
+
+    chain = get_patch_chain(md5)
+    if len(chain) != 1:
+        if journal is not None:
+            raise RuntimeError('The patch needed to finish patching this ROM in place is missing')
+        return False
+    patch = Patches.get(chain[0])
+
+    if journal is None:
+        # Overwriting the ROM can't be undone, so make sure the output
+        # will be right first
+        with telemetry.phase('in_place_check', patchBytes=len(patch)), \
+                NormalizedRom(rom_filepath) as original_rom:
+            if inplace_patch.get_output_md5(original_rom, patch) != Info['outputHash']:
+                raise InPlacePatchingFailed('Patched output would be incorrect; the ROM was not changed')
+
+        with telemetry.phase('in_place_journal') as record:
+            journal = inplace_patch.start_journal(rom_filepath, patch, md5, used_size, size)
+            record['savedBytes'] = journal.saved_bytes
+
+    with telemetry.phase('xdelta_in_place', patchBytes=len(patch)):
+        inplace_patch.patch_in_place(rom_filepath, patch, journal, progress)
+
+    with telemetry.phase('verify_output'):
+        if file_md5(rom_filepath).hexdigest() != Info['outputHash']:
+            raise InPlacePatchingFailed('Patched output file is incorrect')
+
+    return True
+
+
+def patch_rom_single(in_filepath: Path, out_filepath: Path,
+        cache: 'Optional[output_cache.OutputCache]' = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        resumable: bool = False, in_place: bool = False) -> bytes:
+    """
+    The rest of the program exists as a fancy wrapper for this function.
+
+    If an output cache is provided, it's checked before patching, and
+    the (verified) output is added to it afterwards. progress is as for
+    do_xdelta_chain().
+
+    If the input ROM's hash can be predicted from its header, and the
+    pure-Python backend is going to be used, patching starts while the
+    hash is still being calculated (see patch_rom_speculatively()).
+
+    If resumable is True, the main patch is applied by the pure-Python
+    backend with checkpoints next to the output file (see
+    do_xdelta_resumable()), so that if this is interrupted, the next
+    attempt continues from the last checkpoint. (This doesn't speculate,
+    since the ROM's hash is needed to check the checkpoint anyway.)
+
+    If in_place is True and the output filepath is the input ROM, the
+    ROM is overwritten directly (see patch_rom_in_place()), without the
+    cache. That's also the only way to finish patching a ROM whose
+    in-place patching was interrupted.
+    """
+    if in_place and out_filepath.exists() and in_filepath.samefile(out_filepath):
+        if patch_rom_in_place(in_filepath, progress):
+            return
+    else:
+        import inplace_patch
+        if inplace_patch.journal_exists(in_filepath):
+            raise RuntimeError('In-place patching of the input ROM was interrupted;'
+                ' choose it as the output file too, to finish it')
+
+    md5 = newer_ds = None
+
+    if resumable or have_native_backend():
+        predicted_md5 = None
+    else:
+        predicted_md5 = predict_rom_md5(in_filepath)
+    if predicted_md5 is not None and cache is not None:
+        # (A cache hit is much faster than patching, so don't bother
+        # speculating if there would be one)
+        predicted_chain_md5 = get_patch_chain_md5(get_patch_chain(predicted_md5))
+        if cache.make_key(predicted_md5, predicted_chain_md5) in cache:
+            predicted_md5 = None
+
+    if predicted_md5 is not None:
+        with telemetry.phase('speculate', predicted=predicted_md5) as record:
+            md5, newer_ds = patch_rom_speculatively(in_filepath, predicted_md5, progress)
+            record['hit'] = newer_ds is not None
+
+    if md5 is None:
+        with telemetry.phase('hash_input') as record, NormalizedRom(in_filepath) as original_rom:
+            record['bytes'] = len(original_rom)
+            md5 = identify_by_manifest(original_rom)
+            if md5 is not None:
+                record['method'] = 'tree_hash'
+            else:
+                # (If telemetry is on, also record the CRC32 and SHA-1
+                # that ROM databases identify dumps by, in the same pass)
+                names = ['md5', 'crc32', 'sha1'] if telemetry.is_enabled() else ['md5']
+                hashes = original_rom.hashes(names)
+                md5 = hashes.pop('md5').hexdigest()
+                record.update((name, h.hexdigest()) for name, h in hashes.items())
+
+    chain = get_patch_chain(md5)
+
+    if cache is not None:
+        cache_key = cache.make_key(md5, get_patch_chain_md5(chain))
+        if newer_ds is None:
+            with telemetry.phase('cache_lookup') as record:
+                hit = record['hit'] = cache.get(cache_key, out_filepath)
+            if hit:
+                return
+
+    if (newer_ds is None and len(chain) == 1 and cache is None and not resumable
+            and not out_filepath.exists() and can_xdelta_to_file()):
+        with NormalizedRom(in_filepath) as original_rom:
+            do_xdelta_to_file(original_rom, Patches.get(chain[0]), out_filepath, progress)
+        try:
+            check_output_file(out_filepath)
+            return
+        except OutputIncorrect:
+            # Carry on as if it had been patched in memory, so that it
+            # can be repaired
+            newer_ds = out_filepath.read_bytes()
+
+    if newer_ds is None:
+        partial_fp = get_partial_output_filepath(out_filepath) if resumable else None
+        with NormalizedRom(in_filepath) as original_rom:
+            newer_ds = do_xdelta_chain(original_rom, chain, progress, partial_fp)
+
+    try:
+        check_and_save_output(newer_ds, out_filepath)
+    except OutputIncorrect:
+        # Fix just the parts that are wrong, if possible, rather than
+        # leaving patch_rom() to start over from scratch
+        repaired = repair_output(newer_ds, in_filepath, chain)
+        if repaired is None:
+            raise
+        newer_ds = repaired
+        check_and_save_output(newer_ds, out_filepath)
+
+    if cache is not None:
+        with telemetry.phase('cache_store', bytes=len(newer_ds)):
+            cache.put(cache_key, newer_ds)
+
+
+def patch_rom(in_filepath: Path, out_filepath: Path,
+        cache: 'Optional[output_cache.OutputCache]' = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        resumable: bool = False, in_place: bool = False) -> bytes:
+    """
+    Try to patch three times; if it still doesn't work, let the error
+    propogate. (With resumable=True, retries continue from the last
+    checkpoint, and with in_place=True, from the in-place patching
+    journal. In-place patching that fails its output check isn't
+    retried.)
+    """
+    for attempt in range(1, 3):
+        try:
+            with telemetry.phase('patch_rom', attempt=attempt):
+                return patch_rom_single(in_filepath, out_filepath, cache, progress, resumable, in_place)
+        except InPlacePatchingFailed:
+            raise
+        except Exception:
+            pass
+
+    with telemetry.phase('patch_rom', attempt=3):
+        return patch_rom_single(in_filepath, out_filepath, cache, progress, resumable, in_place)
+
+
+
+async def do_xdelta_async(base: Union[BytesLike, NormalizedRom], patch: BytesLike,
+        executor: 'Optional[concurrent.futures.Executor]' = None,
+        progress: Optional[Callable[[int, int], None]] = None) -> bytes:
+    """
+    asyncio version of do_xdelta(). CPU-heavy work and file I/O happen
+    in the executor (default: the event loop's default executor), and
+    xdelta3.exe is run as an asyncio subprocess.
+
+    Cancelling the task kills xdelta3.exe if it's running, or stops the
+    pure-Python backend at the end of the current window.
+    """
+    import asyncio
+    import xdelta3_pure_py
+    run = functools.partial(xdelta3_pure_py.run_in_executor_to_completion,
+        asyncio.get_running_loop(), executor)
+
+    # If the xdelta3 module is installed, use that
+    xdelta3 = get_xdelta3_module()
+    if xdelta3 is not None:
+        try:
+            return await run(lambda: xdelta3.decode(bytes(base), patch))
+        except Exception:
+            pass
+
+    # Otherwise, try to run the xdelta3.exe program instead
+    temp_base_fp, temp_patch_fp, temp_out_fp = get_temp_filepaths()
+    await run(lambda: temp_base_fp.write_bytes(bytes(base)))
+    await run(temp_patch_fp.write_bytes, patch)
+
+    try:
+        command = get_xdelta3_exe_command(temp_base_fp, temp_patch_fp, temp_out_fp)
+        if sys.platform == 'win32':
+            proc = await asyncio.create_subprocess_shell(
+                subprocess.list2cmdline(command), cwd=DataDir)
+        else:
+            # gulp
+            proc = await asyncio.create_subprocess_exec('wine', *command, cwd=DataDir)
+
+        try:
+            await proc.wait()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+        return await run(temp_out_fp.read_bytes)
+
+    except Exception:
+        pass
+
+    finally:
+        temp_base_fp.unlink()
+        temp_patch_fp.unlink()
+        try:
+            temp_out_fp.unlink()
+        except Exception:
+            pass
+
+    # If that still didn't work, use the bundled pure-Python VCDIFF
+    # implementation as a last resort
+    out_file_obj = io.BytesIO()
+    await xdelta3_pure_py.apply_vcdiff_async(base, patch, out_file_obj, executor, progress)
+    return out_file_obj.getvalue()
+
+
+async def do_xdelta_chain_async(base: Union[BytesLike, NormalizedRom], chain: List[str],
+        executor: 'Optional[concurrent.futures.Executor]' = None,
+        progress: Optional[Callable[[int, int], None]] = None) -> bytes:
+    """
+    asyncio version of do_xdelta_chain()
+    """
+    import asyncio
+    import xdelta3_pure_py
+    run = functools.partial(xdelta3_pure_py.run_in_executor_to_completion,
+        asyncio.get_running_loop(), executor)
+
+    patches = [Patches.get(key) for key in chain]
+    total = sum(len(patch) for patch in patches)
+    done = 0
+
+    for i, (key, patch) in enumerate(zip(chain, patches)):
+        if i > 0 and (await run(hashlib.md5, base)).hexdigest() != key:
+            raise RuntimeError(f'Intermediate ROM (step {i}) is incorrect')
+
+        if progress is None:
+            step_progress = None
+        else:
+            step_progress = lambda d, t, done=done: progress(done + d, total)
+
+        base = await do_xdelta_async(base, patch, executor, step_progress)
+
+        done += len(patch)
+        if progress is not None:
+            progress(done, total)
+
+    return base
+
+
+async def patch_rom_single_async(in_filepath: Path, out_filepath: Path,
+        cache: 'Optional[output_cache.OutputCache]' = None,
+        executor: 'Optional[concurrent.futures.Executor]' = None,
+        progress: Optional[Callable[[int, int], None]] = None) -> None:
+    """
+    asyncio version of patch_rom_single(). See do_xdelta_async() for
+    details about the executor and cancellation.
+    """
+    import asyncio
+    import xdelta3_pure_py
+    run = functools.partial(xdelta3_pure_py.run_in_executor_to_completion,
+        asyncio.get_running_loop(), executor)
+
+    with await run(NormalizedRom, in_filepath) as original_rom:
+        md5 = (await run(original_rom.md5)).hexdigest()
+
+    chain = get_patch_chain(md5)
+
+    if cache is not None:
+        cache_key = cache.make_key(md5, get_patch_chain_md5(chain))
+        if await run(cache.get, cache_key, out_filepath):
+            return
+
+    with await run(NormalizedRom, in_filepath) as original_rom:
+        newer_ds = await do_xdelta_chain_async(original_rom, chain, executor, progress)
+
+    await run(check_and_save_output, newer_ds, out_filepath)
+
+    if cache is not None:
+        await run(cache.put, cache_key, newer_ds)
+
+
+async def patch_rom_async(in_filepath: Path, out_filepath: Path,
+        cache: 'Optional[output_cache.OutputCache]' = None,
+        executor: 'Optional[concurrent.futures.Executor]' = None,
+        progress: Optional[Callable[[int, int], None]] = None) -> None:
+    """
+    asyncio version of patch_rom(). Cancellation is never retried.
+    """
+    for attempt in range(1, 3):
+        try:
+            return await patch_rom_single_async(in_filepath, out_filepath, cache, executor, progress)
+        except Exception as e:
+            telemetry.event('patch_rom_async.retry', attempt=attempt, error=repr(e))
+
+    return await patch_rom_single_async(in_filepath, out_filepath, cache, executor, progress)
+
+
+def have_required_files() -> bool:
+    """
+    Check if all required files are present.
+    """
+    data_dir = DataDir
+
+    try:
+        # (One directory listing is cheaper than a dozen stat() calls)
+        present = {entry.name for entry in os.scandir(data_dir) if entry.is_file()}
+    except OSError:
+        return False
+
+    if Patches is None:
+        return False
+
+    if len(Patches) != Info['patchesRequired']:
+        return False
+
+    data_files = [
+        'info.json',
+        'icon-16.png',
+        'icon-24.png',
+        'icon-32.png',
+        'icon-48.png',
+        'icon-64.png',
+        'icon-128.png',
+        'icon.ico',
+        'logo.png',
+        'watermark.png',
+        'xdelta3.exe',
+        PATCH_BUNDLE_FILENAME]
+
+    return present.issuperset(data_files)
+
+
+def load_data(data_dir: Path) -> None:
+    """
+    Load info.json into the Info global, and memory-map the patch bundle
+    into the Patches global (or set it to None if it can't be loaded).
+    info.json must exist.
+    """
+    global Info
+    with (data_dir / 'info.json').open('r', encoding='utf-8') as f:
+        Info = json.load(f)
+
+    # Memory-map the patch bundle. It stays mapped for the lifetime of
+    # the program, so looking up a patch later is just a dict lookup
+    global Patches
+    try:
+        Patches = patch_bundle.PatchBundle(data_dir / PATCH_BUNDLE_FILENAME)
+    except (OSError, ValueError):
+        Patches = None
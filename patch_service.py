@@ -0,0 +1,313 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+from pathlib import Path
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+import output_cache
+import patch_client
+import patch_core
+import telemetry
+import xdelta3_pure_py
+
+
+# A long-running local patching service, for batch jobs that would
+# otherwise pay for starting up the whole program (imports, loading
+# info.json and the patch bundle, ...) once per ROM.
+#
+# The protocol is described in patch_client.py.
+#
+# Jobs run on a fixed-size pool of worker threads. Note that the
+# pure-Python backend holds the GIL, so it only really benefits from one
+# worker; the xdelta3 module and xdelta3.exe backends don't.
+#
+# With --resumable, jobs always use the pure-Python backend, with
+# checkpoints: if the service is killed partway through a job, sending
+# the same job again (to a new instance) continues from the last
+# checkpoint.
+#
+# With --in-place, jobs whose output path is their input ROM overwrite
+# it directly (see inplace_patch.py) instead of building the whole
+# output in memory first. Those are crash-safe the same way.
+
+
+class PatchService:
+    """
+    Schedules patching jobs onto a bounded pool of worker threads
+    """
+    cache: Optional[output_cache.OutputCache]
+
+    def __init__(self, workers: int, cache: Optional[output_cache.OutputCache] = None,
+            resumable: bool = False, in_place: bool = False):
+        self.cache = cache
+        self.resumable = resumable
+        self.in_place = in_place
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='patch-worker')
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.jobs_queued = 0
+        self.jobs_running = 0
+        self.jobs_finished = 0
+        self.jobs_failed = 0
+
+    def submit(self, in_fp: Path, out_fp: Path,
+            send: Callable[[dict], None]) -> concurrent.futures.Future:
+        """
+        Queue a job, reporting events for it through send()
+        """
+        with self._lock:
+            self.jobs_queued += 1
+        send({'event': 'queued'})
+        return self._executor.submit(self._run_job, in_fp, out_fp, send)
+
+    def _run_job(self, in_fp: Path, out_fp: Path, send: Callable[[dict], None]) -> None:
+        with self._lock:
+            self.jobs_queued -= 1
+            self.jobs_running += 1
+        send({'event': 'started'})
+
+        start_time = time.perf_counter()
+        try:
+            patch_core.patch_rom(in_fp, out_fp, self.cache,
+                lambda done, total: send({'event': 'progress', 'done': done, 'total': total}),
+                self.resumable, self.in_place)
+
+        except Exception as e:
+            with self._lock:
+                self.jobs_running -= 1
+                self.jobs_failed += 1
+            send({'event': 'failed', 'error': f'{type(e).__name__}: {e}'})
+
+        else:
+            with self._lock:
+                self.jobs_running -= 1
+                self.jobs_finished += 1
+            send({'event': 'finished', 'seconds': time.perf_counter() - start_time})
+
+    def get_stats(self) -> dict:
+        """
+        Return a JSON-compatible dict of statistics about the service
+        """
+        with self._lock:
+            stats = {
+                'workers': self.workers,
+                'jobsQueued': self.jobs_queued,
+                'jobsRunning': self.jobs_running,
+                'jobsFinished': self.jobs_finished,
+                'jobsFailed': self.jobs_failed,
+            }
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats.as_dict()
+        return stats
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+class PatchRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a single client connection
+    """
+    def setup(self) -> None:
+        super().setup()
+        self._send_lock = threading.Lock()
+
+    def send(self, message: dict) -> None:
+        """
+        Send an event to the client. Safe to call from worker threads.
+        """
+        with self._send_lock:
+            try:
+                self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                # The client went away; the job carries on regardless
+                pass
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            request = json.loads(line)
+            command = request['command']
+        except (ValueError, KeyError, TypeError):
+            self.send({'event': 'failed', 'error': 'Malformed request'})
+            return
+
+        service = self.server.service
+
+        if command == 'patch':
+            try:
+                in_fp = Path(request['input'])
+                out_fp = Path(request['output'])
+            except (KeyError, TypeError):
+                self.send({'event': 'failed', 'error': 'Missing input or output path'})
+                return
+
+            if not (in_fp.is_absolute() and out_fp.is_absolute()):
+                self.send({'event': 'failed', 'error': 'Paths must be absolute'})
+                return
+
+            service.submit(in_fp, out_fp, self.send).result()
+
+        elif command == 'stats':
+            self.send({'event': 'stats', **service.get_stats()})
+
+        else:
+            self.send({'event': 'failed', 'error': f'Unknown command: {command}'})
+
+
+class PatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, service: PatchService):
+        self.service = service
+        super().__init__(str(socket_path), PatchRequestHandler)
+
+
+def remove_stale_socket(socket_path: Path) -> None:
+    """
+    Delete a socket left behind by a service that didn't shut down
+    cleanly. Raises RuntimeError if the path is something else, or if a
+    service is still listening on it.
+    """
+    try:
+        mode = socket_path.lstat().st_mode
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(mode):
+        raise RuntimeError(f'{socket_path} already exists, and is not a socket')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except ConnectionRefusedError:
+            socket_path.unlink()
+            return
+
+    raise RuntimeError(f'Another patch service is already listening on {socket_path}')
+
+
+def serve(socket_path: Path, workers: int,
+        cache: Optional[output_cache.OutputCache] = None, resumable: bool = False,
+        in_place: bool = False, data_dir: Optional[Path] = None,
+        on_ready: Optional[Callable[[PatchServer], None]] = None) -> None:
+    """
+    Load everything up front, and then serve requests until interrupted,
+    or until server.shutdown() is called. on_ready, if provided, is
+    called with the server once it's listening.
+
+    data_dir defaults to the program's own data folder. Any other one
+    (for testing, say) only needs info.json and the patch bundle.
+    """
+    # xdelta3.exe is always the one in the program's own data folder.
+    # (The service can be started from anywhere, or embedded, so this
+    # can't rely on the working directory like the wizard does.)
+    patch_core.DataDir = Path(__file__).resolve().parent / 'data'
+
+    if data_dir is None:
+        patch_core.load_data(patch_core.DataDir)
+        if not patch_core.have_required_files():
+            raise RuntimeError('Some required files in the data folder are missing')
+    else:
+        patch_core.load_data(data_dir)
+        if patch_core.Patches is None:
+            raise RuntimeError('The patch bundle is missing')
+
+    # Warm everything up: this pulls every patch into the page cache
+    # (and checks them while we're at it), and builds the VCDIFF code
+    # table that every job will share
+    if not patch_core.Patches.verify():
+        raise RuntimeError('The patch bundle is corrupted')
+    xdelta3_pure_py.VCDIFFCodeTable.default()
+
+    remove_stale_socket(socket_path)
+
+    service = PatchService(workers, cache, resumable, in_place)
+    with PatchServer(socket_path, service) as server:
+        print(f'Listening on {socket_path} with {workers} worker(s)', flush=True)
+        if on_ready is not None:
+            on_ready(server)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.shutdown()
+            socket_path.unlink()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Local Newer DS patching service. See patch_client.py '
+        'for the client.')
+    parser.add_argument('--socket', type=Path, default=patch_client.DEFAULT_SOCKET_PATH,
+        help=f'socket path (default: {patch_client.DEFAULT_SOCKET_PATH})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+        help='number of jobs to run at once (default: number of CPUs)')
+    parser.add_argument('--cache-dir', type=Path,
+        help='keep a cache of patched ROMs in this folder')
+    parser.add_argument('--cache-size', type=int, default=1024,
+        help='maximum size of the cache, in MiB (default: 1024)')
+    parser.add_argument('--resumable', action='store_true',
+        help='checkpoint patching next to the output files, so that a job that '
+        'was interrupted (or is retried) continues where it left off')
+    parser.add_argument('--in-place', action='store_true',
+        help='patch ROMs in place (crash-safely) for jobs whose output path is their input path')
+    parser.add_argument('--telemetry-log', type=Path,
+        help='append per-phase timing and memory records to this file, as JSON lines')
+    parser.add_argument('--tracemalloc', action='store_true',
+        help='include Python memory allocation peaks in the telemetry (slow)')
+    args = parser.parse_args(argv)
+
+    if args.telemetry_log is not None:
+        telemetry.enable(telemetry.json_lines_sink(args.telemetry_log.resolve()), args.tracemalloc)
+    else:
+        telemetry.enable_from_environment()
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = output_cache.OutputCache(args.cache_dir.resolve(), args.cache_size * 0x100000)
+
+    try:
+        serve(args.socket.resolve(), args.workers, cache, args.resumable, args.in_place)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
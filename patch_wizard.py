@@ -37,22 +37,15 @@ along with Newer DS Patch Wizard.  If not, see
 PATCHER_VERSION = '1.03'
 
 
-import enum
-import hashlib
-import io
-import json
+import functools
 from pathlib import Path
-import subprocess
 import sys
+from typing import Optional
 
 from PyQt5 import QtCore, QtGui, QtWidgets; Qt = QtCore.Qt
 
-try:
-    import xdelta3
-except Exception:
-    xdelta3 = None
-
-import xdelta3_pure_py
+import patch_core
+import telemetry
 
 
 WINDOW_TITLE = 'Newer Super Mario Bros. DS Patch Wizard'
@@ -109,6 +102,12 @@ CHOOSE_ROM_STATUS_UNIDENTIFIED = (a + "This doesn't seem to be a "
     '<i>New Super Mario Bros.</i> ROM file.' + b)
 CHOOSE_ROM_STATUS_UNSUPPORTED = (a + "Unfortunately, this isn't a "
     'supported <i>New Super Mario Bros.</i> ROM file.' + b)
+CHOOSE_ROM_STATUS_UPGRADABLE = ('<small>This is an older version of '
+    '<i>Newer Super Mario Bros. DS</i>. It will be upgraded to version '
+    'GAME_VERSION.</small>')
+CHOOSE_ROM_STATUS_INTERRUPTED = ('<small>Patching this ROM file in place '
+    'was interrupted. Choose it as the output file as well, to finish '
+    'patching it.</small>')
 
 CHOOSE_OUTPUT_HEADER = 'Select output ROM file'
 CHOOSE_OUTPUT_TEXT = """
@@ -125,6 +124,9 @@ CHOOSE_OUTPUT_STATUS_NONE = (a + 'Please enter a file path.' + b)
 CHOOSE_OUTPUT_STATUS_INVALID = (a + "This doesn't seem to be a valid "
     'file path to save to.' + b)
 CHOOSE_OUTPUT_STATUS_EXISTS = "<small>This file already exists.</small>"
+CHOOSE_OUTPUT_STATUS_IN_PLACE = ('<small>This is your <i>New Super Mario '
+    'Bros.</i> ROM file. It will be patched in place, and the original will '
+    'be overwritten.</small>')
 
 CONFIRMATION_HEADER = 'Please confirm'
 CONFIRMATION_TEXT = """
@@ -145,7 +147,6 @@ FINISHED_TEXT_SUCCESS = 'All done! We hope you enjoy the game.'
 FINISHED_HEADER_FAILURE = 'Errors occurred'
 FINISHED_TEXT_FAILURE = 'Some errors occurred during patching — please try again. If this error continues to occur, email the traceback below to admin@newerteam.com.'
 
-NUM_PATCHES_REQUIRED = 10
 ERROR_MISSING_FILES_TITLE = 'Missing files'
 ERROR_MISSING_FILES_TEXT = 'Some required files seem to be missing. Please re-extract the zip file you downloaded and try again. If this continues to happen, redownload the zip file.'
 
@@ -159,185 +160,14 @@ del a, b
 
 
 
-class RomFileStatus(enum.Enum):
-    """
-    The return type of classify_file(). Represents all possible scenarios
-    for a given rom filename.
-    """
-    EMPTY            = 0  # Filename is empty or all whitespace
-    NOT_FULL_PATH    = 1  # Filename is not complete (no slashes)
-    NONEXISTENT      = 2  # No such file exists
-    NOT_A_ROM        = 3  # File exists, but doesn't look like a DS rom
-    UNIDENTIFIED_ROM = 4  # File is a DS rom, but not NSMB
-    UNSUPPORTED_ROM  = 5  # File is a NSMB rom, but not one we can patch
-    VALID_ROM        = 6  # File is a patchable NSMB rom
-
-
-
-
-def file_md5(fn: Path) -> 'hashlib hash object':
-    """
-    Calculate the MD5 hash of the file with the given filename, using a
-    method that is efficient even for large files.
-    Return the hashlib hash object.
-    """
-    # https://stackoverflow.com/a/22058673
-
-    BUF_SIZE = 65536
-
-    md5 = hashlib.new('md5')
-
-    with fn.open('rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            md5.update(data)
-
-    return md5
-
-
-
-def classify_file(fn: str) -> RomFileStatus:
-    """
-    Given a file path (string -- could be arbitrarily invalid as a file
-    path), return a RomFileStatus representing whether or not it points
-    to a patchable rom file.
-
-    This function should run very quickly even for very large files.
-    """
-    if not fn.strip():
-        return RomFileStatus.EMPTY
-
-    try:
-        fn = Path(fn)
-    except Exception:
-        return RomFileStatus.NONEXISTENT
-
-    if not fn.is_absolute():
-        return RomFileStatus.NOT_FULL_PATH
-
-    if not fn.is_file():
-        return RomFileStatus.NONEXISTENT
-
-    with fn.open('rb') as f:
-        first_200 = f.read(0x200)
-
-    if len(first_200) < 0x200:
-        # Unless it's "The Smallest NDS File"...
-        return RomFileStatus.NOT_A_ROM
-
-    # Padding area -- empty in all games I checked
-    if any(first_200[0x15:0x1C]):
-        return RomFileStatus.NOT_A_ROM
-
-    # Check the Nintendo logo
-    if (hashlib.sha256(first_200[0xC0:0x15D]).hexdigest() !=
-            'a07b35ac13a40de9682fc24b4ded05b717da632fb621253e38cafec5471a1cce'):
-        return RomFileStatus.NOT_A_ROM
-
-    # Check for the NSMB rom name and game code (excluding region)
-    if first_200[:15] != b'NEW MARIO\0\0\0A2D':
-        return RomFileStatus.UNIDENTIFIED_ROM
-
-    # If we made it this far, it's probably a NSMB rom.
-    # Hash the whole file and check if it's one we have an xdelta for.
-    xdelta_filename = Path('.') / 'data' / 'patches' / (file_md5(fn).hexdigest() + '.xdelta')
-    if xdelta_filename.is_file():
-        return RomFileStatus.VALID_ROM
-    else:
-        return RomFileStatus.UNSUPPORTED_ROM
-
-
-def do_xdelta(base: bytes, patch: bytes) -> bytes:
-    """
-    Perform an xdelta patch using the best available technique.
-    """
-    # If the xdelta3 module is installed, use that
-    if xdelta3 is not None:
-        try:
-            return xdelta3.decode(base, patch)
-        except Exception:
-            pass
-
-    # Otherwise, try to run the xdelta3.exe program instead
-    temp_base_fp = Path('.') / 'data' / 'temp1.bin'
-    temp_patch_fp = Path('.') / 'data' / 'temp2.bin'
-    temp_out_fp = Path('.') / 'data' / 'temp3.bin'
-    temp_base_fp.write_bytes(base)
-    temp_patch_fp.write_bytes(patch)
-
-    try:
-        command = ['xdelta3.exe', '-d', '-s', temp_base_fp.name, temp_patch_fp.name, temp_out_fp.name]
-        if sys.platform == 'win32':
-            subprocess.call(command, shell=True, cwd='data')
-        else:
-            # gulp
-            command.insert(0, 'wine')
-            subprocess.call(command, cwd='data')
-
-        return temp_out_fp.read_bytes()
-
-    except Exception:
-        pass
-
-    finally:
-        temp_base_fp.unlink()
-        temp_patch_fp.unlink()
-        try:
-            temp_out_fp.unlink()
-        except Exception:
-            pass
-
-    # If that still didn't work, use the bundled pure-Python VCDIFF
-    # implementation as a last resort
-    out_file_obj = io.BytesIO()
-    xdelta3_pure_py.apply_vcdiff(io.BytesIO(base), io.BytesIO(patch), out_file_obj)
-    out_file_obj.seek(0)
-    return out_file_obj.read()
-
-
-
-def patch_rom_single(in_filepath: Path, out_filepath: Path) -> bytes:
-    """
-    The rest of the program exists as a fancy wrapper for this function.
-    """
-    original_rom = in_filepath.read_bytes()
-
-    md5 = hashlib.md5(original_rom).hexdigest()
-
-    xdelta_filename = Path('.') / 'data' / 'patches' / (md5 + '.xdelta')
-    patch = xdelta_filename.read_bytes()
-
-    newer_ds = do_xdelta(original_rom, patch)
-
-    # Check that the patch was applied properly
-    if hashlib.md5(newer_ds).hexdigest() != Info['outputHash']:
-        raise RuntimeError('Patched output file is incorrect')
-
-    out_filepath.write_bytes(newer_ds)  # yay
-
-    # Check that the thing actually saved correctly
-    if out_filepath.read_bytes() != newer_ds:
-        raise RuntimeError('Unable to save to the output filepath specified')
-
-
-def patch_rom(in_filepath: Path, out_filepath: Path) -> bytes:
+def is_same_file(a: Path, b: Path) -> bool:
     """
-    Try to patch three times; if it still doesn't work, let the error
-    propogate.
+    Check if two paths both exist and refer to the same file
     """
     try:
-        return patch_rom_single(in_filepath, out_filepath)
-    except Exception:
-        pass
-
-    try:
-        return patch_rom_single(in_filepath, out_filepath)
-    except Exception:
-        pass
-
-    return patch_rom_single(in_filepath, out_filepath)
+        return a.samefile(b)
+    except OSError:
+        return False
 
 
 
@@ -352,7 +182,7 @@ def create_welcome_page(wizard: QtWidgets.QWizard) -> QtWidgets.QWizardPage:
     # Welcome text label
     label = QtWidgets.QLabel(page)
     label.setWordWrap(True)
-    label.setText(WELCOME_TEXT.replace('GAME_VERSION', Info['gameVersion']))
+    label.setText(WELCOME_TEXT.replace('GAME_VERSION', patch_core.Info['gameVersion']))
 
     # Layout
     L = QtWidgets.QVBoxLayout(page)
@@ -420,25 +250,34 @@ class ChooseRomPage(QtWidgets.QWizardPage):
         """
         Return True if a valid rom has been chosen, or False otherwise
         """
-        result = classify_file(self.wizard().choose_rom_line_edit.text())
+        result = patch_core.classify_file(self.wizard().choose_rom_line_edit.text())
 
         bad_results = {
-            RomFileStatus.EMPTY: CHOOSE_ROM_STATUS_NONE,
-            RomFileStatus.NOT_FULL_PATH: CHOOSE_ROM_STATUS_NOT_FULL_PATH,
-            RomFileStatus.NONEXISTENT: CHOOSE_ROM_STATUS_NONEXISTENT,
-            RomFileStatus.NOT_A_ROM: CHOOSE_ROM_STATUS_NOT_A_ROM,
-            RomFileStatus.UNIDENTIFIED_ROM: CHOOSE_ROM_STATUS_UNIDENTIFIED,
-            RomFileStatus.UNSUPPORTED_ROM: CHOOSE_ROM_STATUS_UNSUPPORTED,
+            patch_core.RomFileStatus.EMPTY: CHOOSE_ROM_STATUS_NONE,
+            patch_core.RomFileStatus.NOT_FULL_PATH: CHOOSE_ROM_STATUS_NOT_FULL_PATH,
+            patch_core.RomFileStatus.NONEXISTENT: CHOOSE_ROM_STATUS_NONEXISTENT,
+            patch_core.RomFileStatus.NOT_A_ROM: CHOOSE_ROM_STATUS_NOT_A_ROM,
+            patch_core.RomFileStatus.UNIDENTIFIED_ROM: CHOOSE_ROM_STATUS_UNIDENTIFIED,
+            patch_core.RomFileStatus.UNSUPPORTED_ROM: CHOOSE_ROM_STATUS_UNSUPPORTED,
         }
 
         if result in bad_results:
             self.wizard().choose_rom_status_label.setText(bad_results[result])
             return False
 
-        elif result == RomFileStatus.VALID_ROM:
+        elif result == patch_core.RomFileStatus.VALID_ROM:
             self.wizard().choose_rom_status_label.setText('')
             return True
 
+        elif result == patch_core.RomFileStatus.UPGRADABLE_ROM:
+            self.wizard().choose_rom_status_label.setText(
+                CHOOSE_ROM_STATUS_UPGRADABLE.replace('GAME_VERSION', patch_core.Info['gameVersion']))
+            return True
+
+        elif result == patch_core.RomFileStatus.INTERRUPTED_ROM:
+            self.wizard().choose_rom_status_label.setText(CHOOSE_ROM_STATUS_INTERRUPTED)
+            return True
+
         # Should never reach here
         self.wizard().choose_rom_status_label.setText('ERROR: UNKNOWN FILE STATUS')
         return False
@@ -539,7 +378,10 @@ class ChooseOutputPage(QtWidgets.QWizardPage):
                 return False
 
             if fn.is_file():
-                w.choose_output_status_label.setText(CHOOSE_OUTPUT_STATUS_EXISTS)
+                if is_same_file(fn, Path(w.choose_rom_line_edit.text())):
+                    w.choose_output_status_label.setText(CHOOSE_OUTPUT_STATUS_IN_PLACE)
+                else:
+                    w.choose_output_status_label.setText(CHOOSE_OUTPUT_STATUS_EXISTS)
                 return True  # This case is just a warning, not an error
 
             w.choose_output_status_label.setText('')
@@ -547,7 +389,10 @@ class ChooseOutputPage(QtWidgets.QWizardPage):
 
         else:
             if fn.is_file():
-                w.choose_output_status_label.setText(CHOOSE_OUTPUT_STATUS_EXISTS)
+                if is_same_file(fn, Path(w.choose_rom_line_edit.text())):
+                    w.choose_output_status_label.setText(CHOOSE_OUTPUT_STATUS_IN_PLACE)
+                else:
+                    w.choose_output_status_label.setText(CHOOSE_OUTPUT_STATUS_EXISTS)
                 return True  # This case is just a warning, not an error
 
             w.choose_output_status_label.setText('')
@@ -635,7 +480,7 @@ class FinishedPage(QtWidgets.QWizardPage):
 
         success = True
         try:
-            result = patch_rom(in_fp, out_fp)
+            patch_core.patch_rom(in_fp, out_fp, in_place=is_same_file(in_fp, out_fp))
         except Exception as e:
             success = False
 
@@ -663,71 +508,78 @@ class FinishedPage(QtWidgets.QWizardPage):
             self.wizard().finished_tracebackBox.hide()
 
 
-def have_required_files() -> bool:
+
+@functools.lru_cache(maxsize=None)
+def load_pixmap(fp: Path) -> QtGui.QPixmap:
     """
-    Check if all required files are present.
+    Load a pixmap, or return the already-loaded one
     """
-    data_dir = Path('data')
-
-    if not data_dir.is_dir():
-        return False
+    return QtGui.QPixmap(str(fp))
 
-    if not (data_dir / 'patches').is_dir():
-        return False
 
-    if len(list((data_dir / 'patches').iterdir())) != Info['patchesRequired']:
-        return False
+def set_page_pixmaps(wizard: QtWidgets.QWizard, data_dir: Path, id: int) -> None:
+    """
+    Give a wizard page its logo and watermark pixmaps, if it doesn't
+    have them yet. This is done as each page is first shown, rather than
+    for every page up front, so that decoding the images doesn't hold up
+    the wizard appearing.
+    """
+    page = wizard.page(id)
+    if page is None or getattr(page, 'pixmaps_set', False):
+        return
 
-    data_files = [
-        'info.json',
-        'icon-16.png',
-        'icon-24.png',
-        'icon-32.png',
-        'icon-48.png',
-        'icon-64.png',
-        'icon-128.png',
-        'icon.ico',
-        'logo.png',
-        'watermark.png',
-        'xdelta3.exe']
-
-    if not all((data_dir / fn).is_file() for fn in data_files):
-        return False
+    page.setPixmap(wizard.LogoPixmap, load_pixmap(data_dir / 'logo.png'))
+    page.setPixmap(wizard.WatermarkPixmap, load_pixmap(data_dir / 'watermark.png'))
+    # (Only macOS-style wizards use the background pixmap)
+    if wizard.wizardStyle() == wizard.MacStyle:
+        page.setPixmap(wizard.BackgroundPixmap, load_pixmap(data_dir / 'watermark.png'))
+    page.pixmaps_set = True
 
-    return True
 
+def create_application() -> QtWidgets.QApplication:
+    """
+    Create the QApplication
+    """
+    # We want to disable Qt.WindowContextHelpButtonHint on the wizard.
+    # Since Qt 5.10, that can be done application-wide, before any
+    # windows are created.
+    if hasattr(Qt, 'AA_DisableWindowContextHelpButton'):
+        QtWidgets.QApplication.setAttribute(Qt.AA_DisableWindowContextHelpButton)
 
-def main() -> None:
-    global app
-    app = QtWidgets.QApplication(sys.argv)
+    return QtWidgets.QApplication(sys.argv)
 
-    data_dir = Path('data')
 
+def create_wizard(data_dir: Path) -> Optional[QtWidgets.QWizard]:
+    """
+    Load the data files, and create the wizard (but don't show it yet).
+    If files are missing, show an error message and return None.
+    """
     # Check if info.json exists like it should (since we need to load it
     # in order to check that the rest of the files exist)
     if not (data_dir / 'info.json').is_file():
         QtWidgets.QMessageBox.warning(None, ERROR_MISSING_FILES_TITLE,  ERROR_MISSING_FILES_TEXT)
+        return None
 
-    # Now we can load the latest version info
-    global Info
-    with (data_dir / 'info.json').open('r', encoding='utf-8') as f:
-        Info = json.load(f)
+    # Now we can load the latest version info, and the patches
+    patch_core.load_data(data_dir)
 
     # Now check that the rest of the required files are present
-    if not have_required_files():
+    if not patch_core.have_required_files():
         QtWidgets.QMessageBox.warning(None, ERROR_MISSING_FILES_TITLE,  ERROR_MISSING_FILES_TEXT)
-        return
+        return None
 
-    # We want to disable Qt.WindowContextHelpButtonHint on the wizard.
-    # Calling setWindowFlags after creation doesn't work properly -- it
-    # needs to be set in the constructor.
-    # So we need to know what the default flags for a wizard are, and
-    # then just disable that particular one.
+    if hasattr(Qt, 'AA_DisableWindowContextHelpButton'):
+        wizard = QtWidgets.QWizard(None)
+    else:
+        # On older Qt versions, the flag has to be removed in the
+        # constructor -- calling setWindowFlags after creation doesn't
+        # work properly. So we need to know what the default flags for a
+        # wizard are, and then just disable that particular one.
 
-    # This is kind of a hack, but it works fine
-    default_flags = QtWidgets.QWizard(None).windowFlags()
+        # This is kind of a hack, but it works fine
+        default_flags = QtWidgets.QWizard(None).windowFlags()
 
-    wizard = QtWidgets.QWizard(None, default_flags & ~Qt.WindowContextHelpButtonHint)
+        wizard = QtWidgets.QWizard(None, default_flags & ~Qt.WindowContextHelpButtonHint)
 
     wizard.addPage(create_welcome_page(wizard))
     wizard.addPage(ChooseRomPage(wizard))
@@ -735,21 +587,30 @@ def main() -> None:
     wizard.addPage(ConfirmationPage(wizard))
     wizard.addPage(FinishedPage(wizard))
 
-    logo_pixmap = QtGui.QPixmap(str(data_dir / 'logo.png'))
-    watermark_pixmap = QtGui.QPixmap(str(data_dir / 'watermark.png'))
-
-    for id in wizard.pageIds():
-        p = wizard.page(id)
-        p.setPixmap(wizard.LogoPixmap, logo_pixmap)
-        p.setPixmap(wizard.WatermarkPixmap, watermark_pixmap)
-        p.setPixmap(wizard.BackgroundPixmap, watermark_pixmap)
+    set_page_pixmaps(wizard, data_dir, wizard.startId())
+    wizard.currentIdChanged.connect(lambda id: set_page_pixmaps(wizard, data_dir, id))
 
+    # QIcon only loads the file for a size when it's actually needed
     icon = QtGui.QIcon()
     for size in [16, 24, 32, 48, 64, 128]:
-        icon.addPixmap(QtGui.QPixmap(str(data_dir / ('icon-%d.png' % size))))
+        icon.addFile(str(data_dir / f'icon-{size}.png'), QtCore.QSize(size, size))
 
     wizard.setWindowTitle(WINDOW_TITLE)
     wizard.setWindowIcon(icon)
+
+    return wizard
+
+
+def main() -> None:
+    global app
+    app = create_application()
+
+    telemetry.enable_from_environment()
+
+    wizard = create_wizard(Path('data'))
+    if wizard is None:
+        return
+
     wizard.show()
 
     return app.exec_()
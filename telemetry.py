@@ -0,0 +1,263 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Optional phase-level timing and memory telemetry, for figuring out
+# which part of patching is slow (or failing) on someone's machine.
+#
+# Code marks phases with
+#
+#     with telemetry.phase('hash_output', bytes=len(data)) as record:
+#         ...
+#         record['backend'] = 'pure_py'  # (extra fields, if needed)
+#
+# and, once enabled, every finished phase is emitted as a dict to a sink
+# callback -- usually one that appends JSON lines to a log file. Each
+# record has at least:
+#
+# - "phase": the phase name
+# - "start": Unix timestamp of when the phase started
+# - "seconds": how long it took
+# - "ok": False if it raised an exception (then "error" says what)
+# - "thread": the name of the thread it ran on
+#
+# plus "peakTracedBytes" (the peak Python memory allocated during the
+# phase) if tracemalloc tracing is on, "peakRssBytes" (the process's
+# peak RSS so far) where the OS can report it, and whatever fields the
+# code added.
+#
+# Both are process-wide, so take them with a grain of salt:
+#
+# - tracemalloc only has one peak for the whole process, which every
+#   phase resets. So "peakTracedBytes" is left out of any phase that
+#   overlapped with a phase on another thread (the fan-out workers or
+#   the patch service's jobs, say), and even then it includes whatever
+#   other threads allocated without being in a phase.
+# - "peakRssBytes" is the peak over the process's whole lifetime, not
+#   the phase's own. A phase only raised it if it's higher than in the
+#   records before it.
+#
+# Telemetry is off by default, in which case phase() just returns a
+# shared do-nothing context manager.
+
+
+ENV_VAR = 'NEWERDS_PATCH_LOG'
+
+
+class _NullPhase:
+    """Context manager for phases while telemetry is disabled"""
+    def __enter__(self) -> dict:
+        return {}
+
+    def __exit__(self, *args) -> None:
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    """Context manager that times one phase and emits a record for it"""
+    def __init__(self, recorder: 'Recorder', name: str, fields: dict):
+        self.recorder = recorder
+        self.record = {'phase': name, **fields}
+
+    def __enter__(self) -> dict:
+        self.record['start'] = time.time()
+        self.child_peak = 0
+        self.overlapped = False
+        if self.recorder.trace_memory:
+            self.recorder._stack().append(self)
+            self.recorder._open_traced_phase(self)
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        record = self.record
+        record['seconds'] = time.perf_counter() - self._start
+        record['ok'] = exc_type is None
+        if exc_type is not None:
+            record['error'] = f'{exc_type.__name__}: {exc_value}'
+        record['thread'] = threading.current_thread().name
+
+        if self.recorder.trace_memory:
+            # (Nested phases reset the tracemalloc peak, so take theirs
+            # into account too)
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            self.recorder._close_traced_phase(self)
+            if not self.overlapped:
+                record['peakTracedBytes'] = peak
+            stack = self.recorder._stack()
+            stack.pop()
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+
+        peak_rss = get_peak_rss()
+        if peak_rss is not None:
+            record['peakRssBytes'] = peak_rss
+
+        self.recorder.emit(record)
+
+
+class Recorder:
+    """
+    Sends phase records to a sink callback. The sink may be called from
+    any thread.
+    """
+    sink: Callable[[dict], None]
+    trace_memory: bool
+
+    def __init__(self, sink: Callable[[dict], None], trace_memory: bool = False):
+        self.sink = sink
+        self.trace_memory = trace_memory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._traced_phases = {}
+
+    def _stack(self) -> list:
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _open_traced_phase(self, phase: _Phase) -> None:
+        # (If phases on different threads overlap, they all reset the
+        # same tracemalloc peak, so none of their peaks can be trusted)
+        thread = threading.get_ident()
+        with self._lock:
+            if any(t != thread for t in self._traced_phases.values()):
+                for other in self._traced_phases:
+                    other.overlapped = True
+                phase.overlapped = True
+            self._traced_phases[phase] = thread
+
+    def _close_traced_phase(self, phase: _Phase) -> None:
+        with self._lock:
+            del self._traced_phases[phase]
+
+    def phase(self, name: str, **fields) -> _Phase:
+        return _Phase(self, name, fields)
+
+    def emit(self, record: dict) -> None:
+        try:
+            with self._lock:
+                self.sink(record)
+        except Exception:
+            # Telemetry must never break patching
+            pass
+
+
+_recorder = None
+
+
+def get_peak_rss() -> Optional[int]:
+    """
+    Return the peak RSS of this process so far, in bytes, or None if
+    the OS can't report it
+    """
+    if resource is None:
+        return None
+    # (ru_maxrss is in KiB, except on macOS, where it's in bytes)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def phase(name: str, **fields):
+    """
+    Return a context manager that records a phase with the given name
+    and fields, if telemetry is enabled. It yields the record dict, so
+    that more fields can be added during the phase.
+    """
+    if _recorder is None:
+        return _NULL_PHASE
+    return _recorder.phase(name, **fields)
+
+
+def event(name: str, **fields) -> None:
+    """
+    Record a single instantaneous event, if telemetry is enabled
+    """
+    if _recorder is not None:
+        _recorder.emit({'event': name, 'start': time.time(), **fields})
+
+
+def is_enabled() -> bool:
+    return _recorder is not None
+
+
+def enable(sink: Callable[[dict], None], trace_memory: bool = False) -> None:
+    """
+    Start sending phase records to sink. If trace_memory is True,
+    tracemalloc is started too (which slows Python code down
+    noticeably, so it's off by default).
+    """
+    global _recorder
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _recorder = Recorder(sink, trace_memory)
+
+
+def disable() -> None:
+    """Stop recording"""
+    global _recorder
+    if _recorder is not None and _recorder.trace_memory:
+        tracemalloc.stop()
+    _recorder = None
+
+
+def json_lines_sink(fp: Path) -> Callable[[dict], None]:
+    """
+    Return a sink that appends records to a file, as JSON lines
+    """
+    f = Path(fp).open('a', encoding='utf-8')
+
+    def sink(record: dict) -> None:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+    return sink
+
+
+def enable_from_environment() -> None:
+    """
+    Enable telemetry if the NEWERDS_PATCH_LOG environment variable is
+    set to a log file path. Memory tracing is enabled too if
+    NEWERDS_PATCH_LOG_TRACEMALLOC is set to 1.
+    """
+    log_fp = os.environ.get(ENV_VAR)
+    if log_fp:
+        enable(json_lines_sink(Path(log_fp)),
+            os.environ.get(ENV_VAR + '_TRACEMALLOC') == '1')
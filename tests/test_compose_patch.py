@@ -0,0 +1,134 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+import io
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import compose_patch
+import optimize_patch
+import xdelta3_pure_py
+
+
+def make_versions(seed: int, size: int = 0x30000) -> list:
+    """Make a few successive "versions" of a file, each edited from the last"""
+    rng = random.Random(seed)
+    versions = [rng.randbytes(size // 2) + bytes(size // 4) + rng.randbytes(8) * (size // 32)]
+    for _ in range(3):
+        data = bytearray(versions[-1])
+        for _ in range(30):
+            pos = rng.randrange(len(data) - 0x200)
+            kind = rng.random()
+            if kind < 0.4:
+                data[pos : pos + rng.randrange(1, 0x100)] = rng.randbytes(rng.randrange(0x100))
+            elif kind < 0.7:
+                data[pos : pos] = bytes([rng.randrange(256)]) * rng.randrange(1, 0x200)
+            else:
+                data[pos : pos] = data[:rng.randrange(1, 0x1000)]
+        shift = rng.randrange(len(data))
+        versions.append(bytes(data[shift:] + data[:shift]))
+    return versions
+
+
+def encode_pure_py(source: bytes, target: bytes) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.encode_vcdiff(source, target, out, window_size=0x8000)
+    return out.getvalue()
+
+
+def encode_xdelta3(source: bytes, target: bytes) -> bytes:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        (temp_dir / 'source').write_bytes(source)
+        (temp_dir / 'target').write_bytes(target)
+        subprocess.run(['xdelta3', '-e', '-f', '-W', str(0x8000),
+            '-s', str(temp_dir / 'source'), str(temp_dir / 'target'), str(temp_dir / 'patch')],
+            check=True)
+        return (temp_dir / 'patch').read_bytes()
+
+
+def decode(source: bytes, patch: bytes) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.apply_vcdiff(source, patch, out)
+    return out.getvalue()
+
+
+class ComposePatchTest(unittest.TestCase):
+
+    def check_composition(self, encode):
+        versions = make_versions(0)
+        patches = [encode(a, b) for a, b in zip(versions, versions[1:])]
+
+        for n in range(2, len(patches) + 1):
+            new_patch, target, counts = compose_patch.compose_patches(versions[0], patches[:n])
+            self.assertEqual(target, versions[n])
+            self.assertEqual(decode(versions[0], new_patch), versions[n])
+            self.assertEqual(compose_patch.apply_chain(versions[0], patches[:n]), versions[n])
+
+    def test_pure_py_patches(self):
+        self.check_composition(encode_pure_py)
+
+    @unittest.skipUnless(shutil.which('xdelta3'), 'xdelta3 is not installed')
+    def test_xdelta3_patches(self):
+        self.check_composition(encode_xdelta3)
+
+    def test_wrong_order(self):
+        versions = make_versions(1)
+        patches = [encode_pure_py(a, b) for a, b in zip(versions, versions[1:])]
+        with self.assertRaises(ValueError):
+            compose_patch.compose_patches(versions[0], [patches[1], patches[0]])
+        with self.assertRaises(ValueError):
+            compose_patch.compose_patches(versions[1], patches[:2])
+
+    def test_mismatch(self):
+        # (If composing ever goes wrong in a way the checksums can't
+        # catch -- here, there aren't any -- the comparison with applying
+        # the patches one at a time does)
+        versions = make_versions(2)
+        patches = []
+        for a, b in zip(versions, versions[1:]):
+            out = io.BytesIO()
+            xdelta3_pure_py.encode_vcdiff(a, b, out, adler32=False)
+            patches.append(out.getvalue())
+        real_build_target = compose_patch.build_target
+        def bad_build_target(source, ops):
+            target = real_build_target(source, ops)
+            target[0] ^= 1
+            return target
+        compose_patch.build_target = bad_build_target
+        try:
+            with self.assertRaises(optimize_patch.PatchMismatch):
+                compose_patch.compose_patches(versions[0], patches[:2])
+        finally:
+            compose_patch.build_target = real_build_target
+
+
+if __name__ == '__main__':
+    unittest.main()
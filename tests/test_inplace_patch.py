@@ -0,0 +1,189 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+import hashlib
+import io
+from pathlib import Path
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import inplace_patch
+import patch_bundle
+import patch_core
+import xdelta3_pure_py
+
+
+ROM_SIZE = 0x20000  # (the smallest chip capacity)
+ROM_USED_SIZE = 0x1C000
+WINDOW_SIZE = 0x4000
+
+
+def make_rom(seed: int) -> bytes:
+    """Make a small fake DS ROM, with 0xFF padding after its used area"""
+    rng = random.Random(seed)
+    header = bytearray(rng.randbytes(0x200))
+    header[0x14] = 0  # capacity: 0x20000 << 0
+    header[0x80:0x84] = ROM_USED_SIZE.to_bytes(4, 'little')
+    body = rng.randbytes(ROM_USED_SIZE - len(header))
+    return bytes(header) + body + b'\xFF' * (ROM_SIZE - ROM_USED_SIZE)
+
+
+def make_target(rom: bytes, seed: int) -> bytes:
+    """
+    Make a patched version of a ROM. It's shifted around, so that later
+    windows copy from parts of the ROM that earlier ones overwrite.
+    """
+    rng = random.Random(seed)
+    target = bytearray(rom[0x9000:ROM_USED_SIZE] + rom[:0x9000])
+    for _ in range(20):
+        pos = rng.randrange(len(target) - 0x100)
+        target[pos : pos + 0x80] = rng.randbytes(0x80)
+    return bytes(target)
+
+
+def make_patch(rom: bytes, target: bytes) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.encode_vcdiff(rom, target, out, window_size=WINDOW_SIZE)
+    return out.getvalue()
+
+
+class Crash(Exception):
+    """Stands in for the program being killed"""
+
+
+class InPlacePatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.rom_fp = Path(self.temp_dir.name) / 'game.nds'
+        self.rom = make_rom(0)
+        self.target = make_target(self.rom, 1)
+        self.patch = make_patch(self.rom, self.target)
+        self.rom_fp.write_bytes(self.rom)
+        self.real_write_record_file = inplace_patch._write_record_file
+
+    def tearDown(self):
+        inplace_patch._write_record_file = self.real_write_record_file
+        self.temp_dir.cleanup()
+
+    def start_journal(self) -> inplace_patch.Journal:
+        return inplace_patch.start_journal(self.rom_fp, self.patch,
+            hashlib.md5(self.rom).hexdigest(), len(self.rom), len(self.rom))
+
+    def assert_finished(self):
+        self.assertEqual(self.rom_fp.read_bytes(), self.target)
+        self.assertFalse(inplace_patch.journal_exists(self.rom_fp))
+        self.assertEqual([fp.name for fp in self.rom_fp.parent.iterdir()], [self.rom_fp.name])
+
+    def crash_at_window(self, crash_window: int, torn_write: bool) -> None:
+        # Crash while writing crash_window: either after its window
+        # record is saved and half of it is written to the ROM (as
+        # garbage), or before its window record is saved at all
+        def write_record_file(fp, magic, header, chunks):
+            if magic == inplace_patch.WINDOW_RECORD_MAGIC and header['windowIndex'] == crash_window:
+                if not torn_write:
+                    raise Crash
+                self.real_write_record_file(fp, magic, header, chunks)
+                with self.rom_fp.open('r+b') as f:
+                    f.seek(header['targetOffset'])
+                    f.write(bytes(len(chunks[0]) // 2))
+                raise Crash
+            self.real_write_record_file(fp, magic, header, chunks)
+
+        inplace_patch._write_record_file = write_record_file
+        journal = self.start_journal()
+        self.assertGreater(journal.saved_bytes, 0)
+        with self.assertRaises(Crash):
+            inplace_patch.patch_in_place(self.rom_fp, self.patch, journal)
+        inplace_patch._write_record_file = self.real_write_record_file
+
+        self.assertTrue(inplace_patch.journal_exists(self.rom_fp))
+        self.assertNotEqual(self.rom_fp.read_bytes(), self.rom)
+
+    def test_uninterrupted(self):
+        inplace_patch.patch_in_place(self.rom_fp, self.patch, self.start_journal())
+        self.assert_finished()
+
+    def test_resume(self):
+        num_windows = -(-len(self.target) // WINDOW_SIZE)
+        for crash_window in [1, num_windows // 2, num_windows - 1]:
+            for torn_write in [False, True]:
+                with self.subTest(crash_window=crash_window, torn_write=torn_write):
+                    self.rom_fp.write_bytes(self.rom)
+                    self.crash_at_window(crash_window, torn_write)
+
+                    journal = inplace_patch.load_journal(self.rom_fp)
+                    self.assertEqual(journal.source_md5, hashlib.md5(self.rom).hexdigest())
+                    inplace_patch.patch_in_place(self.rom_fp, self.patch, journal)
+                    self.assert_finished()
+
+    def test_resume_with_wrong_patch(self):
+        self.crash_at_window(2, True)
+        other_patch = make_patch(self.rom, make_target(self.rom, 2))
+        with self.assertRaises(ValueError):
+            inplace_patch.patch_in_place(self.rom_fp, other_patch, inplace_patch.load_journal(self.rom_fp))
+        self.assertTrue(inplace_patch.journal_exists(self.rom_fp))
+
+
+class PatchRomInPlaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.rom_fp = self.dir / 'game.nds'
+        self.rom = make_rom(0)
+        self.target = make_target(self.rom, 1)
+        self.rom_fp.write_bytes(self.rom)
+
+        rom_md5 = hashlib.md5(self.rom).hexdigest()
+        patch_bundle.build_bundle({rom_md5: make_patch(self.rom, self.target)}, self.dir / 'patches.bundle')
+        self.old_globals = patch_core.Info, patch_core.Patches
+        patch_core.Patches = patch_bundle.PatchBundle(self.dir / 'patches.bundle')
+
+    def tearDown(self):
+        patch_core.Info, patch_core.Patches = self.old_globals
+        self.temp_dir.cleanup()
+
+    def test_patch(self):
+        patch_core.Info = {'outputHash': hashlib.md5(self.target).hexdigest()}
+        self.assertTrue(patch_core.patch_rom_in_place(self.rom_fp))
+        self.assertEqual(self.rom_fp.read_bytes(), self.target)
+        self.assertFalse(inplace_patch.journal_exists(self.rom_fp))
+
+    def test_wrong_output_hash(self):
+        # The output is checked before anything is written, so the ROM
+        # must be left exactly as it was
+        patch_core.Info = {'outputHash': hashlib.md5(b'something else').hexdigest()}
+        with self.assertRaises(patch_core.InPlacePatchingFailed):
+            patch_core.patch_rom_in_place(self.rom_fp)
+        self.assertEqual(self.rom_fp.read_bytes(), self.rom)
+        self.assertFalse(inplace_patch.journal_exists(self.rom_fp))
+        self.assertEqual(sorted(fp.name for fp in self.dir.iterdir()), ['game.nds', 'patches.bundle'])
+
+
+if __name__ == '__main__':
+    unittest.main()
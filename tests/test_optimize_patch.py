@@ -0,0 +1,136 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+import io
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import optimize_patch
+import xdelta3_pure_py
+
+
+def make_source(seed: int, size: int = 0x40000) -> bytes:
+    """Random data, with some repetitive stretches and padding mixed in"""
+    rng = random.Random(seed)
+    out = bytearray()
+    while len(out) < size:
+        kind = rng.random()
+        if kind < 0.5:
+            out += rng.randbytes(rng.randrange(0x100, 0x2000))
+        elif kind < 0.8:
+            out += rng.randbytes(8) * rng.randrange(0x10, 0x100)
+        else:
+            out += bytes([rng.choice([0, 0xFF])]) * rng.randrange(0x100, 0x1000)
+    return bytes(out[:size])
+
+
+def make_target(source: bytes, seed: int) -> bytes:
+    """Edit and shuffle a source around a bit"""
+    rng = random.Random(seed)
+    target = bytearray(source)
+    for _ in range(40):
+        pos = rng.randrange(len(target) - 0x100)
+        kind = rng.random()
+        if kind < 0.4:
+            target[pos : pos + 0x40] = rng.randbytes(0x40)
+        elif kind < 0.7:
+            target[pos : pos] = bytes([rng.randrange(256)]) * rng.randrange(0x10, 0x100)
+        else:
+            del target[pos : pos + rng.randrange(1, 0x100)]
+    return bytes(target[0x3000:] + target[:0x3000])
+
+
+def decode(source: bytes, patch: bytes) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.apply_vcdiff(source, patch, out)
+    return out.getvalue()
+
+
+def read_ops(source: bytes, patch: bytes) -> list:
+    return optimize_patch.read_patch(source, patch)[0]
+
+
+class OptimizePatchTest(unittest.TestCase):
+
+    @unittest.skipUnless(shutil.which('xdelta3'), 'xdelta3 is not installed')
+    def test_xdelta3_patch(self):
+        source = make_source(0)
+        target = make_target(source, 1)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir = Path(temp_dir)
+            (temp_dir / 'source').write_bytes(source)
+            (temp_dir / 'target').write_bytes(target)
+            # (Small windows, so that there's something to re-window)
+            subprocess.run(['xdelta3', '-e', '-f', '-W', str(0x4000),
+                '-s', str(temp_dir / 'source'), str(temp_dir / 'target'), str(temp_dir / 'patch')],
+                check=True)
+            patch = (temp_dir / 'patch').read_bytes()
+
+        self.assertEqual(decode(source, patch), target)
+
+        for use_lzma in [False, True]:
+            new_patch, new_target, stats = optimize_patch.optimize_patch(source, patch, use_lzma=use_lzma)
+            self.assertEqual(new_target, target)
+            self.assertEqual(decode(source, new_patch), target)
+            self.assertLess(stats['after']['windows'], stats['before']['windows'])
+            self.assertLessEqual(len(read_ops(source, new_patch)), len(read_ops(source, patch)))
+
+    def test_merges(self):
+        source = make_source(2, 0x1000)
+        target = b'abc' + b'def' + b'f' * 100 + source[:100]
+        patch = io.BytesIO()
+        writer = xdelta3_pure_py.VCDIFFWriter(patch)
+        writer.write_window([
+            ('add', b'abc'),
+            ('add', b'def'),
+            ('tgt', 5, 100),  # (a RUN, really)
+            ('src', 0, 60),
+            ('src', 60, 40),
+        ], 0, target)
+        patch = patch.getvalue()
+        self.assertEqual(decode(source, patch), target)
+        self.assertEqual([op[0] for op in read_ops(source, patch)], ['add', 'add', 'tgt', 'src', 'src'])
+
+        new_patch, _, _ = optimize_patch.optimize_patch(source, patch)
+        self.assertEqual(decode(source, new_patch), target)
+        self.assertEqual(read_ops(source, new_patch),
+            [('add', b'abcdef'), ('run', ord('f'), 100), ('src', 0, 100)])
+
+    def test_mismatch(self):
+        source = make_source(3, 0x1000)
+        patch = io.BytesIO()
+        xdelta3_pure_py.encode_vcdiff(source, source[::-1], patch)
+        with self.assertRaises(optimize_patch.PatchMismatch):
+            optimize_patch.verify_patch(source, patch.getvalue(), source)
+
+
+if __name__ == '__main__':
+    unittest.main()
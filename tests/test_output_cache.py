@@ -0,0 +1,137 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import output_cache
+
+
+class OutputCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.cache = output_cache.OutputCache(self.dir / 'cache', 250)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_and_put(self):
+        key = output_cache.OutputCache.make_key('a' * 32, 'b' * 32)
+        out_fp = self.dir / 'out.nds'
+
+        self.assertFalse(self.cache.get(key, out_fp))
+        self.assertFalse(out_fp.exists())
+
+        self.cache.put(key, b'rom data')
+        self.assertIn(key, self.cache)
+        self.assertTrue(self.cache.get(key, out_fp))
+        self.assertEqual(out_fp.read_bytes(), b'rom data')
+
+        # (Over an existing output, too)
+        out_fp.write_bytes(b'something else, and longer')
+        self.assertTrue(self.cache.get(key, out_fp))
+        self.assertEqual(out_fp.read_bytes(), b'rom data')
+
+        stats = self.cache.stats.as_dict()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (2, 1, 1))
+        self.assertEqual(stats['bytesServed'], 16)
+        self.assertEqual(sum(stats['methods'].values()), 2)
+        self.assertEqual(list(self.cache.directory.glob('*.tmp')), [])
+
+    def test_evict(self):
+        keys = [output_cache.OutputCache.make_key(str(i) * 32, 'b' * 32) for i in range(3)]
+        now = time.time()
+        for i, key in enumerate(keys):
+            self.cache.put(key, bytes(100))
+            # (Entries are evicted by mtime, which can be too coarse to
+            # tell these apart otherwise)
+            os.utime(self.cache._path_for(key), (now - 100 + i, now - 100 + i))
+
+        # The oldest entry goes once the cache is over 250 bytes...
+        self.assertNotIn(keys[0], self.cache)
+        self.assertIn(keys[1], self.cache)
+        self.assertIn(keys[2], self.cache)
+        self.assertEqual(self.cache.stats.evictions, 1)
+
+        # ...and using an entry makes it the newest
+        self.assertTrue(self.cache.get(keys[1], self.dir / 'out.nds'))
+        self.cache.evict(100)
+        self.assertIn(keys[1], self.cache)
+        self.assertNotIn(keys[2], self.cache)
+
+    def test_get_over_hardlink(self):
+        # Getting an entry over an output that's already a hardlink to
+        # it (from an earlier hit) must not touch the entry
+        self.cache = output_cache.OutputCache(self.dir / 'cache', 1000, allow_hardlink=True)
+        key = output_cache.OutputCache.make_key('a' * 32, 'b' * 32)
+        self.cache.put(key, b'rom data')
+        out_fp = self.dir / 'out.nds'
+        os.link(self.cache._path_for(key), out_fp)
+
+        self.assertTrue(self.cache.get(key, out_fp))
+        self.assertEqual(out_fp.read_bytes(), b'rom data')
+        self.assertEqual(self.cache._path_for(key).read_bytes(), b'rom data')
+
+
+class CloneFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.src_fp = self.dir / 'src.nds'
+        self.src_fp.write_bytes(os.urandom(0x10000))
+        self.dst_fp = self.dir / 'dst.nds'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_clone(self):
+        for allow_hardlink in [False, True]:
+            self.dst_fp.write_bytes(b'old')
+            output_cache.clone_file(self.src_fp, self.dst_fp, allow_hardlink)
+            self.assertEqual(self.dst_fp.read_bytes(), self.src_fp.read_bytes())
+
+    def test_clone_over_hardlink(self):
+        data = self.src_fp.read_bytes()
+        os.link(self.src_fp, self.dst_fp)
+        for allow_hardlink in [False, True]:
+            output_cache.clone_file(self.src_fp, self.dst_fp, allow_hardlink)
+            self.assertEqual(self.src_fp.read_bytes(), data)
+            self.assertEqual(self.dst_fp.read_bytes(), data)
+
+    def test_missing_source(self):
+        with self.assertRaises(FileNotFoundError):
+            output_cache.clone_file(self.dir / 'missing.nds', self.dst_fp)
+        self.assertEqual(list(self.dir.iterdir()), [self.src_fp])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+
+import hashlib
+import io
+import os
+from pathlib import Path
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import patch_bundle
+import patch_core
+import telemetry
+import xdelta3_pure_py
+
+
+ROM_SIZE = 0x20000  # (the smallest chip capacity)
+WINDOW_SIZE = 0x4000
+
+
+def make_rom(seed: int) -> bytes:
+    """Make a small fake (untrimmed) DS ROM"""
+    rng = random.Random(seed)
+    header = bytearray(rng.randbytes(0x200))
+    header[0x14] = 0  # capacity: 0x20000 << 0
+    header[0x80:0x84] = ROM_SIZE.to_bytes(4, 'little')
+    return bytes(header) + rng.randbytes(ROM_SIZE - len(header))
+
+
+def corrupt(data: bytes, *offsets: int) -> bytes:
+    """Flip one byte at each of the given offsets"""
+    data = bytearray(data)
+    for offset in offsets:
+        data[offset] ^= 0xFF
+    return bytes(data)
+
+
+class DeltaWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.fp = self.dir / 'out.nds'
+        self.data = random.Random(0).randbytes(patch_core.DeltaWriter.BLOCK_SIZE * 8 + 123)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, chunk_size: int = 0x1234) -> int:
+        """Write self.data in chunks, and return how much was rewritten"""
+        with patch_core.DeltaWriter(self.fp) as writer:
+            for start in range(0, len(self.data), chunk_size):
+                writer.write(self.data[start : start + chunk_size])
+            self.assertEqual(writer.tell(), len(self.data))
+        return writer.bytes_rewritten
+
+    def test_new_file(self):
+        self.assertEqual(self.write(), len(self.data))
+        self.assertEqual(self.fp.read_bytes(), self.data)
+
+    def test_partially_correct(self):
+        B = patch_core.DeltaWriter.BLOCK_SIZE
+        self.fp.write_bytes(corrupt(self.data, 5, B * 3 + 7))
+        rewritten = self.write()
+        self.assertEqual(self.fp.read_bytes(), self.data)
+        self.assertLess(rewritten, len(self.data))
+        self.assertGreater(rewritten, 0)
+
+        # (Now that it's correct, nothing needs rewriting)
+        self.assertEqual(self.write(), 0)
+        self.assertEqual(self.fp.read_bytes(), self.data)
+
+    def test_wrong_length(self):
+        for existing in [self.data + b'extra', self.data[:-1000], b'']:
+            with self.subTest(existing_len=len(existing)):
+                self.fp.write_bytes(existing)
+                self.write()
+                self.assertEqual(self.fp.read_bytes(), self.data)
+
+    def test_hardlinked(self):
+        # The other link (a cache entry, say) must not be changed
+        other_fp = self.dir / 'cached.nds'
+        old_data = corrupt(self.data, 5)
+        other_fp.write_bytes(old_data)
+        os.link(other_fp, self.fp)
+
+        self.write()
+        self.assertEqual(self.fp.read_bytes(), self.data)
+        self.assertEqual(other_fp.read_bytes(), old_data)
+        self.assertEqual(self.fp.stat().st_nlink, 1)
+        self.assertEqual(other_fp.stat().st_nlink, 1)
+
+
+class CheckAndSaveOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.fp = self.dir / 'out.nds'
+        self.rom = make_rom(1)
+        self.old_info = patch_core.Info
+        patch_core.Info = {'outputHash': hashlib.md5(self.rom).hexdigest()}
+
+        self.records = []
+        telemetry.enable(self.records.append)
+
+    def tearDown(self):
+        telemetry.disable()
+        patch_core.Info = self.old_info
+        self.temp_dir.cleanup()
+
+    def rewritten_bytes(self) -> int:
+        [record] = [r for r in self.records if r.get('phase') == 'write_output']
+        self.records.clear()
+        return record['rewrittenBytes']
+
+    def test_partially_correct(self):
+        self.fp.write_bytes(corrupt(self.rom, 0x10000))
+        patch_core.check_and_save_output(self.rom, self.fp)
+        self.assertEqual(self.fp.read_bytes(), self.rom)
+        self.assertEqual(self.rewritten_bytes(), patch_core.DeltaWriter.BLOCK_SIZE)
+
+    def test_hardlinked(self):
+        other_fp = self.dir / 'cached.nds'
+        other_fp.write_bytes(corrupt(self.rom, 0x10000))
+        os.link(other_fp, self.fp)
+        patch_core.check_and_save_output(self.rom, self.fp)
+        self.assertEqual(self.fp.read_bytes(), self.rom)
+        self.assertEqual(other_fp.read_bytes(), corrupt(self.rom, 0x10000))
+
+    def test_incorrect(self):
+        # Nothing is written if the output is wrong
+        self.fp.write_bytes(b'old')
+        with self.assertRaises(patch_core.OutputIncorrect):
+            patch_core.check_and_save_output(corrupt(self.rom, 0), self.fp)
+        self.assertEqual(self.fp.read_bytes(), b'old')
+
+
+class RepairOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.rom_fp = self.dir / 'game.nds'
+        self.rom = make_rom(2)
+        self.rom_fp.write_bytes(self.rom)
+
+        rng = random.Random(3)
+        target = bytearray(self.rom[0x8000:] + self.rom[:0x8000])
+        for _ in range(20):
+            pos = rng.randrange(len(target) - 0x100)
+            target[pos : pos + 0x80] = rng.randbytes(0x80)
+        self.target = bytes(target)
+
+        out = io.BytesIO()
+        xdelta3_pure_py.encode_vcdiff(self.rom, self.target, out, window_size=WINDOW_SIZE)
+        self.key = hashlib.md5(self.rom).hexdigest()
+        patch_bundle.build_bundle({self.key: out.getvalue()}, self.dir / 'patches.bundle')
+
+        # (repair_output() only needs the digests, not a real NitroFS)
+        digests = [[f'region{i}', start, 0x2000, hashlib.md5(self.target[start : start + 0x2000]).hexdigest()]
+            for i, start in enumerate(range(0, len(self.target), 0x2000))]
+
+        self.old_globals = patch_core.Info, patch_core.Patches
+        patch_core.Info = {'regionDigests': digests}
+        patch_core.Patches = patch_bundle.PatchBundle(self.dir / 'patches.bundle')
+
+    def tearDown(self):
+        patch_core.Info, patch_core.Patches = self.old_globals
+        self.temp_dir.cleanup()
+
+    def test_repair(self):
+        broken = corrupt(self.target, 0x100, 0x9000, len(self.target) - 1)
+        repaired = patch_core.repair_output(broken, self.rom_fp, [self.key])
+        self.assertEqual(repaired, self.target)
+
+    def test_unrepairable(self):
+        # Nothing wrong in any region
+        self.assertIsNone(patch_core.repair_output(self.target, self.rom_fp, [self.key]))
+        # Wrong length
+        self.assertIsNone(patch_core.repair_output(self.target[:-1], self.rom_fp, [self.key]))
+        # More than one patch in the chain
+        self.assertIsNone(patch_core.repair_output(corrupt(self.target, 0), self.rom_fp, [self.key, self.key]))
+        # No digests
+        patch_core.Info = {}
+        self.assertIsNone(patch_core.repair_output(corrupt(self.target, 0), self.rom_fp, [self.key]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import random
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import patch_bundle
+import patch_client
+import patch_service
+import xdelta3_pure_py
+
+
+# Runs the patch service on a temporary socket, with a tiny data folder
+# (one small fake ROM and its patch), and talks to it with patch_client.
+
+
+ROM_SIZE = 0x20000  # (the smallest chip capacity)
+ROM_USED_SIZE = 0x18000
+NUM_JOBS = 4
+
+
+def make_rom(seed: int) -> bytes:
+    """Make a small fake DS ROM, with 0xFF padding after its used area"""
+    rng = random.Random(seed)
+    header = bytearray(rng.randbytes(0x200))
+    header[0x14] = 0  # capacity: 0x20000 << 0
+    header[0x80:0x84] = ROM_USED_SIZE.to_bytes(4, 'little')
+    body = rng.randbytes(ROM_USED_SIZE - len(header))
+    return bytes(header) + body + b'\xFF' * (ROM_SIZE - ROM_USED_SIZE)
+
+
+def make_target(rom: bytes, seed: int) -> bytes:
+    """Make a patched version of a ROM: a few edits, and a shift"""
+    rng = random.Random(seed)
+    target = bytearray(rom)
+    for _ in range(20):
+        pos = rng.randrange(len(target) - 0x100)
+        target[pos : pos + 0x80] = rng.randbytes(0x80)
+    return bytes(target[0x1000:] + target[:0x1000])
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are not available')
+class PatchServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+
+        self.rom = make_rom(0)
+        self.target = make_target(self.rom, 1)
+        patch = io.BytesIO()
+        # (Small windows, so that there's more than one progress event)
+        xdelta3_pure_py.encode_vcdiff(self.rom, self.target, patch, window_size=0x8000)
+
+        data_dir = self.dir / 'data'
+        data_dir.mkdir()
+        rom_md5 = hashlib.md5(self.rom).hexdigest()
+        patch_bundle.build_bundle({rom_md5: patch.getvalue()}, data_dir / 'patches.bundle')
+        (data_dir / 'info.json').write_text(json.dumps({
+            'outputHash': hashlib.md5(self.target).hexdigest(),
+            'patchesRequired': 1,
+        }), encoding='utf-8')
+
+        self.rom_fp = self.dir / 'in.nds'
+        self.rom_fp.write_bytes(self.rom)
+        self.socket_path = self.dir / 'service.sock'
+
+        # (resumable=True always uses the pure-Python backend, which is
+        # the one that reports progress)
+        ready = threading.Event()
+        def on_ready(server):
+            self.server = server
+            ready.set()
+        self.thread = threading.Thread(target=patch_service.serve,
+            args=(self.socket_path, 2), kwargs={'resumable': True, 'data_dir': data_dir, 'on_ready': on_ready})
+        self.thread.start()
+        self.assertTrue(ready.wait(10), 'The service never started')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.temp_dir.cleanup()
+
+    def test_concurrent_jobs(self):
+        events = [[] for _ in range(NUM_JOBS)]
+        results = [None] * NUM_JOBS
+
+        def run(i):
+            results[i] = patch_client.submit(self.socket_path, self.rom_fp,
+                self.dir / f'out{i}.nds', events[i].append)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(NUM_JOBS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(NUM_JOBS):
+            self.assertEqual(results[i]['event'], 'finished', results[i])
+            self.assertEqual((self.dir / f'out{i}.nds').read_bytes(), self.target)
+
+            names = [event['event'] for event in events[i]]
+            self.assertEqual(names[:2], ['queued', 'started'])
+            progress = [event for event in events[i] if event['event'] == 'progress']
+            self.assertGreater(len(progress), 1)
+            self.assertEqual(len(progress), len(names) - 2)
+            dones = [event['done'] for event in progress]
+            self.assertEqual(dones, sorted(dones))
+            self.assertEqual(dones[-1], progress[-1]['total'])
+
+        stats = patch_client.request(self.socket_path, {'command': 'stats'})
+        self.assertEqual(stats['jobsFinished'], NUM_JOBS)
+        self.assertEqual(stats['jobsFailed'], 0)
+
+    def test_errors(self):
+        result = patch_client.submit(self.socket_path, self.dir / 'missing.nds', self.dir / 'out.nds')
+        self.assertEqual(result['event'], 'failed')
+        self.assertIn('FileNotFoundError', result['error'])
+
+        result = patch_client.request(self.socket_path,
+            {'command': 'patch', 'input': 'in.nds', 'output': 'out.nds'})
+        self.assertEqual(result, {'event': 'failed', 'error': 'Paths must be absolute'})
+
+        result = patch_client.request(self.socket_path, {'command': 'nonsense'})
+        self.assertEqual(result['event'], 'failed')
+
+        stats = patch_client.request(self.socket_path, {'command': 'stats'})
+        self.assertEqual(stats['jobsFailed'], 1)
+
+    def test_working_directory(self):
+        # (Embedding the service mustn't change the working directory
+        # out from under everything else in the process)
+        self.assertEqual(os.getcwd(), self.cwd)
+
+    def test_socket_in_use(self):
+        with self.assertRaises(RuntimeError):
+            patch_service.remove_stale_socket(self.socket_path)
+        self.assertTrue(self.socket_path.exists())
+
+
+class RemoveStaleSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / 'service.sock'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_missing(self):
+        patch_service.remove_stale_socket(self.path)
+
+    def test_not_a_socket(self):
+        self.path.write_bytes(b'important')
+        with self.assertRaises(RuntimeError):
+            patch_service.remove_stale_socket(self.path)
+        self.assertEqual(self.path.read_bytes(), b'important')
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are not available')
+    def test_stale(self):
+        # (Bound, but nothing listening: what a killed service leaves)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(str(self.path))
+        patch_service.remove_stale_socket(self.path)
+        self.assertFalse(self.path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
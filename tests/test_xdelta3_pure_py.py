@@ -0,0 +1,456 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+import io
+import json
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Optional
+import unittest
+import zlib
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import patch_core
+import xdelta3_pure_py
+
+
+def make_pair(seed: int, size: int = 0x30000) -> (bytes, bytes):
+    """Make a (source, target) pair: random data, with edits and a shift"""
+    rng = random.Random(seed)
+    source = rng.randbytes(size // 2) + bytes(size // 4) + rng.randbytes(16) * (size // 64)
+    target = bytearray(source)
+    for _ in range(30):
+        pos = rng.randrange(len(target) - 0x200)
+        if rng.random() < 0.5:
+            target[pos : pos + rng.randrange(1, 0x100)] = rng.randbytes(rng.randrange(0x100))
+        else:
+            target[pos : pos] = bytes([rng.randrange(256)]) * rng.randrange(1, 0x200)
+    return source, bytes(target[0x1000:] + target[:0x1000])
+
+
+def encode(source: bytes, target: bytes, **kwargs) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.encode_vcdiff(source, target, out, **kwargs)
+    return out.getvalue()
+
+
+def decode(source: bytes, patch: bytes) -> bytes:
+    out = io.BytesIO()
+    xdelta3_pure_py.apply_vcdiff(source, patch, out)
+    return out.getvalue()
+
+
+def xdelta3_encode(source: bytes, target: bytes, *args: str) -> bytes:
+    """Make a patch with the real xdelta3 binary"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        (temp_dir / 'source').write_bytes(source)
+        (temp_dir / 'target').write_bytes(target)
+        subprocess.run(['xdelta3', '-e', '-f', *args,
+            '-s', str(temp_dir / 'source'), str(temp_dir / 'target'), str(temp_dir / 'patch')],
+            check=True)
+        return (temp_dir / 'patch').read_bytes()
+
+
+def xdelta3_decode(source: bytes, patch: bytes) -> bytes:
+    """Apply a patch with the real xdelta3 binary"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        (temp_dir / 'source').write_bytes(source)
+        (temp_dir / 'patch').write_bytes(patch)
+        subprocess.run(['xdelta3', '-d', '-f',
+            '-s', str(temp_dir / 'source'), str(temp_dir / 'patch'), str(temp_dir / 'target')],
+            check=True)
+        return (temp_dir / 'target').read_bytes()
+
+
+def read_windows(patch: bytes) -> list:
+    diff = io.BytesIO(patch)
+    xdelta3_pure_py.read_vcdiff_header(diff)
+    windows = []
+    while diff.tell() < len(patch):
+        windows.append(xdelta3_pure_py.read_vcdiff_window(diff))
+    return windows
+
+
+def count_windows(patch: bytes) -> int:
+    return len(read_windows(patch))
+
+
+def make_window_header(target_window_len: int) -> bytes:
+    """A patch with one window header claiming the given target length"""
+    out = io.BytesIO()
+    xdelta3_pure_py.VCDIFFWriter(out)
+    return (out.getvalue() + bytes([0])
+        + xdelta3_pure_py.encode_vcdiff_integer(16)
+        + xdelta3_pure_py.encode_vcdiff_integer(target_window_len)
+        + bytes(16))
+
+
+class EncoderTest(unittest.TestCase):
+
+    OPTIONS = [
+        {},
+        {'adler32': False},
+        {'secondary': xdelta3_pure_py.VCD_COMPRESSION_LZMA},
+        {'secondary': xdelta3_pure_py.VCD_COMPRESSION_LZMA, 'adler32': False},
+        {'appheader': b'appheader'},
+        {'window_size': 0x4000},
+        {'window_size': 0x4000, 'secondary': xdelta3_pure_py.VCD_COMPRESSION_LZMA},
+        {'block_size': 0x100},
+    ]
+
+    def check_patch(self, source: bytes, target: bytes, patch: bytes, adler32: bool = True):
+        out = io.BytesIO()
+        xdelta3_pure_py.apply_vcdiff(source, patch, out)
+        self.assertEqual(out.getvalue(), target)
+
+        pos = 0
+        for window in read_windows(patch):
+            target_window = target[pos : pos + window.target_window_len]
+            pos += window.target_window_len
+            if adler32:
+                self.assertEqual(window.expected_adler, zlib.adler32(target_window))
+            else:
+                self.assertIsNone(window.expected_adler)
+        self.assertEqual(pos, len(target))
+
+        if shutil.which('xdelta3'):
+            self.assertEqual(xdelta3_decode(source, patch), target)
+
+    def test_round_trip(self):
+        source, target = make_pair(5)
+        for options in self.OPTIONS:
+            with self.subTest(**options):
+                patch = encode(source, target, **options)
+                self.check_patch(source, target, patch, options.get('adler32', True))
+
+                # (It should actually be finding matches)
+                self.assertLess(len(patch), len(target) // 4)
+
+    def test_appheader(self):
+        source, target = make_pair(6, 0x1000)
+        patch = encode(source, target, appheader=b'appheader')
+        self.assertEqual(xdelta3_pure_py.apply_vcdiff(source, patch, io.BytesIO()), b'appheader')
+
+    def test_lzma(self):
+        # (Unmatched random data doesn't compress, so use text)
+        rng = random.Random(7)
+        words = [b'mario', b'luigi', b'peach', b'bowser', b'toad', b'yoshi']
+        target = b' '.join(rng.choice(words) for _ in range(0x4000))
+        plain = encode(b'', target, window_size=0x4000)
+        compressed = encode(b'', target, window_size=0x4000,
+            secondary=xdelta3_pure_py.VCD_COMPRESSION_LZMA)
+        self.assertLess(len(compressed), len(plain))
+        self.check_patch(b'', target, compressed)
+
+    def test_edge_cases(self):
+        source, target = make_pair(8, 0x1000)
+        for name, src, tgt in [
+                ('empty source', b'', target),
+                ('empty target', source, b''),
+                ('both empty', b'', b''),
+                ('identical', source, source),
+                ('tiny', b'a', b'ab'),
+                ]:
+            with self.subTest(name):
+                self.check_patch(src, tgt, encode(src, tgt))
+
+    def test_files(self):
+        # (Real files: the source is memory-mapped, and the target is
+        # read a window at a time)
+        source, target = make_pair(9)
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as tgt:
+            src.write(source)
+            tgt.write(target)
+            tgt.seek(0)
+            out = io.BytesIO()
+            xdelta3_pure_py.encode_vcdiff(src, tgt, out, window_size=0x4000)
+        self.check_patch(source, target, out.getvalue())
+
+    def test_writer(self):
+        source = bytes(range(256)) * 4
+        target_1 = b'hello' + source[100:300] + bytes([7]) * 50
+        target_2 = source[:64] + source[10:30] + b'!'
+        ops_1 = [('add', b'hello'), ('src', 100, 200), ('run', 7, 50)]
+        ops_2 = [('src', 0, 64), ('tgt', len(target_1) + 10, 20), ('add', b'!')]
+        target = target_1 + target_2
+
+        for address_cache in [True, False]:
+            for secondary in [None, xdelta3_pure_py.VCD_COMPRESSION_LZMA]:
+                with self.subTest(address_cache=address_cache, secondary=secondary):
+                    out = io.BytesIO()
+                    writer = xdelta3_pure_py.VCDIFFWriter(out, secondary, address_cache=address_cache)
+                    writer.write_window(ops_1, 0, target_1)
+                    writer.write_window(ops_2, len(target_1), target_2)
+                    self.check_patch(source, target, out.getvalue())
+
+        # (Target copies can't reach back into earlier windows)
+        writer = xdelta3_pure_py.VCDIFFWriter(io.BytesIO())
+        writer.write_window(ops_1, 0, target_1)
+        with self.assertRaises(ValueError):
+            writer.write_window([('tgt', 0, 20)], len(target_1), target_1[:20])
+
+    def test_source_index(self):
+        source = bytes(64) + bytes(range(64)) + bytes(64) + bytes(10)
+        index = xdelta3_pure_py.VCDIFFSourceIndex(source, 32)
+        self.assertEqual(index.block_size, 32)
+        # (Whole blocks only, each at the first place it appears)
+        self.assertEqual(index.blocks, {
+            zlib.adler32(bytes(32)): 0,
+            zlib.adler32(bytes(range(32))): 64,
+            zlib.adler32(bytes(range(32, 64))): 96,
+        })
+
+        # Large sources get larger blocks, to limit the index size
+        big = memoryview(bytes(xdelta3_pure_py.ENCODER_MAX_INDEX_BLOCKS * 64))
+        index = xdelta3_pure_py.VCDIFFSourceIndex(big, 32)
+        self.assertEqual(index.block_size, 64)
+        self.assertEqual(index.blocks, {zlib.adler32(bytes(64)): 0})
+
+
+class ThreadedTest(unittest.TestCase):
+
+    def test_threaded(self):
+        source, target = make_pair(0)
+        patch = encode(source, target, window_size=0x4000)
+
+        for max_workers in [1, 3]:
+            out = io.BytesIO()
+            xdelta3_pure_py.apply_vcdiff_threaded(source, patch, out, max_workers=max_workers)
+            self.assertEqual(out.getvalue(), target)
+
+        # (A real file is memory-mapped, and the map closed again, even
+        # if decoding fails)
+        with tempfile.TemporaryFile() as f:
+            f.write(source)
+            out = io.BytesIO()
+            xdelta3_pure_py.apply_vcdiff_threaded(f, patch, out, max_workers=2)
+            self.assertEqual(out.getvalue(), target)
+            with self.assertRaises(Exception):
+                xdelta3_pure_py.apply_vcdiff_threaded(f, patch[:-100], io.BytesIO(), max_workers=2)
+
+    def test_window_too_large(self):
+        patch = make_window_header(1 << 40)
+        with self.assertRaises(ValueError):
+            xdelta3_pure_py.apply_vcdiff_threaded(b'', patch, io.BytesIO())
+        with self.assertRaises(ValueError):
+            xdelta3_pure_py.apply_vcdiff(b'', patch, io.BytesIO())
+
+
+class StreamDecoderTest(unittest.TestCase):
+
+    def stream(self, source: bytes, patch: bytes, chunk_sizes) -> bytes:
+        """Push a patch into a VCDIFFStreamDecoder in chunks of the given sizes"""
+        out = io.BytesIO()
+        decoder = xdelta3_pure_py.VCDIFFStreamDecoder(source, out)
+        pos = completed = 0
+        for size in chunk_sizes:
+            if pos >= len(patch):
+                break
+            completed += decoder.feed(patch[pos : pos + size])
+            pos += size
+        decoder.close()
+
+        self.assertEqual(decoder.bytes_fed, len(patch))
+        self.assertEqual(completed, decoder.windows_done)
+        self.assertEqual(decoder.windows_done, count_windows(patch))
+        return out.getvalue()
+
+    def check_patch(self, source: bytes, patch: bytes):
+        expected = decode(source, patch)
+        rng = random.Random(len(patch))
+
+        def random_sizes(max_size):
+            while True:
+                yield rng.randrange(1, max_size + 1)
+
+        for name, chunk_sizes in [
+                ('whole', [len(patch)]),
+                ('1-byte', iter(lambda: 1, None)),
+                ('up to 7 bytes', random_sizes(7)),
+                ('up to 4 KiB', random_sizes(0x1000)),
+                ('up to 64 KiB', random_sizes(0x10000)),
+                ]:
+            with self.subTest(chunks=name):
+                self.assertEqual(self.stream(source, patch, chunk_sizes), expected)
+
+    def test_pure_py_patch(self):
+        source, target = make_pair(2)
+        for secondary in [None, xdelta3_pure_py.VCD_COMPRESSION_LZMA]:
+            patch = encode(source, target, window_size=0x4000, secondary=secondary,
+                appheader=b'appheader')
+            self.assertEqual(decode(source, patch), target)
+            self.check_patch(source, patch)
+
+    @unittest.skipUnless(shutil.which('xdelta3'), 'xdelta3 is not installed')
+    def test_xdelta3_patch(self):
+        source, target = make_pair(3)
+        patch = xdelta3_encode(source, target, '-W', str(0x4000))
+        self.assertEqual(decode(source, patch), target)
+        self.check_patch(source, patch)
+
+    def test_truncated(self):
+        source, target = make_pair(4)
+        patch = encode(source, target, window_size=0x4000)
+        for end in [3, 6, len(patch) - 1]:
+            with self.subTest(end=end):
+                decoder = xdelta3_pure_py.VCDIFFStreamDecoder(source, io.BytesIO())
+                decoder.feed(patch[:end])
+                with self.assertRaises(ValueError):
+                    decoder.close()
+
+
+class Interrupt(Exception):
+    """Stands in for the program being killed"""
+
+
+class ResumableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.out_fp = self.dir / 'out.nds'
+        self.checkpoint_fp = self.dir / ('out.nds' + xdelta3_pure_py.CHECKPOINT_SUFFIX)
+        self.source, self.target = make_pair(1)
+        self.real_execute = xdelta3_pure_py.VCDIFFWindow.execute
+        self.windows_run = 0
+
+        def execute(window, *args, **kwargs):
+            self.windows_run += 1
+            return self.real_execute(window, *args, **kwargs)
+        xdelta3_pure_py.VCDIFFWindow.execute = execute
+
+    def tearDown(self):
+        xdelta3_pure_py.VCDIFFWindow.execute = self.real_execute
+        self.temp_dir.cleanup()
+
+    def apply(self, patch: bytes, interrupt_after: Optional[int] = None, source_id: str = 'source'):
+        """Apply a patch resumably, interrupting it after some windows"""
+        self.windows_run = 0
+        def progress(done, total):
+            if interrupt_after is not None and self.windows_run == interrupt_after:
+                raise Interrupt
+        xdelta3_pure_py.apply_vcdiff_resumable(self.source, patch, self.out_fp,
+            progress=progress, source_id=source_id, checkpoint_interval=0x4000)
+
+    def interrupt(self, patch: bytes) -> int:
+        """Interrupt applying a patch partway, and return how many windows it has"""
+        num_windows = count_windows(patch)
+        with self.assertRaises(Interrupt):
+            self.apply(patch, num_windows // 2)
+        self.assertTrue(self.checkpoint_fp.is_file())
+        return num_windows
+
+    def test_resume(self):
+        for secondary in [None, xdelta3_pure_py.VCD_COMPRESSION_LZMA]:
+            with self.subTest(secondary=secondary):
+                patch = encode(self.source, self.target, window_size=0x4000, secondary=secondary)
+                num_windows = self.interrupt(patch)
+
+                self.apply(patch)
+                self.assertEqual(self.out_fp.read_bytes(), self.target)
+                self.assertFalse(self.checkpoint_fp.exists())
+                # (Only the windows after the checkpoint were run again)
+                self.assertLess(self.windows_run, num_windows)
+
+    def test_stale_checkpoints(self):
+        patch = encode(self.source, self.target, window_size=0x4000)
+
+        def check_started_over(num_windows):
+            self.assertEqual(self.out_fp.read_bytes(), self.target)
+            self.assertEqual(self.windows_run, num_windows)
+            self.assertFalse(self.checkpoint_fp.exists())
+
+        # A different source
+        num_windows = self.interrupt(patch)
+        self.apply(patch, source_id='other source')
+        check_started_over(num_windows)
+
+        # A different patch (with the same output)
+        num_windows = self.interrupt(patch)
+        other_patch = encode(self.source, self.target, window_size=0x2000)
+        self.apply(other_patch)
+        check_started_over(count_windows(other_patch))
+
+        # A damaged partial output
+        num_windows = self.interrupt(patch)
+        with self.out_fp.open('r+b') as f:
+            f.write(b'oops')
+        self.apply(patch)
+        check_started_over(num_windows)
+
+        # A truncated partial output
+        num_windows = self.interrupt(patch)
+        with self.out_fp.open('r+b') as f:
+            f.truncate(10)
+        self.apply(patch)
+        check_started_over(num_windows)
+
+        # A checkpoint from another version
+        num_windows = self.interrupt(patch)
+        checkpoint = json.loads(self.checkpoint_fp.read_text(encoding='utf-8'))
+        checkpoint['version'] += 1
+        self.checkpoint_fp.write_text(json.dumps(checkpoint), encoding='utf-8')
+        self.apply(patch)
+        check_started_over(num_windows)
+
+    def test_do_xdelta_resumable(self):
+        # (do_xdelta_resumable() uses the default checkpoint interval, so
+        # this needs a few MiB of output. The patch is written directly,
+        # since encoding that much would be slow.)
+        rng = random.Random(2)
+        window_size = 0x100000
+        self.source = rng.randbytes(window_size * 5)
+        patch = io.BytesIO()
+        writer = xdelta3_pure_py.VCDIFFWriter(patch)
+        target = bytearray()
+        for i in range(6):
+            ops = [('src', (i * 0x12345) % window_size, window_size - 0x100), ('add', rng.randbytes(0x100))]
+            window_target = self.source[ops[0][1] : ops[0][1] + ops[0][2]] + ops[1][1]
+            writer.write_window(ops, len(target), window_target)
+            target += window_target
+        patch = patch.getvalue()
+
+        partial_fp = self.dir / 'out.partial'
+        def progress(done, total):
+            if self.windows_run == 5:
+                raise Interrupt
+        self.windows_run = 0
+        with self.assertRaises(Interrupt):
+            patch_core.do_xdelta_resumable(self.source, patch, partial_fp, 'a' * 32, progress)
+        self.assertTrue(partial_fp.is_file())
+
+        self.windows_run = 0
+        self.assertEqual(patch_core.do_xdelta_resumable(self.source, patch, partial_fp, 'a' * 32), target)
+        self.assertEqual(self.windows_run, 2)
+        self.assertEqual(list(self.dir.iterdir()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
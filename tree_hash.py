@@ -0,0 +1,245 @@
+"""
+Newer Super Mario Bros. DS Patch Wizard ("Newer DS Patch Wizard")
+Copyright (C) 2017 RoadrunnerWMC, skawo
+
+This file is part of Newer DS Patch Wizard.
+"""
+COPYRIGHT = """
+Newer DS Patch Wizard is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Newer DS Patch Wizard is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Newer DS Patch Wizard.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+from pathlib import Path
+import sys
+from typing import Iterator, List, Optional, Union
+
+
+# Chunked tree-hash manifests, so that a ROM can be verified on every
+# core at once instead of by one long serial MD5 (which info.json keeps
+# using too, for compatibility), and so that a mismatch says *where* the
+# ROM is wrong.
+#
+# The hash is BLAKE2b in its standard tree mode (see hashlib's docs):
+# the data is split into fixed-size leaves (1 MiB by default), each leaf
+# is hashed with its own node offset, and the root hashes the
+# concatenated leaf digests. A manifest stores all of them:
+#
+#     {
+#         "algorithm": "blake2b-tree",
+#         "size": <total size in bytes>,
+#         "leafSize": <leaf size in bytes>,
+#         "leaves": [<leaf digest (hex)>, ...],
+#         "root": <root digest (hex)>
+#     }
+#
+# info.json can have one for the patched ROM ("outputManifest"), which
+# patched ROMs are checked against, and one per source ROM, by
+# (normalized) MD5 ("sourceManifests"), which input ROMs are identified
+# by (see patch_core.identify_by_manifest()). Run this module as a
+# script to generate those, or to create and check standalone
+# manifests (for auditing a ROM library, say).
+
+
+ALGORITHM = 'blake2b-tree'
+DEFAULT_LEAF_SIZE = 0x100000
+DIGEST_SIZE = 32
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+def _node(leaf_size: int, node_offset: int, node_depth: int, last_node: bool) -> 'hashlib._Hash':
+    return hashlib.blake2b(digest_size=DIGEST_SIZE, fanout=0, depth=2, leaf_size=leaf_size,
+        inner_size=DIGEST_SIZE, node_offset=node_offset, node_depth=node_depth, last_node=last_node)
+
+
+def leaf_count(size: int, leaf_size: int) -> int:
+    # (Empty data still has one, empty, leaf)
+    return max(1, -(-size // leaf_size))
+
+
+def root_digest(leaves: List[bytes], leaf_size: int) -> bytes:
+    """Return the root digest for a list of leaf digests"""
+    root = _node(leaf_size, 0, 1, True)
+    for leaf in leaves:
+        root.update(leaf)
+    return root.digest()
+
+
+def _hash_leaves(data: BytesLike, leaf_size: int, indices: range,
+        max_workers: Optional[int]) -> Iterator[bytes]:
+    """
+    Hash the given leaves of data on a thread pool (hashlib releases the
+    GIL), yielding their digests in order
+    """
+    view = memoryview(data).cast('B')
+    count = leaf_count(len(view), leaf_size)
+
+    def hash_leaf(index: int) -> bytes:
+        leaf = _node(leaf_size, index, 0, index == count - 1)
+        leaf.update(view[index * leaf_size : (index + 1) * leaf_size])
+        return leaf.digest()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers or os.cpu_count() or 1)
+    try:
+        yield from executor.map(hash_leaf, indices)
+    finally:
+        # (If the caller stops early, don't bother with the rest)
+        executor.shutdown(cancel_futures=True)
+        view.release()
+
+
+def compute_manifest(data: BytesLike, leaf_size: int = DEFAULT_LEAF_SIZE,
+        max_workers: Optional[int] = None) -> dict:
+    """
+    Compute the tree-hash manifest of some data, hashing leaves in
+    parallel on up to max_workers threads (default: one per CPU)
+    """
+    size = memoryview(data).nbytes
+    leaves = list(_hash_leaves(data, leaf_size, range(leaf_count(size, leaf_size)), max_workers))
+    return {
+        'algorithm': ALGORITHM,
+        'size': size,
+        'leafSize': leaf_size,
+        'leaves': [leaf.hex() for leaf in leaves],
+        'root': root_digest(leaves, leaf_size).hex(),
+    }
+
+
+def find_first_mismatch(data: BytesLike, manifest: dict,
+        max_workers: Optional[int] = None) -> Optional[int]:
+    """
+    Check data against a manifest, hashing leaves in parallel, and
+    return the offset of the start of the first leaf that doesn't match
+    (if the size is wrong, that's at most where the leaves that can
+    still be compared end), or None if it all matches. Raises ValueError
+    if the manifest itself is invalid.
+    """
+    if manifest.get('algorithm') != ALGORITHM:
+        raise ValueError(f'Unsupported manifest algorithm: {manifest.get("algorithm")}')
+
+    leaf_size = manifest['leafSize']
+    expected = [bytes.fromhex(leaf) for leaf in manifest['leaves']]
+    if (len(expected) != leaf_count(manifest['size'], leaf_size)
+            or root_digest(expected, leaf_size).hex() != manifest['root']):
+        raise ValueError('Manifest is corrupted')
+
+    size = memoryview(data).nbytes
+    if size != manifest['size']:
+        # Only full leaves that aren't the last one of either can be
+        # compared (the last leaf is hashed differently)
+        common = min(min(size, manifest['size']) // leaf_size,
+            len(expected) - 1, leaf_count(size, leaf_size) - 1)
+    else:
+        common = len(expected)
+
+    for index, leaf in enumerate(_hash_leaves(data, leaf_size, range(common), max_workers)):
+        if leaf != expected[index]:
+            return index * leaf_size
+
+    if size != manifest['size']:
+        return common * leaf_size
+    return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Create and check chunked tree-hash manifests of ROMs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create_parser = subparsers.add_parser('create', help='create a manifest for a file')
+    create_parser.add_argument('file', type=Path)
+    create_parser.add_argument('manifest', type=Path,
+        help='where to save the manifest')
+    create_parser.add_argument('--leaf-size', type=int, default=DEFAULT_LEAF_SIZE // 0x400,
+        help=f'leaf size, in KiB (default: {DEFAULT_LEAF_SIZE // 0x400})')
+
+    verify_parser = subparsers.add_parser('verify', help='check files against a manifest')
+    verify_parser.add_argument('manifest', type=Path)
+    verify_parser.add_argument('files', type=Path, nargs='+')
+
+    info_parser = subparsers.add_parser('info',
+        help="generate info.json's output and source ROM manifests")
+    info_parser.add_argument('output_rom', type=Path,
+        help='the (correct) patched ROM')
+    info_parser.add_argument('source_roms', type=Path, nargs='*',
+        help='supported source ROMs')
+    info_parser.add_argument('--info', type=Path, default=Path('data') / 'info.json',
+        help='the info.json file to update (default: data/info.json)')
+
+    for subparser in [create_parser, verify_parser, info_parser]:
+        subparser.add_argument('--normalize', action='store_true',
+            help='treat ROMs as untrimmed dumps, like the patcher does'
+            ' (always on for source ROMs with "info")')
+        subparser.add_argument('--workers', type=int,
+            help='number of hashing threads (default: number of CPUs)')
+
+    args = parser.parse_args(argv)
+
+    def read_rom(fp: Path, normalize: bool) -> bytes:
+        if not normalize:
+            return fp.read_bytes()
+        import patch_core
+        with patch_core.NormalizedRom(fp) as rom:
+            return bytes(rom)
+
+    if args.command == 'create':
+        manifest = compute_manifest(read_rom(args.file, args.normalize),
+            args.leaf_size * 0x400, args.workers)
+        args.manifest.write_text(json.dumps(manifest, indent=4) + '\n', encoding='utf-8')
+        print(f'{args.file}: {manifest["root"]}')
+
+    elif args.command == 'verify':
+        manifest = json.loads(args.manifest.read_text(encoding='utf-8'))
+        failed = False
+        for fp in args.files:
+            try:
+                bad_offset = find_first_mismatch(read_rom(fp, args.normalize), manifest, args.workers)
+            except (OSError, ValueError) as e:
+                print(f'{fp}: {e}')
+                failed = True
+                continue
+            if bad_offset is None:
+                print(f'{fp}: OK')
+            else:
+                print(f'{fp}: MISMATCH at 0x{bad_offset:X}')
+                failed = True
+        return 1 if failed else 0
+
+    else:
+        info = json.loads(args.info.read_text(encoding='utf-8'))
+        output = read_rom(args.output_rom, args.normalize)
+        if hashlib.md5(output).hexdigest() != info.get('outputHash'):
+            print(f"{args.output_rom} doesn't match the outputHash in {args.info}", file=sys.stderr)
+            return 1
+        info['outputManifest'] = compute_manifest(output, max_workers=args.workers)
+        del output
+
+        source_manifests = info.setdefault('sourceManifests', {})
+        for fp in args.source_roms:
+            source = read_rom(fp, True)
+            source_manifests[hashlib.md5(source).hexdigest()] = compute_manifest(source, max_workers=args.workers)
+
+        args.info.write_text(json.dumps(info, indent=4) + '\n', encoding='utf-8')
+        print(f'Saved manifests for the output and {len(args.source_roms)} source ROM(s) to {args.info}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
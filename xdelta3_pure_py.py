@@ -34,11 +34,23 @@ along with Newer DS Patch Wizard.  If not, see
 <a href="http://www.gnu.org/licenses/">http://www.gnu.org/licenses/</a>.
 """
 
+import bisect
 import collections
+import concurrent.futures
+import hashlib
 import io
+import itertools
+import json
 import lzma
+import mmap
 import os
-from typing import BinaryIO, List, Optional, Type
+import queue
+import re
+import struct
+import sys
+import threading
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Type, Union
 import zlib  # for adler32()
 
 
@@ -92,6 +104,16 @@ INST_TYPE_ADD = 1
 INST_TYPE_RUN = 2
 INST_TYPE_COPY = 3
 
+# How much to read at a time from diffs that aren't seekable
+STREAM_READ_SIZE = 0x10000
+
+# xdelta3 refuses target windows larger than this (XD3_HARDMAXWINSIZE),
+# and so does this decoder, so that a corrupt window header can't make
+# it allocate any amount of memory it likes
+MAX_TARGET_WINDOW_LEN = 0x1000000
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
 
 def get_file_len(file: BinaryIO) -> int:
     """Helper to get the total length of a file-like object"""
@@ -102,6 +124,61 @@ def get_file_len(file: BinaryIO) -> int:
     return end
 
 
+class BufferReader:
+    """
+    Minimal read-only file-like wrapper around a bytes-like object
+    (bytes, bytearray, mmap, memoryview...). Unlike io.BytesIO, this
+    never copies the underlying buffer -- only the bytes actually read.
+    """
+    def __init__(self, data):
+        self._view = memoryview(data).cast('B')
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(self._pos + size, len(self._view))
+        data = self._view[self._pos : end].tobytes()
+        self._pos = max(end, self._pos)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = len(self._view) + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seekable(self) -> bool:
+        return True
+
+    def release(self) -> None:
+        """
+        Release the underlying buffer (so that a bytearray can be
+        resized again, for instance). The reader can't be used after
+        this.
+        """
+        self._view.release()
+
+
+def as_binary_io(file) -> BinaryIO:
+    """
+    Return the argument as-is if it's already a file-like object, or
+    wrapped in a BufferReader if it's a bytes-like object
+    """
+    if hasattr(file, 'read'):
+        return file
+    return BufferReader(file)
+
+
 def read_vcdiff_integer(file: BinaryIO) -> int:
     """
     Read a variable-length VCDIFF integer. See RFC 3284, section 2.
@@ -209,6 +286,18 @@ class VCDIFFCodeTable:
     # Instead of including nops, we just make some lists one element long
     i_code: List[List[Instruction]]
 
+    _default = None
+
+    @classmethod
+    def default(cls) -> 'VCDIFFCodeTable':
+        """
+        Return a shared instance of the default code table, building it
+        the first time it's needed. Callers must not modify it.
+        """
+        if cls._default is None:
+            cls._default = cls.build_default()
+        return cls._default
+
     @classmethod
     def build_default(cls) -> 'VCDIFFCodeTable':
         """Build the default code table"""
@@ -279,70 +368,206 @@ class VCDIFFCache:
             self.same[addr % (self.s_same * 256)] = addr
 
 
-def apply_vcdiff_window(
-        src: BinaryIO, diff: BinaryIO, out: BinaryIO,
-        code_table: VCDIFFCodeTable, decompressors: XdeltaDecompressorTriple) -> None:
-    """Apply a single VCDIFF window"""
+class VCDIFFWindow:
+    """
+    A single VCDIFF window, as read from the diff file: the window header
+    plus the three data streams (which may still be compressed)
+    """
+    win_indicator: int
+    src_seg_len: int
+    src_seg_pos: int
+    target_window_len: int
+    delta_indicator: int
+    expected_adler: Optional[int]
+    # Lengths of the three data streams, as stored in the diff
+    data_lens: Tuple[int, int, int]
+    adds_runs_data: bytes
+    instructions_data: bytes
+    addresses_data: bytes
+
+    def read_data(self, diff: BinaryIO) -> None:
+        """
+        Read the window's three data streams, which come right after the
+        window header
+        """
+        adds_runs_len, instructions_len, addresses_len = self.data_lens
+
+        self.adds_runs_data = diff.read(adds_runs_len)
+        self.instructions_data = diff.read(instructions_len)
+        self.addresses_data = diff.read(addresses_len)
+
+        if (len(self.adds_runs_data) < adds_runs_len
+                or len(self.instructions_data) < instructions_len
+                or len(self.addresses_data) < addresses_len):
+            raise EOFError('VCDIFF window is truncated')
+
+    def decompress(self, decompressors: XdeltaDecompressorTriple,
+            executor: Optional[concurrent.futures.Executor] = None) -> None:
+        """
+        Decompress any of the data streams that use secondary
+        compression, in place. This has to be done for every window, in
+        order, since the decompressors are stateful.
+
+        If an executor is provided, the streams are decompressed
+        concurrently (each stream has its own decompressor, and LZMA
+        releases the GIL).
+        """
+        jobs = []
+        if self.delta_indicator & VCD_DATACOMP:
+            jobs.append(('adds_runs_data', decompressors.adds_runs))
+        if self.delta_indicator & VCD_INSTCOMP:
+            jobs.append(('instructions_data', decompressors.instructions))
+        if self.delta_indicator & VCD_ADDRCOMP:
+            jobs.append(('addresses_data', decompressors.addresses))
+
+        def decompress_stream(job):
+            attr, decompressor = job
+            return decompressor.decompress_chunk(getattr(self, attr))
+
+        if executor is None or len(jobs) < 2:
+            results = map(decompress_stream, jobs)
+        else:
+            results = executor.map(decompress_stream, jobs)
+
+        for (attr, _), data in zip(jobs, list(results)):
+            setattr(self, attr, data)
+
+        self.delta_indicator &= ~(VCD_DATACOMP | VCD_INSTCOMP | VCD_ADDRCOMP)
+
+    def execute(self, src: BinaryIO, code_table: VCDIFFCodeTable,
+            out_buffer: Optional[memoryview] = None) -> Union[bytearray, memoryview]:
+        """
+        Run the window's instructions, and return the target window. The
+        window must already be decompressed.
+
+        If out_buffer (a writable memoryview exactly as long as the target
+        window) is provided, the target window is written into that
+        instead of a new bytearray.
+        """
+        cache = VCDIFFCache(code_table.s_near, code_table.s_same)
+
+        return _apply_vcdiff_window_inner_loop(
+            src, self.src_seg_pos, self.src_seg_len,
+            io.BytesIO(self.adds_runs_data), io.BytesIO(self.instructions_data),
+            io.BytesIO(self.addresses_data), len(self.instructions_data),
+            code_table, cache,
+            self.target_window_len, out_buffer)
+
+    def iter_instructions(self, code_table: VCDIFFCodeTable) -> Iterator[Tuple[int, int, Union[bytes, int]]]:
+        """
+        Parse the window's instructions without running them, yielding
+        (type, size, arg) tuples, where arg is the data for an ADD, the
+        byte for a RUN, or the (decoded) address for a COPY. The window
+        must already be decompressed.
+        """
+        cache = VCDIFFCache(code_table.s_near, code_table.s_same)
+        adds_runs_f = io.BytesIO(self.adds_runs_data)
+        instructions_f = io.BytesIO(self.instructions_data)
+        addresses_f = io.BytesIO(self.addresses_data)
+        here = self.src_seg_len
+
+        while instructions_f.tell() < len(self.instructions_data):
+            for inst in code_table.i_code[instructions_f.read(1)[0]]:
+                size = inst.size or read_vcdiff_integer(instructions_f)
+
+                if inst.type == INST_TYPE_ADD:
+                    yield INST_TYPE_ADD, size, adds_runs_f.read(size)
+                elif inst.type == INST_TYPE_RUN:
+                    yield INST_TYPE_RUN, size, adds_runs_f.read(1)[0]
+                else:
+                    mode = inst.mode
+                    if mode == VCD_SELF:
+                        addr = read_vcdiff_integer(addresses_f)
+                    elif mode == VCD_HERE:
+                        addr = here - read_vcdiff_integer(addresses_f)
+                    elif mode - 2 < cache.s_near:
+                        addr = cache.near[mode - 2] + read_vcdiff_integer(addresses_f)
+                    else:
+                        addr = cache.same[(mode - (2 + cache.s_near)) * 256 + addresses_f.read(1)[0]]
+                    cache.cache_update(addr)
+                    yield INST_TYPE_COPY, size, addr
 
-    win_indicator = diff.read(1)[0]
+                here += size
+
+    def check_adler32(self, out_buffer: BytesLike) -> None:
+        """
+        If the window has an Adler-32 checksum, verify the target window
+        against it
+        """
+        if self.expected_adler is None:
+            return
+
+        actual_adler = zlib.adler32(out_buffer)
+        if self.expected_adler != actual_adler:
+            print("WARNING: Adler-32 checksum didn't match!"
+                f' (expected {self.expected_adler:08x}, got {actual_adler:08x}).'
+                ' Output is probably wrong!')
+
+
+def read_vcdiff_window(diff: BinaryIO) -> VCDIFFWindow:
+    """
+    Read a single VCDIFF window (without applying it). Raises EOFError
+    (or IndexError, if it happens partway through an integer) if the
+    diff ends partway through the window.
+    """
+    window = read_vcdiff_window_header(diff)
+    window.read_data(diff)
+    return window
+
+
+def read_vcdiff_window_header(diff: BinaryIO) -> VCDIFFWindow:
+    """
+    Read the header of a single VCDIFF window, but not its data streams.
+    Call .read_data() on the result to read those.
+    """
+    window = VCDIFFWindow()
+
+    win_indicator = window.win_indicator = diff.read(1)[0]
 
     if win_indicator & VCD_TARGET:
         # not sure where to get example files to test win_indicator & VCD_TARGET...
         raise NotImplementedError('win_indicator & VCD_TARGET not yet supported')
 
     if win_indicator & (VCD_SOURCE | VCD_TARGET):
-        src_seg_len = read_vcdiff_integer(diff)
-        src_seg_pos = read_vcdiff_integer(diff)
+        window.src_seg_len = read_vcdiff_integer(diff)
+        window.src_seg_pos = read_vcdiff_integer(diff)
+    else:
+        window.src_seg_len = window.src_seg_pos = 0
 
     delta_encoding_len = read_vcdiff_integer(diff)
-    target_window_len = read_vcdiff_integer(diff)
-    delta_indicator = diff.read(1)[0]
+    window.target_window_len = read_vcdiff_integer(diff)
+    if window.target_window_len > MAX_TARGET_WINDOW_LEN:
+        raise ValueError(f'VCDIFF target window is too large ({window.target_window_len} bytes)')
+    window.delta_indicator = diff.read(1)[0]
     adds_runs_data_comp_len = read_vcdiff_integer(diff)
     instructions_data_comp_len = read_vcdiff_integer(diff)
     addresses_data_comp_len = read_vcdiff_integer(diff)
 
     if win_indicator & VCD_ADLER32:
-        expected_adler = int.from_bytes(diff.read(4), 'big')
-
-    adds_runs_data_comp = diff.read(adds_runs_data_comp_len)
-    instructions_data_comp = diff.read(instructions_data_comp_len)
-    addresses_data_comp = diff.read(addresses_data_comp_len)
-
-    if delta_indicator & VCD_DATACOMP:
-        adds_runs_data = decompressors.adds_runs.decompress_chunk(adds_runs_data_comp)
+        adler = diff.read(4)
+        if len(adler) < 4:
+            raise EOFError('VCDIFF window is truncated')
+        window.expected_adler = int.from_bytes(adler, 'big')
     else:
-        adds_runs_data = adds_runs_data_comp
+        window.expected_adler = None
 
-    if delta_indicator & VCD_INSTCOMP:
-        instructions_data = decompressors.instructions.decompress_chunk(instructions_data_comp)
-    else:
-        instructions_data = instructions_data_comp
+    window.data_lens = (adds_runs_data_comp_len, instructions_data_comp_len, addresses_data_comp_len)
+
+    return window
 
-    if delta_indicator & VCD_ADDRCOMP:
-        addresses_data = decompressors.addresses.decompress_chunk(addresses_data_comp)
-    else:
-        addresses_data = addresses_data_comp
 
-    adds_runs_f = io.BytesIO(adds_runs_data)
-    instructions_f = io.BytesIO(instructions_data)
-    addresses_f = io.BytesIO(addresses_data)
+def apply_vcdiff_window(
+        src: BinaryIO, diff: BinaryIO, out: BinaryIO,
+        code_table: VCDIFFCodeTable, decompressors: XdeltaDecompressorTriple) -> None:
+    """Apply a single VCDIFF window"""
 
-    cache = VCDIFFCache(code_table.s_near, code_table.s_same)
+    window = read_vcdiff_window(diff)
+    window.decompress(decompressors)
 
     # Main loop
-    out_buffer = _apply_vcdiff_window_inner_loop(
-        src, src_seg_pos, src_seg_len,
-        adds_runs_f, instructions_f, addresses_f, len(instructions_data),
-        code_table, cache,
-        target_window_len)
+    out_buffer = window.execute(src, code_table)
 
-    if win_indicator & VCD_ADLER32:
-        # Verify the Adler-32
-        actual_adler = zlib.adler32(out_buffer)
-        if expected_adler != actual_adler:
-            print("WARNING: Adler-32 checksum didn't match!"
-                f' (expected {expected_adler:08x}, got {actual_adler:08x}).'
-                ' Output is probably wrong!')
+    window.check_adler32(out_buffer)
 
     # Write output data
     out.write(out_buffer)
@@ -352,7 +577,7 @@ def _apply_vcdiff_window_inner_loop(
         src, src_seg_pos, src_seg_len,
         adds_runs_f, instructions_f, addresses_f, instructions_data_len,
         code_table, cache,
-        target_window_len) -> bytearray:
+        target_window_len, out_buffer=None) -> Union[bytearray, memoryview]:
     """Optimized namespace for the hot VCDIFF-instruction-processing loop"""
 
     # Assign this function to a local, so we can avoid global namespace lookups
@@ -365,8 +590,11 @@ def _apply_vcdiff_window_inner_loop(
     if target_window_len > 0x8000000:
         raise ValueError(f'Refusing to allocate memory for an enormous window size ({target_window_len})')
 
-    # Create the output buffer
-    out_buffer = bytearray(target_window_len)
+    # Create the output buffer, unless the caller provided one
+    if out_buffer is None:
+        out_buffer = bytearray(target_window_len)
+    elif len(out_buffer) != target_window_len:
+        raise ValueError('Output buffer is the wrong size for the target window')
     del target_window_len
     out_cursor = 0
 
@@ -427,20 +655,769 @@ def _apply_vcdiff_window_inner_loop(
     return out_buffer
 
 
-def apply_vcdiff(src: BinaryIO, diff: BinaryIO, out: BinaryIO) -> Optional[bytes]:
+def apply_vcdiff(src: Union[BinaryIO, bytes], diff: Union[BinaryIO, bytes],
+        out: BinaryIO,
+        progress: Optional[Callable[[int, int], None]] = None) -> Optional[bytes]:
     """
     Apply a VCDIFF (RFC 3284) patch to a file stream. Compatible with
     (most of) xdelta3's format extensions.
 
     src: the "source" file, which must be opened in binary-read mode.
+        A bytes-like object (including a memoryview) is also accepted.
     diff: the VCDIFF file, which must be opened in binary-read mode.
+        A bytes-like object (including a memoryview) is also accepted.
     out: the output file, which must be opened in binary-write mode.
+    progress: if provided, called as progress(done, total) after each
+        window, where both values are measured in bytes of the diff.
+        (total is 0 if the diff isn't seekable.)
 
     Returns the xdelta3 "appdata" (application-specific data -- a small
     bytestring from the file header), or None if there isn't any.
     """
+    src = as_binary_io(src)
+    diff = as_binary_io(diff)
+
+    if hasattr(diff, 'seekable') and not diff.seekable():
+        # We can't find the end of a pipe or socket in advance, so let
+        # the push-mode decoder figure out where the windows end instead
+        decoder = VCDIFFStreamDecoder(src, out)
+        while True:
+            data = diff.read(STREAM_READ_SIZE)
+            if not data:
+                break
+            if decoder.feed(data) and progress is not None:
+                progress(decoder.bytes_fed, 0)
+        return decoder.close()
+
+    code_table, decompressors, appdata = read_vcdiff_header(diff)
+
+    # After the header, a VCDIFF file is just a bunch of windows in a row.
+    # So we apply them one by one until we reach the end of the file.
+    diff_len = get_file_len(diff)
+    while diff.tell() < diff_len:
+        apply_vcdiff_window(src, diff, out, code_table, decompressors)
+        if progress is not None:
+            progress(diff.tell(), diff_len)
+
+    return appdata
+
+
+def decode_vcdiff_windows(src: Union[BinaryIO, bytes], diff: Union[BinaryIO, bytes],
+        ranges: List[Tuple[int, int]]) -> List[Tuple[int, bytearray]]:
+    """
+    Decode only the windows whose target data overlaps any of the given
+    (start, end) ranges of the output, and return (target offset, target
+    window) for each of them. This is for repairing parts of an output
+    that turned out to be wrong.
+
+    Every window still has to be decompressed (the decompressors are
+    stateful), but only the selected ones are run.
+    """
+    src = as_binary_io(src)
+    diff = as_binary_io(diff)
+
+    code_table, decompressors, _ = read_vcdiff_header(diff)
+    diff_len = get_file_len(diff)
+
+    windows = []
+    target_offset = 0
+    while diff.tell() < diff_len:
+        window = read_vcdiff_window(diff)
+        window.decompress(decompressors)
+
+        window_end = target_offset + window.target_window_len
+        if any(start < window_end and target_offset < end for start, end in ranges):
+            target_window = window.execute(src, code_table)
+            window.check_adler32(target_window)
+            windows.append((target_offset, target_window))
+
+        target_offset = window_end
+
+    return windows
+
+
+def apply_vcdiff_pipelined(src: Union[BinaryIO, bytes], diff: Union[BinaryIO, bytes],
+        out: BinaryIO,
+        progress: Optional[Callable[[int, int], None]] = None,
+        output_hash: Optional['hashlib._Hash'] = None,
+        queue_size: int = 2) -> Optional[bytes]:
+    """
+    Like apply_vcdiff(), but split into three pipelined stages, each on
+    its own thread and connected by bounded queues:
+
+    1. Read the next window and decompress its three data streams
+       (concurrently with each other)
+    2. Run the window's instructions
+    3. Verify the Adler-32, update output_hash (if provided) with the
+       target window, and write it
+
+    Stages 1 and 3 are mostly spent in C code that releases the GIL
+    (lzma, zlib, hashlib, file writes), so they overlap with stage 2.
+
+    The diff must be seekable. progress is called from the stage-3
+    thread.
+    """
+    src = as_binary_io(src)
+    diff = as_binary_io(diff)
+
+    code_table, decompressors, appdata = read_vcdiff_header(diff)
+    diff_len = get_file_len(diff)
+
+    decompressed_queue = queue.Queue(queue_size)
+    executed_queue = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    END = object()
+
+    def put(q: queue.Queue, item) -> None:
+        # Give up if another stage failed, since nobody may be reading
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.05)
+                return
+            except queue.Full:
+                pass
+
+    def put_end(q: queue.Queue) -> None:
+        # The end marker always has to get through, or the next stage
+        # would wait for it forever. If the next stage is gone, make
+        # room for it ourselves.
+        while True:
+            try:
+                q.put(END, timeout=0.05)
+                return
+            except queue.Full:
+                if stop.is_set():
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def read_and_decompress() -> None:
+        try:
+            with concurrent.futures.ThreadPoolExecutor(3) as executor:
+                while diff.tell() < diff_len and not stop.is_set():
+                    window = read_vcdiff_window(diff)
+                    window.decompress(decompressors, executor)
+                    put(decompressed_queue, (window, diff.tell()))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put_end(decompressed_queue)
+
+    def verify_and_write() -> None:
+        try:
+            while True:
+                item = executed_queue.get()
+                if item is END:
+                    return
+                if stop.is_set():
+                    continue
+
+                window, out_buffer, diff_pos = item
+                window.check_adler32(out_buffer)
+                if output_hash is not None:
+                    output_hash.update(out_buffer)
+                out.write(out_buffer)
+
+                if progress is not None:
+                    progress(diff_pos, diff_len)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    reader = threading.Thread(target=read_and_decompress, name='vcdiff-reader')
+    writer = threading.Thread(target=verify_and_write, name='vcdiff-writer')
+    reader.start()
+    writer.start()
+
+    try:
+        while True:
+            item = decompressed_queue.get()
+            if item is END:
+                break
+            if stop.is_set():
+                continue
+
+            window, diff_pos = item
+            put(executed_queue, (window, window.execute(src, code_table), diff_pos))
+
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+        while decompressed_queue.get() is not END:
+            pass
+
+    finally:
+        put_end(executed_queue)
+        reader.join()
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    return appdata
+
+
+def is_free_threaded() -> bool:
+    """
+    Check if this is a free-threaded ("no-GIL") Python build, running
+    with the GIL actually disabled (it can be re-enabled at runtime, e.g.
+    with PYTHON_GIL=1, or by importing an extension that needs it)
+    """
+    return not getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+def apply_vcdiff_threaded(src: Union[BinaryIO, bytes], diff: Union[BinaryIO, bytes],
+        out: BinaryIO,
+        progress: Optional[Callable[[int, int], None]] = None,
+        max_workers: Optional[int] = None) -> Optional[bytes]:
+    """
+    Like apply_vcdiff(), but runs the windows' instructions in parallel
+    on a thread pool.
+
+    A window's COPYs can only read from the source and from earlier in
+    the same target window (VCD_TARGET windows aren't supported at all),
+    so the windows don't depend on each other: they all read from one
+    shared source buffer, and each writes to its own slice of one
+    preallocated output buffer. Secondary decompression still has to
+    happen in order, since the decompressors are stateful, so that's
+    done on the calling thread while earlier windows run.
+
+    This only runs faster on free-threaded builds (see
+    is_free_threaded()); with the GIL, only one window can run at a time
+    anyway, so max_workers defaults to 1 then, and to the CPU count
+    otherwise.
+
+    The diff must be seekable, and the whole output is kept in memory
+    until it's written at the end. progress is called as windows finish,
+    in order.
+    """
+    src = _as_random_access_buffer(src)
+    try:
+        return _apply_vcdiff_threaded(src, diff, out, progress, max_workers)
+    finally:
+        if isinstance(src, mmap.mmap):
+            src.close()
+
+
+def _apply_vcdiff_threaded(src: Union[BytesLike, mmap.mmap], diff: Union[BinaryIO, bytes], out: BinaryIO,
+        progress: Optional[Callable[[int, int], None]], max_workers: Optional[int]) -> Optional[bytes]:
+    # (apply_vcdiff_threaded(), once the source is a buffer)
+    diff = as_binary_io(diff)
+    if max_workers is None:
+        max_workers = (os.cpu_count() or 1) if is_free_threaded() else 1
+
+    code_table, decompressors, appdata = read_vcdiff_header(diff)
+    diff_len = get_file_len(diff)
+
+    # (read_vcdiff_window() checks each window's length against
+    # MAX_TARGET_WINDOW_LEN before any of this is allocated)
+    windows = []
+    while diff.tell() < diff_len:
+        windows.append((read_vcdiff_window(diff), diff.tell()))
+
+    out_buffer = bytearray(sum(window.target_window_len for window, _ in windows))
+    out_view = memoryview(out_buffer)
+
+    def run_window(window: VCDIFFWindow, window_view: memoryview) -> None:
+        # (Each thread needs its own file position in the source. The
+        # reader is released even on errors, since the source may be a
+        # memory map that has to be closed afterwards.)
+        reader = BufferReader(src)
+        try:
+            window.execute(reader, code_table, window_view)
+        finally:
+            reader.release()
+        window.check_adler32(window_view)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='vcdiff-window') as executor:
+        futures = []
+        try:
+            target_pos = 0
+            for window, diff_pos in windows:
+                window.decompress(decompressors)
+                window_view = out_view[target_pos : target_pos + window.target_window_len]
+                futures.append((executor.submit(run_window, window, window_view), diff_pos))
+                target_pos += window.target_window_len
+
+            for future, diff_pos in futures:
+                future.result()
+                if progress is not None:
+                    progress(diff_pos, diff_len)
+
+        except BaseException:
+            for future, _ in futures:
+                future.cancel()
+            raise
+
+    out.write(out_buffer)
+    return appdata
+
+
+# Checkpoints for apply_vcdiff_resumable() are saved in a JSON sidecar
+# file next to the partial output:
+#
+# - "version": CHECKPOINT_VERSION
+# - "patchMd5": MD5 of the whole patch
+# - "sourceId": whatever the caller uses to identify the source file
+# - "windowIndex": how many windows have been completed
+# - "diffOffset": where the next window starts in the patch
+# - "targetOffset": how much of the output has been written
+# - "outputMd5": MD5 of the output written so far
+#
+# Neither hashlib nor lzma objects can be serialized, so the output hash
+# is re-derived by hashing the partial output again (which also checks
+# that it hasn't been damaged), and the LZMA decompressors are re-synced
+# by decompressing -- but not running -- the completed windows. Both are
+# far quicker than running the windows again.
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+# Save a checkpoint after at least this much output
+DEFAULT_CHECKPOINT_INTERVAL = 0x400000
+
+
+def _load_checkpoint(checkpoint_fp: Path, out_fp: Path,
+        patch_md5: str, source_id: str) -> Optional[dict]:
+    """
+    Load a checkpoint, if there's one that matches this patch, source
+    and partial output file
+    """
+    try:
+        checkpoint = json.loads(checkpoint_fp.read_text(encoding='utf-8'))
+        if (checkpoint['version'] != CHECKPOINT_VERSION
+                or checkpoint['patchMd5'] != patch_md5
+                or checkpoint['sourceId'] != source_id
+                or out_fp.stat().st_size < checkpoint['targetOffset']):
+            return None
+        return checkpoint
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _save_checkpoint(checkpoint_fp: Path, checkpoint: dict) -> None:
+    """Atomically replace the checkpoint file"""
+    temp_fp = checkpoint_fp.with_name(checkpoint_fp.name + '.tmp')
+    with temp_fp.open('w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_fp, checkpoint_fp)
+
+
+def _hash_file_prefix(f: BinaryIO, length: int, hash_obj: 'hashlib._Hash') -> None:
+    """Update a hash object with the first length bytes of a file"""
+    f.seek(0)
+    while length > 0:
+        data = f.read(min(length, 0x100000))
+        if not data:
+            raise EOFError('File is shorter than expected')
+        hash_obj.update(data)
+        length -= len(data)
+
+
+def apply_vcdiff_resumable(src: Union[BinaryIO, bytes], diff: Union[BinaryIO, bytes],
+        out_fp: Path, checkpoint_fp: Optional[Path] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        output_hash: Optional['hashlib._Hash'] = None,
+        source_id: str = '',
+        checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL) -> Optional[bytes]:
+    """
+    Like apply_vcdiff(), but writes to a file path, and saves a
+    checkpoint at window boundaries (every checkpoint_interval bytes of
+    output) so that, if it's interrupted, calling it again with the same
+    arguments continues from the last checkpoint instead of starting
+    over.
+
+    out_fp: path of the output file. Until the function returns, this
+        is a partial output file.
+    checkpoint_fp: path of the checkpoint file. Default: out_fp with
+        ".checkpoint" added. It's deleted once the patch has been
+        applied completely.
+    source_id: a string identifying the source file (such as its hash).
+        A checkpoint is only used if this and the patch match.
+    output_hash: if provided, updated with the complete output
+        (including any part that was written before resuming).
+
+    The diff must be seekable. Returns the xdelta3 "appdata", like
+    apply_vcdiff().
+    """
+    src = as_binary_io(src)
+    diff = as_binary_io(diff)
+    out_fp = Path(out_fp)
+    if checkpoint_fp is None:
+        checkpoint_fp = out_fp.with_name(out_fp.name + CHECKPOINT_SUFFIX)
+
+    patch_md5 = hashlib.md5()
+    _hash_file_prefix(diff, get_file_len(diff), patch_md5)
+    patch_md5 = patch_md5.hexdigest()
+    diff.seek(0)
+
+    code_table, decompressors, appdata = read_vcdiff_header(diff)
+    diff_len = get_file_len(diff)
+
+    window_index = target_offset = 0
+    prefix_md5 = hashlib.md5()
+    out = None
+
+    checkpoint = _load_checkpoint(checkpoint_fp, out_fp, patch_md5, source_id)
+    if checkpoint is not None:
+        out = out_fp.open('r+b')
+        try:
+            # Make sure the output so far is still what it was
+            _hash_file_prefix(out, checkpoint['targetOffset'], prefix_md5)
+            if prefix_md5.hexdigest() != checkpoint['outputMd5']:
+                raise ValueError('Partial output file has changed')
+
+            # Re-sync the decompressors
+            if isinstance(decompressors.adds_runs, XdeltaNullDecompressor):
+                diff.seek(checkpoint['diffOffset'])
+            else:
+                for _ in range(checkpoint['windowIndex']):
+                    read_vcdiff_window(diff).decompress(decompressors)
+            if diff.tell() != checkpoint['diffOffset']:
+                raise ValueError('Checkpoint does not match the patch')
+
+            if output_hash is not None:
+                _hash_file_prefix(out, checkpoint['targetOffset'], output_hash)
+
+        except (ValueError, EOFError, IndexError, lzma.LZMAError):
+            # Start over
+            out.close()
+            out = None
+            prefix_md5 = hashlib.md5()
+            diff.seek(0)
+            code_table, decompressors, appdata = read_vcdiff_header(diff)
+
+        else:
+            window_index = checkpoint['windowIndex']
+            target_offset = checkpoint['targetOffset']
+            out.seek(target_offset)
+            out.truncate()
+
+    if out is None:
+        out = out_fp.open('w+b')
+
+    with out:
+        last_checkpoint = target_offset
+
+        while diff.tell() < diff_len:
+            window = read_vcdiff_window(diff)
+            window.decompress(decompressors)
+            target_window = window.execute(src, code_table)
+            window.check_adler32(target_window)
+
+            out.write(target_window)
+            prefix_md5.update(target_window)
+            if output_hash is not None:
+                output_hash.update(target_window)
+            window_index += 1
+            target_offset += len(target_window)
+
+            if target_offset - last_checkpoint >= checkpoint_interval and diff.tell() < diff_len:
+                # The output has to be on disk before the checkpoint
+                # that describes it
+                out.flush()
+                os.fsync(out.fileno())
+                _save_checkpoint(checkpoint_fp, {
+                    'version': CHECKPOINT_VERSION,
+                    'patchMd5': patch_md5,
+                    'sourceId': source_id,
+                    'windowIndex': window_index,
+                    'diffOffset': diff.tell(),
+                    'targetOffset': target_offset,
+                    'outputMd5': prefix_md5.hexdigest(),
+                })
+                last_checkpoint = target_offset
+
+            if progress is not None:
+                progress(diff.tell(), diff_len)
+
+    try:
+        checkpoint_fp.unlink()
+    except FileNotFoundError:
+        pass
+
+    return appdata
+
+
+# apply_vcdiff_copy_range(): a decoder for when the source and the output
+# are both real files. Most of a ROM patch's target is source data copied
+# over unchanged (or just shifted), which the normal decoder reads into
+# the window's buffer and then writes out again. Here, long source COPYs
+# are handed to os.copy_file_range() instead, so those bytes never pass
+# through Python at all (and on filesystems with reflinks, may not even
+# be copied). Only ADD, RUN and target COPY data -- and short source
+# COPYs, which aren't worth a system call -- are written from Python.
+#
+# A target COPY can read from anywhere earlier in its window, though, so
+# source COPYs that a target COPY reads from are still done in Python.
+#
+# The Adler-32 of windows with any kernel-side copies can't be checked
+# (that would mean reading them back), so callers should check the
+# output's hash instead.
+
+HAVE_COPY_RANGE = hasattr(os, 'copy_file_range')
+
+# Source COPYs at least this long are done with copy_file_range()
+COPY_RANGE_MIN_SIZE = 0x4000
+
+
+def _copy_range(src_fd: int, out_fd: int, src_pos: int, out_pos: int, size: int) -> None:
+    """
+    Copy size bytes from src_pos in one file to out_pos in another,
+    without going through Python if possible
+    """
+    while size > 0:
+        try:
+            copied = os.copy_file_range(src_fd, out_fd, size, src_pos, out_pos)
+        except OSError:
+            # (Some filesystems and older kernels don't support it, or
+            # not across filesystems)
+            data = os.pread(src_fd, size, src_pos)
+            if not data:
+                raise EOFError('Source file is truncated')
+            copied = os.pwrite(out_fd, data, out_pos)
+        if copied == 0:
+            raise EOFError('Source file is truncated')
+        src_pos += copied
+        out_pos += copied
+        size -= copied
+
+
+def _execute_window_copy_range(window: VCDIFFWindow, src: BinaryIO, code_table: VCDIFFCodeTable,
+        src_file_len: int, min_copy_size: int) -> (bytearray, List[Tuple[int, int, int]]):
+    """
+    Run a (decompressed) window's instructions, except for the long
+    source COPYs that can be done with copy_file_range(). Return the
+    target window (with zeros where those go), and a list of
+    (target window offset, source position, size) for them.
+    """
+    instructions = list(window.iter_instructions(code_table))
+    src_seg_len = window.src_seg_len
+
+    # Ranges of the window that target COPYs read from
+    target_reads = sorted((arg - src_seg_len, arg - src_seg_len + size)
+        for type, size, arg in instructions if type == INST_TYPE_COPY and arg >= src_seg_len)
+    read_starts = [start for start, _ in target_reads]
+    # (Running maximum of the ends, so that one bisect finds any overlap)
+    read_ends = list(itertools.accumulate((end for _, end in target_reads), max))
+
+    def is_read_by_target_copy(start: int, end: int) -> bool:
+        i = bisect.bisect_left(read_starts, end) - 1
+        return i >= 0 and read_ends[i] > start
+
+    out_buffer = bytearray(window.target_window_len)
+    copies = []
+    pos = 0
+    for type, size, arg in instructions:
+        if type == INST_TYPE_ADD:
+            out_buffer[pos : pos + size] = arg
+        elif type == INST_TYPE_RUN:
+            out_buffer[pos : pos + size] = bytes([arg]) * size
+        elif arg < src_seg_len:
+            src_pos = window.src_seg_pos + arg
+            if (size >= min_copy_size and src_pos + size <= src_file_len
+                    and not is_read_by_target_copy(pos, pos + size)):
+                copies.append((pos, src_pos, size))
+            else:
+                src.seek(src_pos)
+                out_buffer[pos : pos + size] = src.read(size)
+        else:
+            addr = arg - src_seg_len
+            if addr + size <= pos:
+                out_buffer[pos : pos + size] = out_buffer[addr : addr + size]
+            else:
+                for i in range(size):  # (overlapping)
+                    out_buffer[pos + i] = out_buffer[addr + i]
+        pos += size
+
+    return out_buffer, copies
+
+
+def apply_vcdiff_copy_range(src: BinaryIO, diff: Union[BinaryIO, bytes], out: BinaryIO,
+        progress: Optional[Callable[[int, int], None]] = None,
+        min_copy_size: int = COPY_RANGE_MIN_SIZE,
+        src_fd: Optional[int] = None, src_limit: Optional[int] = None) -> int:
+    """
+    Like apply_vcdiff(), but src and out must both be real files (opened
+    in binary-read and binary-write mode, respectively), and long source
+    COPYs are done by the OS with copy_file_range() (see above). Only
+    available where the OS supports that (see HAVE_COPY_RANGE).
+
+    src can also be any file-like object that reads the same data as the
+    file descriptor src_fd -- at least up to src_limit, if that's given.
+    The OS only copies from before src_limit; anything after it is read
+    through src. (For a normalized view of a ROM, say, that's only the
+    same as the file up to the end of the used area.)
+
+    The Adler-32 of windows with kernel-side copies isn't checked.
+
+    Returns the number of bytes that were copied by the OS.
+    """
+    if src_fd is None:
+        src_fd = src.fileno()
+    out_fd = out.fileno()
+    src_file_len = os.fstat(src_fd).st_size
+    if src_limit is not None:
+        src_file_len = min(src_file_len, src_limit)
+    diff = as_binary_io(diff)
+
+    code_table, decompressors, _ = read_vcdiff_header(diff)
+    diff_len = get_file_len(diff)
+
+    copied_bytes = 0
+    target_offset = out.tell()
+    while diff.tell() < diff_len:
+        window = read_vcdiff_window(diff)
+        window.decompress(decompressors)
+        out_buffer, copies = _execute_window_copy_range(window, src, code_table,
+            src_file_len, min_copy_size)
+
+        if not copies:
+            window.check_adler32(out_buffer)
+            out.write(out_buffer)
+        else:
+            # Write the parts in between the copies from Python, and let
+            # the OS do the rest
+            view = memoryview(out_buffer)
+            pos = 0
+            for copy_pos, src_pos, size in copies + [(len(out_buffer), 0, 0)]:
+                if copy_pos > pos:
+                    out.seek(target_offset + pos)
+                    out.write(view[pos:copy_pos])
+                pos = copy_pos + size
+            view.release()
+            out.flush()
+
+            for copy_pos, src_pos, size in copies:
+                _copy_range(src_fd, out_fd, src_pos, target_offset + copy_pos, size)
+                copied_bytes += size
+
+        target_offset += len(out_buffer)
+        out.seek(target_offset)
+
+        if progress is not None:
+            progress(diff.tell(), diff_len)
+
+    out.truncate(target_offset)
+    return copied_bytes
+
+
+class VCDIFFStreamDecoder:
+    """
+    Incremental ("push-mode") VCDIFF decoder, for diffs that arrive a
+    piece at a time -- from a pipe, a socket, a decompressor, etc. -- and
+    can't be seeked.
+
+    Call feed() with each piece of the diff as it arrives, and close()
+    at the end. Each target window is decoded and written to `out` as
+    soon as all of its data has arrived. Only the window that's
+    currently being received is buffered.
+    """
+    appdata: Optional[bytes]
+    bytes_fed: int
+    windows_done: int
+
+    def __init__(self, src: Union[BinaryIO, bytes], out: BinaryIO):
+        self.src = as_binary_io(src)
+        self.out = out
+        self.appdata = None
+        self.bytes_fed = 0
+        self.windows_done = 0
+
+        self._buffer = bytearray()
+        # Don't bother trying to parse anything until the buffer is at
+        # least this long
+        self._needed = 0
+        self._code_table = None
+        self._decompressors = None
+        self._closed = False
+
+    def feed(self, data: BytesLike) -> int:
+        """
+        Add more of the diff. Returns the number of target windows that
+        were completed (and written) as a result.
+        """
+        if self._closed:
+            raise ValueError('Decoder is already closed')
+
+        self._buffer += data
+        self.bytes_fed += len(data)
+
+        completed = 0
+        while self._buffer and len(self._buffer) >= self._needed:
+            window = None
+
+            reader = BufferReader(self._buffer)
+            try:
+                if self._code_table is None:
+                    self._code_table, self._decompressors, self.appdata = read_vcdiff_header(reader)
+                else:
+                    window = read_vcdiff_window_header(reader)
+
+                    window_end = reader.tell() + sum(window.data_lens)
+                    if len(self._buffer) < window_end:
+                        # Now we know exactly how much we're waiting for
+                        self._needed = window_end
+                        break
+
+                    window.read_data(reader)
+
+            except (EOFError, IndexError):
+                # Partway through a header -- wait for at least one more
+                # byte
+                self._needed = len(self._buffer) + 1
+                break
+
+            finally:
+                consumed = reader.tell()
+                reader.release()
+
+            del self._buffer[:consumed]
+            self._needed = 0
+
+            if window is not None:
+                window.decompress(self._decompressors)
+                out_buffer = window.execute(self.src, self._code_table)
+                window.check_adler32(out_buffer)
+                self.out.write(out_buffer)
+
+                self.windows_done += 1
+                completed += 1
+
+        return completed
+
+    def close(self) -> Optional[bytes]:
+        """
+        Signal the end of the diff. Raises ValueError if it ended
+        partway through something. Returns the xdelta3 appdata, like
+        apply_vcdiff().
+        """
+        self._closed = True
+
+        if self._code_table is None:
+            raise ValueError('VCDIFF data ended partway through the header')
+        if self._buffer:
+            raise ValueError('VCDIFF data ended partway through a window')
+
+        return self.appdata
+
+
+def read_vcdiff_header(diff: BinaryIO) -> (VCDIFFCodeTable, XdeltaDecompressorTriple, Optional[bytes]):
+    """
+    Read the header of a VCDIFF file, leaving it positioned at the first
+    window. Returns the code table, the secondary decompressors, and the
+    xdelta3 appdata (or None).
+    """
     header_1234 = diff.read(4)
 
+    if len(header_1234) < 4:
+        raise EOFError('VCDIFF header is truncated')
     if header_1234 != bytes.fromhex('D6 C3 C4 00'):
         raise ValueError(f'Wrong VCDIFF magic ({header_1234.hex()})')
 
@@ -456,20 +1433,648 @@ def apply_vcdiff(src: BinaryIO, diff: BinaryIO, out: BinaryIO) -> Optional[bytes
         # Note: xdelta3 seems to not support this either
         raise NotImplementedError('Custom code tables not implemented')
     else:
-        code_table = VCDIFFCodeTable.build_default()
+        code_table = VCDIFFCodeTable.default()
 
     if header_indicator & VCD_APPHEADER:
-        appdata = diff.read(read_vcdiff_integer(diff))
+        appdata_len = read_vcdiff_integer(diff)
+        appdata = diff.read(appdata_len)
+        if len(appdata) < appdata_len:
+            raise EOFError('VCDIFF header is truncated')
     else:
         appdata = None
 
-    # After the header, a VCDIFF file is just a bunch of windows in a row.
-    # So we apply them one by one until we reach the end of the file.
-    diff_len = get_file_len(diff)
+    return code_table, decompressors, appdata
+
+
+async def run_in_executor_to_completion(loop: 'asyncio.AbstractEventLoop',
+        executor: Optional[concurrent.futures.Executor], func: Callable, *args):
+    """
+    Like loop.run_in_executor(), but if the awaiting task is cancelled,
+    wait for func to actually finish before re-raising CancelledError.
+    (A function that's already running in a thread can't be stopped, and
+    it mustn't keep using files the caller is about to close.)
+    """
+    import asyncio
+    fut = loop.run_in_executor(executor, func, *args)
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        await asyncio.wait({fut})
+        raise
+
+
+async def iter_apply_vcdiff_async(src: Union[BinaryIO, bytes], diff: Union[BinaryIO, bytes],
+        out: BinaryIO,
+        executor: Optional[concurrent.futures.Executor] = None) -> AsyncIterator[Tuple[int, int]]:
+    """
+    asyncio version of apply_vcdiff(), as an async iterator that applies
+    one window per iteration and yields progress as (done, total)
+    tuples, measured in bytes of the diff.
+
+    All of the actual work (file I/O included) happens in the executor
+    (default: the event loop's default executor). If the consuming task
+    is cancelled, patching stops cleanly at the end of the current
+    window.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+
+    src = as_binary_io(src)
+    diff = as_binary_io(diff)
+
+    code_table, decompressors, _ = await run_in_executor_to_completion(
+        loop, executor, read_vcdiff_header, diff)
+
+    diff_len = await run_in_executor_to_completion(loop, executor, get_file_len, diff)
     while diff.tell() < diff_len:
-        apply_vcdiff_window(src, diff, out, code_table, decompressors)
+        await run_in_executor_to_completion(loop, executor,
+            apply_vcdiff_window, src, diff, out, code_table, decompressors)
+        yield diff.tell(), diff_len
 
-    return appdata
+
+async def apply_vcdiff_async(src: Union[BinaryIO, bytes], diff: Union[BinaryIO, bytes],
+        out: BinaryIO,
+        executor: Optional[concurrent.futures.Executor] = None,
+        progress: Optional[Callable[[int, int], None]] = None) -> None:
+    """
+    asyncio version of apply_vcdiff(). See iter_apply_vcdiff_async() for
+    details.
+    """
+    async for done, total in iter_apply_vcdiff_async(src, diff, out, executor):
+        if progress is not None:
+            progress(done, total)
+
+
+########################################################################
+# Encoding
+########################################################################
+
+# The writer takes each window as a list of "edit operations", which
+# use absolute positions in the source and target files:
+#
+# - ('add', data)
+# - ('run', byte, size)
+# - ('src', position, size): copy from the source file
+# - ('tgt', position, size): copy from earlier in the target file (but
+#   not before the start of the current window, since xdelta3 doesn't
+#   support VCD_TARGET windows). May overlap the data being produced.
+#
+# and takes care of choosing the source segment, instruction codes
+# (including the combined ADD+COPY codes) and address modes.
+
+EditOp = tuple
+
+# xdelta3's .xz stream headers for LZMA secondary compression: stream
+# header with no integrity check, then a block header with one LZMA2
+# filter (8 MiB dictionary) and no sizes
+LZMA_DICT_SIZE = 0x800000
+XZ_STREAM_HEADER = b'\xfd7zXZ\0' + b'\0\0' + struct.pack('<I', zlib.crc32(b'\0\0'))
+_XZ_BLOCK_HEADER = bytes([2, 0, 0x21, 1, 0x16, 0, 0, 0])  # 0x16 = 8 MiB
+XZ_BLOCK_HEADER = _XZ_BLOCK_HEADER + struct.pack('<I', zlib.crc32(_XZ_BLOCK_HEADER))
+
+
+def encode_vcdiff_integer(value: int) -> bytes:
+    """
+    Encode a variable-length VCDIFF integer. See RFC 3284, section 2.
+    """
+    out = [value & 0x7f]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+class AbstractXdeltaCompressor:
+    """
+    Superclass for classes that are able to compress "secondary
+    compression" formats. Like the decompressors, one is used per data
+    stream, across all windows.
+    """
+    def compress_chunk(self, data: bytes) -> Optional[bytes]:
+        """
+        Compress one window's worth of data. Returns None (and leaves
+        the compressor's state alone) if that wouldn't make it smaller,
+        in which case the data should be stored uncompressed, as xdelta3
+        does.
+        """
+        raise NotImplementedError
+
+
+class XdeltaLZMACompressor(AbstractXdeltaCompressor):
+    """
+    Class implementing the AbstractXdeltaCompressor interface for LZMA
+    compression.
+
+    xdelta3 writes one .xz stream per data stream, and flushes it (but
+    doesn't end it) after every window. Python's lzma module can't do
+    that kind of flush, so instead, this writes the .xz stream and block
+    headers itself, and then compresses each window as separate raw
+    LZMA2 chunks (starting with a dictionary reset, and without the
+    end-of-data marker).
+
+    min_savings: only use the compressed data if it's at least this
+        fraction smaller than the original. Decompressing data that
+        barely compresses can take longer than it saves.
+    """
+    def __init__(self, min_savings: float = 0.0):
+        self.min_savings = min_savings
+        self._started = False
+
+    def compress_chunk(self, data: bytes) -> Optional[bytes]:
+        """Compress one window's worth of data"""
+        if not data:
+            return None
+
+        out = bytearray(encode_vcdiff_integer(len(data)))
+        if not self._started:
+            out += XZ_STREAM_HEADER
+            out += XZ_BLOCK_HEADER
+
+        comp = lzma.LZMACompressor(lzma.FORMAT_RAW,
+            filters=[{'id': lzma.FILTER_LZMA2, 'dict_size': LZMA_DICT_SIZE}])
+        chunks = comp.compress(data) + comp.flush()
+        out += memoryview(chunks)[:-1]  # (strip the end marker)
+
+        if len(out) >= len(data) * (1 - self.min_savings):
+            return None
+
+        self._started = True
+        return bytes(out)
+
+
+class VCDIFFInstructionEncoder:
+    """
+    Encodes one window's instructions into the three data streams,
+    using the code table's combined instruction codes where possible and
+    the smallest address encoding for each COPY.
+    """
+    adds_runs: bytearray
+    instructions: bytearray
+    addresses: bytearray
+
+    def __init__(self, code_table: VCDIFFCodeTable, src_seg_len: int,
+            address_cache: bool = True):
+        self.code_table = code_table
+        self.single_codes, self.pair_codes = get_code_table_reverse_maps(code_table)
+        self.cache = VCDIFFCache(code_table.s_near, code_table.s_same)
+        self.address_cache = address_cache
+        self.here = src_seg_len
+
+        self.adds_runs = bytearray()
+        self.instructions = bytearray()
+        self.addresses = bytearray()
+
+        # The last instruction (as a code-table key), if it could still
+        # be combined with the next one
+        self._pending = None
+
+    def _emit(self, key: Instruction) -> None:
+        """Emit an instruction, with the size embedded in the code"""
+        if self._pending is not None:
+            code = self.pair_codes.get((self._pending, key))
+            if code is not None:
+                self.instructions.append(code)
+                self._pending = None
+                return
+            self.instructions.append(self.single_codes[self._pending])
+        self._pending = key
+
+    def _emit_explicit(self, type: int, size: int, mode: int) -> None:
+        """Emit an instruction, with the size embedded if possible"""
+        key = Instruction(type, size, mode)
+        if size and key in self.single_codes:
+            self._emit(key)
+        else:
+            self.flush()
+            self.instructions.append(self.single_codes[Instruction(type, 0, mode)])
+            self.instructions += encode_vcdiff_integer(size)
+
+    def flush(self) -> None:
+        if self._pending is not None:
+            self.instructions.append(self.single_codes[self._pending])
+            self._pending = None
+
+    def add(self, data: BytesLike) -> None:
+        self._emit_explicit(INST_TYPE_ADD, len(data), 0)
+        self.adds_runs += data
+        self.here += len(data)
+
+    def run(self, byte: int, size: int) -> None:
+        self._emit_explicit(INST_TYPE_RUN, size, 0)
+        self.adds_runs.append(byte)
+        self.here += size
+
+    def copy(self, addr: int, size: int) -> None:
+        """Copy from an address in the window's address space"""
+        cache = self.cache
+
+        # VCD_SELF and VCD_HERE
+        best_mode, best = VCD_SELF, encode_vcdiff_integer(addr)
+        encoded = encode_vcdiff_integer(self.here - addr)
+        if len(encoded) < len(best):
+            best_mode, best = VCD_HERE, encoded
+
+        if self.address_cache:
+            for i, near in enumerate(cache.near):
+                if addr >= near:
+                    encoded = encode_vcdiff_integer(addr - near)
+                    if len(encoded) < len(best):
+                        best_mode, best = 2 + i, encoded
+            if cache.s_same and len(best) > 1:
+                slot = addr % (cache.s_same * 256)
+                if cache.same[slot] == addr:
+                    best_mode, best = 2 + cache.s_near + slot // 256, bytes([slot % 256])
+
+        cache.cache_update(addr)
+
+        self._emit_explicit(INST_TYPE_COPY, size, best_mode)
+        self.addresses += best
+        self.here += size
+
+
+_reverse_maps_cache = {}
+
+def get_code_table_reverse_maps(code_table: VCDIFFCodeTable
+        ) -> Tuple[Dict[Instruction, int], Dict[Tuple[Instruction, Instruction], int]]:
+    """
+    Return dicts mapping single instructions and instruction pairs to
+    their codes in a code table
+    """
+    maps = _reverse_maps_cache.get(id(code_table))
+    if maps is None:
+        single_codes = {}
+        pair_codes = {}
+        for code, inst_pair in enumerate(code_table.i_code):
+            if len(inst_pair) == 1:
+                single_codes.setdefault(inst_pair[0], code)
+            else:
+                pair_codes.setdefault(tuple(inst_pair), code)
+        maps = _reverse_maps_cache[id(code_table)] = (single_codes, pair_codes)
+    return maps
+
+
+class VCDIFFWriter:
+    """
+    Writes a VCDIFF file in the format xdelta3 uses, one window at a
+    time. The file header is written immediately.
+
+    secondary: None, or VCD_COMPRESSION_LZMA
+    appheader: the xdelta3 "appdata" to include, if any
+    adler32: whether to include Adler-32 checksums of target windows
+    address_cache: whether to use the "near" and "same" address modes
+        (smaller patches), or only VCD_SELF and VCD_HERE
+    secondary_min_savings: see XdeltaLZMACompressor
+    """
+    def __init__(self, out: BinaryIO, secondary: Optional[int] = None,
+            appheader: Optional[bytes] = None, adler32: bool = True,
+            address_cache: bool = True, secondary_min_savings: float = 0.0):
+        self.out = out
+        self.adler32 = adler32
+        self.address_cache = address_cache
+        self.code_table = VCDIFFCodeTable.default()
+
+        if secondary is None:
+            self.compressors = None
+        elif secondary == VCD_COMPRESSION_LZMA:
+            self.compressors = [XdeltaLZMACompressor(secondary_min_savings) for _ in range(3)]
+        else:
+            raise NotImplementedError(f'Unsupported secondary compression type: {secondary}')
+
+        header = bytearray(b'\xd6\xc3\xc4\x00')
+        header_indicator = 0
+        if secondary is not None:
+            header_indicator |= VCD_DECOMPRESS
+        if appheader is not None:
+            header_indicator |= VCD_APPHEADER
+        header.append(header_indicator)
+        if secondary is not None:
+            header.append(secondary)
+        if appheader is not None:
+            header += encode_vcdiff_integer(len(appheader))
+            header += appheader
+        out.write(header)
+
+    def write_window(self, ops: List[EditOp], target_start: int,
+            target_window: Optional[BytesLike] = None) -> None:
+        """
+        Write a window made of the given edit operations. target_start
+        is the position of the window in the target file.
+        target_window (the data the window produces) is needed if
+        Adler-32 checksums are enabled.
+        """
+        src_ranges = [(op[1], op[1] + op[2]) for op in ops if op[0] == 'src']
+        if src_ranges:
+            src_seg_pos = min(start for start, _ in src_ranges)
+            src_seg_len = max(end for _, end in src_ranges) - src_seg_pos
+        else:
+            src_seg_pos = src_seg_len = 0
+
+        encoder = VCDIFFInstructionEncoder(self.code_table, src_seg_len, self.address_cache)
+        target_len = 0
+        for op in ops:
+            kind = op[0]
+            if kind == 'add':
+                encoder.add(op[1])
+                target_len += len(op[1])
+            elif kind == 'run':
+                encoder.run(op[1], op[2])
+                target_len += op[2]
+            elif kind == 'src':
+                encoder.copy(op[1] - src_seg_pos, op[2])
+                target_len += op[2]
+            elif kind == 'tgt':
+                if op[1] < target_start:
+                    raise ValueError('Target copies must stay within their window')
+                encoder.copy(src_seg_len + op[1] - target_start, op[2])
+                target_len += op[2]
+            else:
+                raise ValueError(f'Unknown edit operation: {kind}')
+        encoder.flush()
+
+        self.write_encoded_window(src_seg_pos, src_seg_len, target_len,
+            encoder.adds_runs, encoder.instructions, encoder.addresses, target_window)
+
+    def write_encoded_window(self, src_seg_pos: int, src_seg_len: int, target_len: int,
+            adds_runs: BytesLike, instructions: BytesLike, addresses: BytesLike,
+            target_window: Optional[BytesLike] = None) -> None:
+        """
+        Write a window whose data streams have already been encoded
+        (but not compressed)
+        """
+        streams = [adds_runs, instructions, addresses]
+        delta_indicator = 0
+        if self.compressors is not None:
+            for i, (compressor, flag) in enumerate(zip(self.compressors,
+                    [VCD_DATACOMP, VCD_INSTCOMP, VCD_ADDRCOMP])):
+                compressed = compressor.compress_chunk(bytes(streams[i]))
+                if compressed is not None:
+                    streams[i] = compressed
+                    delta_indicator |= flag
+
+        win_indicator = 0
+        window = bytearray()
+        if src_seg_len:
+            win_indicator |= VCD_SOURCE
+            window += encode_vcdiff_integer(src_seg_len)
+            window += encode_vcdiff_integer(src_seg_pos)
+
+        delta = bytearray(encode_vcdiff_integer(target_len))
+        delta.append(delta_indicator)
+        for data in streams:
+            delta += encode_vcdiff_integer(len(data))
+        if self.adler32:
+            if target_window is None:
+                raise ValueError('The target window is needed for its Adler-32 checksum')
+            win_indicator |= VCD_ADLER32
+            delta += zlib.adler32(target_window).to_bytes(4, 'big')
+
+        window += encode_vcdiff_integer(len(delta) + sum(len(data) for data in streams))
+
+        self.out.write(bytes([win_indicator]))
+        self.out.write(window)
+        self.out.write(delta)
+        for data in streams:
+            self.out.write(data)
+
+
+# Default block size for the encoder's source index
+ENCODER_BLOCK_SIZE = 32
+
+# The block size is increased for large sources, to keep the index from
+# having more blocks than this (each one costs about 100 bytes of RAM)
+ENCODER_MAX_INDEX_BLOCKS = 0x100000
+
+# Repeated bytes are encoded as RUNs from this length
+ENCODER_MIN_RUN_SIZE = 8
+
+# How much to compare at a time when extending matches (at first)
+_MATCH_COMPARE_STEP = 64
+
+_RUN_RE = re.compile(rb'(.)\1{%d,}' % (ENCODER_MIN_RUN_SIZE - 1), re.S)
+
+
+def split_runs(data: BytesLike) -> List[EditOp]:
+    """
+    Turn literal data into a list of 'add' and 'run' edit operations,
+    using RUNs for long repeated bytes
+    """
+    ops = []
+    pos = 0
+    for match in _RUN_RE.finditer(data):
+        if match.start() > pos:
+            ops.append(('add', data[pos : match.start()]))
+        ops.append(('run', data[match.start()], match.end() - match.start()))
+        pos = match.end()
+    if pos < len(data):
+        ops.append(('add', data[pos:]))
+    return ops
+
+
+def _match_length(buf_a: BytesLike, pos_a: int, buf_b: BytesLike, pos_b: int, limit: int) -> int:
+    """
+    Return how many bytes (up to limit) are the same in buf_a starting
+    at pos_a and buf_b starting at pos_b
+    """
+    n = 0
+    step = _MATCH_COMPARE_STEP
+    while n < limit:
+        k = min(step, limit - n)
+        if buf_a[pos_a + n : pos_a + n + k] == buf_b[pos_b + n : pos_b + n + k]:
+            n += k
+            step = min(step * 2, 0x10000)
+            continue
+
+        # Binary search for the first difference in this chunk. The first
+        # "lo" bytes are known to match, and the first "hi" don't.
+        lo, hi = 0, k
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if buf_a[pos_a + n + lo : pos_a + n + mid] == buf_b[pos_b + n + lo : pos_b + n + mid]:
+                lo = mid
+            else:
+                hi = mid
+        return n + lo
+
+    return n
+
+
+def _as_random_access_buffer(src) -> Union[BytesLike, mmap.mmap]:
+    """
+    Return the source file as something that can be sliced: the object
+    itself if it's bytes, a memory map if it's a real file, or
+    otherwise its contents
+    """
+    if isinstance(src, bytes):
+        return src
+    if not hasattr(src, 'read'):
+        return memoryview(src).cast('B')
+
+    try:
+        fileno = src.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fileno = None
+    if fileno is not None and os.fstat(fileno).st_size > 0:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    src.seek(0)
+    return src.read()
+
+
+class VCDIFFSourceIndex:
+    """
+    Maps Adler-32 checksums of the source file's (non-overlapping)
+    blocks to the first position they appear at, for finding matches
+    with a rolling checksum over the target
+    """
+    block_size: int
+    blocks: Dict[int, int]
+
+    def __init__(self, source: BytesLike, block_size: int = ENCODER_BLOCK_SIZE):
+        block_size = max(block_size, -(-len(source) // ENCODER_MAX_INDEX_BLOCKS))
+        self.block_size = block_size
+
+        blocks = self.blocks = {}
+        L_adler32 = zlib.adler32
+        for pos in range(0, len(source) - block_size + 1, block_size):
+            blocks.setdefault(L_adler32(source[pos : pos + block_size]), pos)
+
+
+def _encode_target_window(source: BytesLike, index: VCDIFFSourceIndex,
+        target: bytes, target_start: int) -> List[EditOp]:
+    """
+    Find matches for one target window, and return its edit operations
+    """
+    B = index.block_size
+    source_blocks = index.blocks
+    target_blocks = {}
+    n = len(target)
+    ops = []
+
+    L_adler32 = zlib.adler32
+    L_match_length = _match_length
+
+    def add_literal(end: int) -> None:
+        if add_start < end:
+            ops.extend(split_runs(target[add_start : end]))
+
+    add_start = 0
+    next_target_block = 0
+    i = 0
+    if n >= B:
+        checksum = L_adler32(target[:B])
+        a, b = checksum & 0xffff, checksum >> 16
+
+    while i + B <= n:
+        # Index target blocks that are completely behind us
+        if next_target_block + B <= i:
+            while next_target_block + B <= i:
+                target_blocks.setdefault(
+                    L_adler32(target[next_target_block : next_target_block + B]), next_target_block)
+                next_target_block += B
+
+        checksum = (b << 16) | a
+        best_len = 0
+
+        src_pos = source_blocks.get(checksum)
+        if src_pos is not None:
+            length = L_match_length(source, src_pos, target, i, min(len(source) - src_pos, n - i))
+            if length >= B:
+                best_len, best_kind, best_pos = length, 'src', src_pos
+
+        tgt_pos = target_blocks.get(checksum)
+        if tgt_pos is not None:
+            length = L_match_length(target, tgt_pos, target, i, n - i)
+            # (Source copies are faster to decode, so only prefer a
+            # target copy if it's longer)
+            if length >= B and length > best_len:
+                best_len, best_kind, best_pos = length, 'tgt', tgt_pos
+
+        if not best_len:
+            # Roll the checksum forward by one byte
+            if i + B < n:
+                out_byte = target[i]
+                a = (a - out_byte + target[i + B]) % 65521
+                b = (b - B * out_byte + a - 1) % 65521
+            i += 1
+            continue
+
+        # Extend the match backward, into the pending literal data
+        start = i
+        while start > add_start and best_pos > 0:
+            if best_kind == 'src':
+                if source[best_pos - 1] != target[start - 1]:
+                    break
+            elif target[best_pos - 1] != target[start - 1]:
+                break
+            start -= 1
+            best_pos -= 1
+            best_len += 1
+
+        add_literal(start)
+        if best_kind == 'src':
+            ops.append(('src', best_pos, best_len))
+        else:
+            ops.append(('tgt', target_start + best_pos, best_len))
+
+        i = add_start = start + best_len
+        if i + B <= n:
+            checksum = L_adler32(target[i : i + B])
+            a, b = checksum & 0xffff, checksum >> 16
+
+    add_literal(n)
+    return ops
+
+
+def encode_vcdiff(src: Union[BinaryIO, bytes], target: Union[BinaryIO, bytes],
+        out: BinaryIO, window_size: int = 0x800000, adler32: bool = True,
+        secondary: Optional[int] = None, appheader: Optional[bytes] = None,
+        block_size: int = ENCODER_BLOCK_SIZE) -> None:
+    """
+    Create a VCDIFF patch (compatible with xdelta3) that turns src into
+    target.
+
+    src: the "source" file, opened in binary-read mode, or a bytes-like
+        object. Real files are memory-mapped rather than read.
+    target: the target file, opened in binary-read mode, or a bytes-like
+        object. It's read one window at a time.
+    out: the output file, which must be opened in binary-write mode.
+        It's written one window at a time.
+    window_size: the target window size. xdelta3 can't decode windows
+        larger than 16 MiB.
+    adler32: whether to include Adler-32 checksums of target windows
+    secondary: None, or VCD_COMPRESSION_LZMA
+    appheader: the xdelta3 "appdata" to include, if any
+    block_size: the size of the blocks to index in the source file
+        (matches are at least this long)
+    """
+    source = _as_random_access_buffer(src)
+    target = as_binary_io(target)
+
+    try:
+        index = VCDIFFSourceIndex(source, block_size)
+        writer = VCDIFFWriter(out, secondary, appheader, adler32)
+
+        target_start = 0
+        while True:
+            target_window = target.read(window_size)
+            if not target_window:
+                break
+
+            ops = _encode_target_window(source, index, target_window, target_start)
+            writer.write_window(ops, target_start, target_window)
+            target_start += len(target_window)
+
+        if target_start == 0:
+            # xdelta3 won't decode a patch without any windows, so write
+            # an empty one, like it does
+            writer.write_window([], 0, b'')
+
+    finally:
+        if isinstance(source, mmap.mmap):
+            source.close()
 
 
-__all__ = ['apply_vcdiff']
+__all__ = ['apply_vcdiff', 'apply_vcdiff_pipelined', 'apply_vcdiff_threaded', 'apply_vcdiff_resumable',
+    'apply_vcdiff_copy_range', 'apply_vcdiff_async', 'iter_apply_vcdiff_async', 'decode_vcdiff_windows',
+    'VCDIFFStreamDecoder', 'VCDIFFWriter', 'encode_vcdiff']